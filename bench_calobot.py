@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: bench_calobot.py (v1 - Benchmark offline ponta a ponta do core com Firestore/Gemini falsos)
+#
+# Uso: python bench_calobot.py [--users 50] [--concurrency 25] [--seed 1234] [--json saida.json]
+#                              [--compare base.json] [--engine two_call|single_call] [--stream]
+# Cada usuário simulado faz o onboarding completo e depois uma conversa roteirizada (registros,
+# status, sugestões, papo). Firestore e Gemini são os de fake_backends, com latência/erros
+# configuráveis; nada acessa a rede. Reporta mensagens/s, latência por mensagem e por etapa
+# (metrics.span) e, numa segunda passada com tracemalloc, alocações. O JSON traz commit, seed e
+# parâmetros; --compare mostra a variação contra um resultado anterior.
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+
+os.environ.setdefault("NLU_CACHE_SHARED", "0")
+
+import calobot_core as core  # noqa: E402
+import fake_backends  # noqa: E402
+import firestore_manager  # noqa: E402
+import metrics  # noqa: E402
+import rate_limiter  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+ONBOARDING_SCRIPT = ["__INTERNAL_ONBOARDING_CHECK__", "1990", "masculino", "180", "80,5", "leve", "perder peso", "sim"]
+CONVERSATION_SCRIPT = [
+    "comi 2 pães de queijo e um café com leite",
+    "qual meu status?",
+    "me sugere um jantar leve sem lactose",
+    "oi",
+    "comi uma tapioca de frango",
+    "qual minha altura?",
+    "almocei arroz, feijão e bife",
+    "quem ganhou o jogo ontem?",
+    "valeu!",
+]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))]
+
+
+def summarize(values):
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "mean_ms": round(1000 * sum(values) / len(values), 3) if values else 0.0,
+        "p50_ms": round(1000 * percentile(values, 50), 3),
+        "p95_ms": round(1000 * percentile(values, 95), 3),
+        "p99_ms": round(1000 * percentile(values, 99), 3),
+        "max_ms": round(1000 * values[-1], 3) if values else 0.0,
+    }
+
+
+def git_revision():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or "unknown"
+    except Exception:
+        return "unknown"
+
+
+def install_backends(args):
+    """Fakes novos (dados vazios) com seeds fixas; devolve (firestore, modelo)."""
+    store = fake_backends.FakeFirestore(faults=fake_backends.FaultInjector(
+        latency_seconds=args.firestore_latency, jitter_seconds=args.firestore_jitter,
+        error_rate=args.firestore_error_rate, seed=args.seed))
+    model = fake_backends.FakeGenerativeModel(
+        faults=fake_backends.FaultInjector(latency_seconds=args.model_latency, jitter_seconds=args.model_jitter,
+                                           error_rate=args.model_error_rate, seed=args.seed + 1),
+        chunk_latency_seconds=args.chunk_latency, seed=args.seed)
+    core.set_backends(db_client=store, async_db_client=store.async_client(), model_obj=model)
+    core.ENGINE_MODE = args.engine
+    # Cota alta: o benchmark mede o pipeline, não a cota do Vertex
+    rate_limiter.model_limiter = rate_limiter.ModelRateLimiter(quota_per_minute=args.model_quota, burst=args.model_quota / 60)
+    random.seed(args.seed)
+    return store, model
+
+
+async def send(user_id, text, stream):
+    if not stream:
+        return await core.process_message_async(user_id, f"Bench {user_id}", text)
+    parts = []
+    with rate_limiter.message_scope():
+        async for part in core.process_message_stream(user_id, f"Bench {user_id}", text):
+            parts.append(part)
+    return "".join(parts) if parts else None
+
+
+async def run_load(args, users):
+    """Roda os roteiros de 'users' usuários (no máximo args.concurrency ao mesmo tempo)."""
+    latencies = defaultdict(list)  # fase -> segundos por mensagem
+    errors = defaultdict(int)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def run_user(user_id):
+        rng = random.Random(args.seed * 100003 + user_id)
+        conversation = CONVERSATION_SCRIPT[:]
+        rng.shuffle(conversation)
+        async with semaphore:
+            for phase, script in (("onboarding", ONBOARDING_SCRIPT), ("conversation", conversation)):
+                for text in script:
+                    start = time.perf_counter()
+                    try:
+                        reply = await send(user_id, text, args.stream)
+                    except Exception as e:
+                        errors[type(e).__name__] += 1
+                        reply = ""
+                    latencies[phase].append(time.perf_counter() - start)
+                    if reply is None and text != ONBOARDING_SCRIPT[0]:
+                        errors["no_reply"] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_user(1_000_000 + i) for i in range(users)))
+    return time.perf_counter() - start, latencies, errors
+
+
+def benchmark(args):
+    stage_samples = defaultdict(list)
+    outcomes = defaultdict(int)
+
+    def on_trace(intent, outcome, elapsed, spans):
+        outcomes[f"{intent}:{outcome}"] += 1
+        for stage, seconds, _ in spans:
+            stage_samples[stage].append(seconds)
+
+    metrics.METRICS_ENABLED = True
+    metrics.add_trace_listener(on_trace)
+    store, model = install_backends(args)
+    wall, latencies, errors = asyncio.run(run_load(args, args.users))
+    metrics.remove_trace_listener(on_trace)
+    messages = sum(len(v) for v in latencies.values())
+    result = {
+        "meta": {
+            "git": git_revision(),
+            "seed": args.seed,
+            "python": platform.python_version(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "params": {k: v for k, v in vars(args).items() if k not in ("json", "compare")},
+        },
+        "throughput": {"messages": messages, "wall_seconds": round(wall, 3), "messages_per_second": round(messages / wall, 2)},
+        "latency": {phase: summarize(values) for phase, values in sorted(latencies.items())},
+        "stages": {stage: summarize(values) for stage, values in sorted(stage_samples.items())},
+        "outcomes": dict(sorted(outcomes.items())),
+        "errors": dict(errors),
+        "backends": {"firestore": store.stats(), "model": model.stats(), "model_limiter": rate_limiter.model_limiter.stats()},
+    }
+    result["latency"]["all"] = summarize([v for values in latencies.values() for v in values])
+
+    if not args.no_tracemalloc:
+        metrics.METRICS_ENABLED = False  # Mede o pipeline, não o próprio benchmark
+        install_backends(args)
+        memory_users = min(args.users, args.memory_users)
+        tracemalloc.start(10)
+        before = tracemalloc.take_snapshot()
+        _, mem_latencies, _ = asyncio.run(run_load(args, memory_users))
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        mem_messages = sum(len(v) for v in mem_latencies.values())
+        diff = after.compare_to(before, "lineno")
+        result["memory"] = {
+            "messages": mem_messages,
+            "peak_kib": round(peak / 1024, 1),
+            "retained_kib": round(sum(d.size_diff for d in diff) / 1024, 1),
+            "retained_blocks": sum(d.count_diff for d in diff),
+            "top_retained": [f"{d.traceback[0].filename.rsplit(os.sep, 1)[-1]}:{d.traceback[0].lineno} {d.size_diff / 1024:+.1f} KiB"
+                             for d in sorted(diff, key=lambda d: -d.size_diff)[:5]],
+        }
+    return result
+
+
+def print_report(result, baseline=None):
+    def delta(new, old):
+        return f" ({(new - old) / old:+.1%})" if old else ""
+
+    meta, thr = result["meta"], result["throughput"]
+    print(f"\n=== bench_calobot @ {meta['git']} (seed {meta['seed']}, Python {meta['python']}) ===")
+    base_thr = baseline["throughput"]["messages_per_second"] if baseline else 0
+    print(f"Mensagens: {thr['messages']} em {thr['wall_seconds']}s -> {thr['messages_per_second']} msg/s{delta(thr['messages_per_second'], base_thr)}")
+    print(f"\n{'latência':<22}{'n':>7}{'média':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'máx':>10}  (ms)")
+    for section in ("latency", "stages"):
+        for name, s in result[section].items():
+            base = (baseline or {}).get(section, {}).get(name, {})
+            label = name if section == "latency" else f"  etapa {name}"
+            print(f"{label:<22}{s['count']:>7}{s['mean_ms']:>10.2f}{s['p50_ms']:>10.2f}{s['p95_ms']:>10.2f}{s['p99_ms']:>10.2f}{s['max_ms']:>10.2f}"
+                  + (f"  p50{delta(s['p50_ms'], base.get('p50_ms'))}" if base else ""))
+    print(f"\nResultados: {result['outcomes']}")
+    print(f"Erros: {result['errors'] or 'nenhum'}")
+    print(f"Backends: {result['backends']}")
+    if "memory" in result:
+        mem = result["memory"]
+        base_peak = (baseline or {}).get("memory", {}).get("peak_kib")
+        print(f"\nMemória ({mem['messages']} mensagens): pico {mem['peak_kib']} KiB{delta(mem['peak_kib'], base_peak)}, "
+              f"retido {mem['retained_kib']} KiB em {mem['retained_blocks']} blocos")
+        for line in mem["top_retained"]:
+            print(f"  {line}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline do calobot_core (Firestore/Gemini falsos).")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=25, help="Usuários conversando ao mesmo tempo.")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--engine", choices=["two_call", "single_call"], default="two_call")
+    parser.add_argument("--stream", action="store_true", help="Usa process_message_stream.")
+    parser.add_argument("--model-latency", type=float, default=0.05)
+    parser.add_argument("--model-jitter", type=float, default=0.02)
+    parser.add_argument("--model-error-rate", type=float, default=0.0)
+    parser.add_argument("--chunk-latency", type=float, default=0.0, help="Atraso entre pedaços no streaming.")
+    parser.add_argument("--firestore-latency", type=float, default=0.004)
+    parser.add_argument("--firestore-jitter", type=float, default=0.002)
+    parser.add_argument("--firestore-error-rate", type=float, default=0.0)
+    parser.add_argument("--model-quota", type=float, default=1e6, help="Cota do rate limiter (req/min).")
+    parser.add_argument("--memory-users", type=int, default=10, help="Usuários na passada com tracemalloc.")
+    parser.add_argument("--no-tracemalloc", action="store_true")
+    parser.add_argument("--log-level", default="ERROR", help="Nível de log do core durante a carga.")
+    parser.add_argument("--json", help="Grava o resultado neste arquivo.")
+    parser.add_argument("--compare", help="JSON de uma execução anterior para comparar.")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(args.log_level)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    result = benchmark(args)
+    firestore_manager.touch_flusher.stop()
+    print_report(result, baseline)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"\nResultado gravado em {args.json}")
+    return 0 if not result["errors"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,27 @@
 # -*- coding: utf-8 -*-
-# Nome do arquivo: calobot_core.py (v33 - Simplificação EXTREMA try/except validação)
+# Nome do arquivo: calobot_core.py (v53 - Stream da resposta limitado pelo prazo da mensagem)
 
+import conversation_memory
+import daily_history
 import firestore_manager
-import vertexai
-from vertexai.generative_models import GenerativeModel, Part, GenerationConfig, SafetySetting, HarmCategory
+import food_db
+import kcal_estimate_cache
+import metrics
+import rate_limiter
+import response_pool
+import nlu_local
+import nlu_cache
+import onboarding
 import datetime
 import re
 import json # Para processar JSON da NLU
 from google.cloud import firestore
 import logging
+import os
+import asyncio
+import atexit
+import threading
+import time
 
 # Configuração básica de logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -18,75 +31,305 @@ logger = logging.getLogger(__name__)
 PROJECT_ID = "gen-lang-client-0288576877"
 LOCATION = "us-central1"
 MODEL_NAME = "gemini-1.0-pro"
+# NLU local (nlu_local.py): acima do limiar de confiança, não chama o Gemini
+NLU_LOCAL_ENABLED = os.environ.get("NLU_LOCAL_ENABLED", "1") != "0"
+NLU_LOCAL_THRESHOLD = float(os.environ.get("NLU_LOCAL_THRESHOLD", "0.85"))
+# Cache de NLU (nlu_cache.py); NLU_CACHE_SHARED=1 compartilha via Firestore entre processos
+NLU_CACHE_ENABLED = os.environ.get("NLU_CACHE_ENABLED", "1") != "0"
+NLU_CACHE_SHARED = os.environ.get("NLU_CACHE_SHARED", "0") == "1"
+NLU_CACHE_MAX_ENTRIES = int(os.environ.get("NLU_CACHE_MAX_ENTRIES", "5000"))
+NLU_CACHE_TTL_SECONDS = int(os.environ.get("NLU_CACHE_TTL_SECONDS", str(6 * 3600)))
+# Modo do motor: "two_call" (NLU + resposta) ou "single_call" (uma chamada devolve intent, entidades, resposta e kcal)
+ENGINE_MODE = os.environ.get("CALOBOT_ENGINE_MODE", "two_call")
+# Só modelos com saída estruturada (ex: gemini-1.5) aceitam response_mime_type="application/json"
+SINGLE_CALL_JSON_MODE = os.environ.get("SINGLE_CALL_JSON_MODE", "0") == "1"
+# Tabela local de alimentos (food_db.py): itens conhecidos têm kcal calculadas sem o Gemini
+FOOD_DB_ENABLED = os.environ.get("FOOD_DB_ENABLED", "1") != "0"
+# Cache de estimativas de kcal (kcal_estimate_cache.py): mediana das estimativas do Gemini por alimento+quantidade, entre usuários
+KCAL_CACHE_ENABLED = os.environ.get("KCAL_CACHE_ENABLED", "1") != "0"
+KCAL_CACHE_MAX_ENTRIES = int(os.environ.get("KCAL_CACHE_MAX_ENTRIES", "20000"))
+KCAL_CACHE_MIN_OBSERVATIONS = int(os.environ.get("KCAL_CACHE_MIN_OBSERVATIONS", "2"))
+KCAL_CACHE_FLUSH_SECONDS = float(os.environ.get("KCAL_CACHE_FLUSH_SECONDS", "60"))
+# Persona e esquema da NLU como system_instruction do modelo (texto fixo fora de cada prompt). O gemini-1.0-pro
+# não aceita system_instruction: nele o padrão é concatenar o texto fixo ao prompt, como antes
+SYSTEM_INSTRUCTION_ENABLED = os.environ.get("SYSTEM_INSTRUCTION_ENABLED", "0" if MODEL_NAME == "gemini-1.0-pro" else "1") == "1"
 
-# Inicializa Firestore
-db = firestore_manager.db
-if not db: logger.critical("ERRO CRÍTICO: Cliente Firestore não inicializado.");
-else: logger.info("Cliente Firestore carregado com sucesso.")
-
-# Inicializa Vertex AI
-model = None; generation_config = None; safety_settings = None
-try:
-    logger.info(f"Inicializando Vertex AI: Projeto={PROJECT_ID}, Local={LOCATION}")
-    vertexai.init(project=PROJECT_ID, location=LOCATION); logger.info("Vertex AI inicializado.")
-    model = GenerativeModel(MODEL_NAME); logger.info(f"Modelo {MODEL_NAME} carregado.")
-    generation_config = GenerationConfig(temperature=0.7, top_p=0.95); logger.info(f"Config Geração definida (temp=0.7).")
-    safety_settings = { HarmCategory.HARM_CATEGORY_HARASSMENT: SafetySetting.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE, HarmCategory.HARM_CATEGORY_HATE_SPEECH: SafetySetting.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE, HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: SafetySetting.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE, HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: SafetySetting.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE, }; logger.info(f"Config Segurança aplicadas.")
-except Exception as e: logger.error(f"ERRO CRÍTICO inicializar Vertex AI: {e}", exc_info=True); model=None; generation_config=None; safety_settings=None
+# Clientes do GCP: criados por init() (na 1ª mensagem ou no warmup() do bot). Importar o módulo não
+# importa o SDK do Vertex, não procura credenciais e não abre canais gRPC.
+db = None; model = None; reply_model = None; nlu_model = None; generation_config = None; safety_settings = None
+_initialized = False; _init_lock = threading.Lock()
+
+# Inicializa cache de NLU (o armazenamento compartilhado no Firestore é ligado no init())
+nlu_result_cache = None
+if NLU_CACHE_ENABLED:
+    nlu_result_cache = nlu_cache.NLUCache(max_entries=NLU_CACHE_MAX_ENTRIES, ttl_seconds=NLU_CACHE_TTL_SECONDS)
+    logger.info(f"Cache NLU ativo (max={NLU_CACHE_MAX_ENTRIES}, ttl={NLU_CACHE_TTL_SECONDS}s, compartilhado={NLU_CACHE_SHARED}).")
+
+# Inicializa cache de estimativas de kcal (persistido em "kcal_estimates" via write-behind; carregado no warmup())
+kcal_cache = None; kcal_writer = None
+if KCAL_CACHE_ENABLED:
+    kcal_writer = firestore_manager.WriteBehindFlusher(interval_seconds=KCAL_CACHE_FLUSH_SECONDS, collection="kcal_estimates"); atexit.register(kcal_writer.stop)
+    kcal_cache = kcal_estimate_cache.KcalEstimateCache(max_entries=KCAL_CACHE_MAX_ENTRIES, min_observations=KCAL_CACHE_MIN_OBSERVATIONS, writer=kcal_writer)
+
+# Métricas (metrics.py): estatísticas dos caches e do rate limiter exportadas como gauges
+metrics.register_collector("model_limiter", rate_limiter.model_limiter.stats)
+if nlu_result_cache: metrics.register_collector("nlu_cache", nlu_result_cache.stats)
+if kcal_cache: metrics.register_collector("kcal_cache", kcal_cache.stats)
+if response_pool.RESPONSE_POOL_ENABLED: metrics.register_collector("response_pool", response_pool.stats)
+
+def _default_generation_settings():
+    """(GenerationConfig, safety_settings) padrão das respostas."""
+    from vertexai.generative_models import GenerationConfig, HarmCategory, SafetySetting
+    block = SafetySetting.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE
+    return GenerationConfig(temperature=0.7, top_p=0.95), { HarmCategory.HARM_CATEGORY_HARASSMENT: block, HarmCategory.HARM_CATEGORY_HATE_SPEECH: block, HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: block, HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: block }
+
+# --- Ponte síncrona -> assíncrona ---
+# O pipeline é assíncrono (Vertex generate_content_async + Firestore AsyncClient). Chamadores síncronos
+# (scripts, testes manuais) usam um event loop dedicado numa thread de fundo, sempre o mesmo, pois os
+# clientes gRPC assíncronos ficam presos ao loop em que foram criados.
+_sync_loop = None; _sync_loop_lock = threading.Lock()
+
+def _run_sync(coro):
+    """Executa uma corrotina do pipeline a partir de código síncrono."""
+    global _sync_loop
+    with _sync_loop_lock:
+        if _sync_loop is None:
+            _sync_loop = asyncio.new_event_loop(); threading.Thread(target=_sync_loop.run_forever, name="calobot-sync-loop", daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coro, _sync_loop).result()
+
+STREAM_TIMEOUT_REPLY = "Demorei demais para responder 😅 Pode mandar de novo?" # Stream sem nenhum pedaço antes do prazo da mensagem
 
 # --- Definição da Persona Base ---
-BASE_PERSONA_PROMPT = """
-Aja como o CaloBot: um coach nutricional digital parceiro e motivador. Use uma linguagem clara, positiva e encorajadora. Seu objetivo é ajudar o usuário com informações sobre calorias, dieta e hábitos saudáveis de forma prática e compreensível. Use emojis para tornar a conversa amigável (ex: 😊, 👍, 💪, 🍎, 🥗, 🏃‍♀️), mas evite sarcasmo ou excesso de informalidade. Responda sempre em português do Brasil (pt-br).
-"""
+BASE_PERSONA_PROMPT = "Aja como o CaloBot: coach nutricional digital, parceiro e motivador. Linguagem clara, positiva e encorajadora. Ajude com calorias, dieta e hábitos saudáveis de forma prática e compreensível. Use emojis amigáveis (ex: 😊👍💪🍎🥗🏃‍♀️), sem sarcasmo ou excesso de informalidade. Responda sempre em português do Brasil (pt-br)."
 # --- Definições para NLU ---
 POSSIBLE_INTENTS = [ "LOG_FOOD", "ASK_SUGGESTION", "GET_STATUS", "GET_PROFILE", "UPDATE_PROFILE", "PROVIDE_INFO", "GREETING", "FAREWELL", "AFFIRMATION", "NEGATION", "HELP", "CHITCHAT", "OUT_OF_SCOPE", "UNCLEAR" ]
 POSSIBLE_ENTITIES = [ "food_items", "quantity", "meal_time", "profile_field", "profile_value", "info_value", "dietary_constraint", "preference" ]
+_INTENTS_CSV = ",".join(POSSIBLE_INTENTS); _ENTITIES_CSV = ",".join(e + "[]" if e in ("food_items", "dietary_constraint") else e for e in POSSIBLE_ENTITIES)
+NLU_SCHEMA_PROMPT = (f'Analise a mensagem do usuário e retorne só um JSON VÁLIDO {{"intent":"...","entities":{{...}}}}.\n'
+                     f"Intenções: {_INTENTS_CSV} (UNCLEAR/CHITCHAT/OUT_OF_SCOPE quando couber).\nEntidades (só as encontradas): {_ENTITIES_CSV}.")
+
+# --- Templates de tarefa (compactos, montados uma vez no import; o status vai só na linha de contexto) ---
+TASK_TEMPLATES = {
+    "CONTEXT": "Contexto '{name}': {status}.",
+    "ONBOARDING": "Tarefa:Onboarding '{name}'. Peça '{field}' usando:'{question}'",
+    "REPROMPT": "Tarefa:'{name}' deu input inválido('{value}') p/ '{field}'. Peça de novo:'{hint}'",
+    "GOAL_NEXT": "Tarefa:Perfil ok! Diga prox passo=meta.",
+    "GOAL_SUGGESTION": "Tarefa:Perfil ok! TDEE={tdee}, obj='{goal}'. Sugiro meta {suggested} kcal. Apresente, pergunte 'sim' ou número.",
+    "GOAL_ERROR": "Erro cálculo meta.",
+    "LOG_FOOD": "Tarefa:User registrou:'{message}'(Extr:{extr}). 1.Estime kcal('Estimativa CaloBot: XXX kcal.'). 2.Comente. 3.Mencione status(+estimativa).",
+    "LOG_FOOD_TABLE": "Tarefa:User registrou:'{message}'(Extr:{extr}). Tabela CaloBot:{table}. 1.Informe 'Estimativa CaloBot: {total} kcal.' 2.Comente. 3.Mencione status(+estimativa).",
+    "LOG_FOOD_PARTIAL": "Tarefa:User registrou:'{message}'(Extr:{extr}). Já calculado pela Tabela CaloBot:{table}. 1.Estime kcal SÓ de:{unknown}('Estimativa CaloBot: XXX kcal.' só desses). 2.Comente. 3.Mencione status(+estimativa).",
+    "ASK_SUGGESTION": "Tarefa:User pede sugestão:'{message}'. {ctx} Sugira 2-3 opções c/ kcal.",
+    "GET_STATUS": "Tarefa:User perguntou status('{message}'). Responda c/ o contexto(Hist=últimos 7/30 dias, p/ semana/mês).",
+    "GET_PROFILE": "Tarefa:User pediu perfil('{message}',campo:{field}). Perfil:{profile}. Foco no campo se esp.",
+    "UPDATE_PROFILE": "Tarefa:User tentou atualizar perfil('{message}'). Informe não impl.",
+    "SOCIAL": "Tarefa:User enviou {intent}:'{message}'. Responda apropriadamente.",
+    "OUT_OF_SCOPE": "Tarefa:User fora do escopo('{message}'). Diga foco nutrição/saúde.",
+    "UNCLEAR": "Tarefa:User:'{message}'. Intenção incerta. Responda conversacionalmente.",
+    "NLU_ERROR": "Tarefa:Erro entender:'{message}'. Peça desculpas/reformulação.",
+    "SINGLE_CALL": ("Contexto '{name}': {status}. Perfil:{profile}.\nMensagem do Usuário:\"{message}\"\n"
+                    f"Tarefa:1.Identifique \"intent\"({_INTENTS_CSV}) e \"entities\"({_ENTITIES_CSV}; só as encontradas). "
+                    "2.\"reply\" ao usuário conforme a intent: LOG_FOOD->estime kcal, comente, mencione status(+estimativa); ASK_SUGGESTION->sugira 2-3 opções c/ kcal; GET_STATUS->responda c/ o contexto; GET_PROFILE->apresente o perfil; UPDATE_PROFILE->informe não impl.; OUT_OF_SCOPE->diga foco nutrição/saúde; demais->responda apropriadamente. "
+                    "3.\"estimated_kcal\": inteiro se LOG_FOOD, senão null.\n"
+                    'Retorne APENAS um JSON VÁLIDO: {{"intent":"...","entities":{{...}},"reply":"...","estimated_kcal":null}}'),
+}
+SOCIAL_INTENTS = ("GREETING", "FAREWELL", "AFFIRMATION", "NEGATION", "HELP", "CHITCHAT")
+
+# --- Ciclo de vida dos clientes: init() -> warmup() -> close() ---
+def init():
+    """Cria Firestore, Vertex AI e modelos (idempotente, thread-safe). Retorna True se Firestore e modelo estão ok."""
+    global db, model, reply_model, nlu_model, generation_config, safety_settings, SYSTEM_INSTRUCTION_ENABLED, _initialized
+    if _initialized: return bool(db and model)
+    with _init_lock:
+        if _initialized: return bool(db and model)
+        db = db or firestore_manager.init()  # set_backends pode já ter plugado um cliente
+        if not db: logger.critical("ERRO CRÍTICO: Cliente Firestore não inicializado.")
+        else: logger.info("Cliente Firestore carregado com sucesso.")
+        if nlu_result_cache and NLU_CACHE_SHARED and db: nlu_result_cache.backing_store = nlu_cache.FirestoreNLUStore(db, async_db_factory=firestore_manager.get_async_db)
+        if model is None:  # Idem para o modelo
+            try:
+                import vertexai; from vertexai.generative_models import GenerativeModel
+                logger.info(f"Inicializando Vertex AI: Projeto={PROJECT_ID}, Local={LOCATION}")
+                vertexai.init(project=PROJECT_ID, location=LOCATION); logger.info("Vertex AI inicializado.")
+                model = GenerativeModel(MODEL_NAME); logger.info(f"Modelo {MODEL_NAME} carregado.")
+                generation_config, safety_settings = _default_generation_settings(); logger.info(f"Config Geração (temp=0.7) e Segurança aplicadas.")
+            except Exception as e: logger.error(f"ERRO CRÍTICO inicializar Vertex AI: {e}", exc_info=True); model=None; generation_config=None; safety_settings=None
+            # Modelos com o texto fixo como system_instruction (sem ela, reply_model/nlu_model são o próprio model)
+            reply_model = model; nlu_model = model
+            if model and SYSTEM_INSTRUCTION_ENABLED:
+                try: reply_model = GenerativeModel(MODEL_NAME, system_instruction=[BASE_PERSONA_PROMPT]); nlu_model = GenerativeModel(MODEL_NAME, system_instruction=[NLU_SCHEMA_PROMPT]); logger.info("Persona e esquema NLU como system_instruction.")
+                except Exception as e: logger.error(f"Falha criar modelos c/ system_instruction ({e}); usando prompt concatenado."); SYSTEM_INSTRUCTION_ENABLED = False
+        elif not generation_config or not safety_settings: generation_config, safety_settings = _default_generation_settings()
+        _initialized = True
+    return bool(db and model)
+
+def _warmup_config():
+    from vertexai.generative_models import GenerationConfig
+    return GenerationConfig(temperature=0.0, max_output_tokens=1)
+
+def warmup():
+    """Antes do 1º usuário: init(), leitura barata no Firestore, cache de kcal e geração mínima (credenciais e canais síncronos).
+
+    Retorna o resultado de init(); falhas na leitura/geração de aquecimento só geram warning.
+    """
+    if not init(): return False
+    start = time.perf_counter()
+    with metrics.span("warmup_firestore") as sp:
+        try: db.collection("users").document("__warmup__").get()
+        except Exception as e: sp.fail(); logger.warning(f"[Warmup] Leitura no Firestore falhou: {e}")
+    if kcal_cache:
+        try: logger.info(f"Cache de kcal aquecido com {kcal_cache.load(db)} alimentos.")
+        except Exception as e: logger.warning(f"Falha ao aquecer cache de kcal: {e}")
+    if response_pool.RESPONSE_POOL_ENABLED:
+        response_pool.load()
+        if response_pool.GENERATE_ON_WARMUP and response_pool.missing_keys():
+            with metrics.span("warmup_response_pool") as sp:
+                try: logger.info(f"[Warmup] {response_pool.generate(generate_pool_text)} chaves do pool geradas."); response_pool.save()
+                except Exception as e: sp.fail(); logger.warning(f"[Warmup] Pool de respostas não gerado/gravado: {e}")
+    with metrics.span("warmup_generate") as sp:
+        try: model.generate_content("ok", generation_config=_warmup_config())
+        except Exception as e: sp.fail(); logger.warning(f"[Warmup] Geração mínima falhou: {e}")
+    logger.info(f"[Warmup] Clientes síncronos prontos em {time.perf_counter() - start:.2f}s.")
+    return True
+
+def generate_pool_text(prompt):
+    """Geração síncrona com a persona para response_pool (offline/warm-up, fora do caminho das mensagens)."""
+    if not init(): raise RuntimeError("Modelo indisponível")
+    response = reply_model.generate_content(prompt if SYSTEM_INSTRUCTION_ENABLED else f"{BASE_PERSONA_PROMPT}\n\n{prompt}", generation_config=generation_config, safety_settings=safety_settings)
+    return response.candidates[0].content.parts[0].text if response.candidates and response.candidates[0].content.parts else ""
+
+async def warmup_async():
+    """Abre os canais presos ao event loop atual (AsyncClient do Firestore e clientes async dos modelos). Chamar no loop do bot."""
+    if not init(): return False
+    start = time.perf_counter()
+    with metrics.span("warmup_firestore") as sp:
+        try: await firestore_manager.get_async_db().collection("users").document("__warmup__").get()
+        except Exception as e: sp.fail(); logger.warning(f"[Warmup] Leitura assíncrona no Firestore falhou: {e}")
+    for m in {id(m): m for m in (reply_model, nlu_model)}.values():
+        with metrics.span("warmup_generate") as sp:
+            try: await m.generate_content_async("ok", generation_config=_warmup_config())
+            except Exception as e: sp.fail(); logger.warning(f"[Warmup] Geração mínima assíncrona falhou: {e}")
+    logger.info(f"[Warmup] Canais do event loop prontos em {time.perf_counter() - start:.2f}s.")
+    return True
+
+def close():
+    """Grava pendências (write-behind do cache de kcal e touches) e solta os clientes; init() recria sob demanda."""
+    global db, model, reply_model, nlu_model, _initialized
+    with _init_lock:
+        if kcal_writer: kcal_writer.flush()
+        firestore_manager.close()
+        db = model = reply_model = nlu_model = None; _initialized = False
+    logger.info("Clientes do calobot_core fechados.")
+
+def set_backends(db_client=None, async_db_client=None, model_obj=None):
+    """Pluga Firestore e/ou modelo (ex: fake_backends para benchmarks offline) no lugar dos clientes do GCP.
+
+    Os modelos com system_instruction são derivados de model_obj (via with_system_instruction, se houver).
+    """
+    global db, model, reply_model, nlu_model, generation_config, safety_settings, _initialized
+    if db_client is not None:
+        firestore_manager.set_clients(db_client, async_db_client); db = db_client
+    if model_obj is not None:
+        model = reply_model = nlu_model = model_obj
+        derive = getattr(model_obj, "with_system_instruction", None)
+        if SYSTEM_INSTRUCTION_ENABLED and derive: reply_model = derive([BASE_PERSONA_PROMPT]); nlu_model = derive([NLU_SCHEMA_PROMPT])
+        if not generation_config or not safety_settings: generation_config, safety_settings = _default_generation_settings()
+        _initialized = db is not None  # Com os dois plugados, init() não cria clientes do GCP
+    if nlu_result_cache: nlu_result_cache.clear()
+    if kcal_cache: kcal_cache.clear()
+
+def _compact(data):
+    """Dict em 'k=v,k=v' (sem vazios nem dicts aninhados, ex: profile.derived): bem menos tokens que o repr do Python."""
+    return ",".join(f"{k}={v}" for k, v in (data or {}).items() if v not in (None, "", [], {}) and not isinstance(v, dict))
+
+def compose_prompt(task, context=None):
+    """Prompt de resposta: [contexto] + tarefa. Sem system_instruction, a persona vai na frente (modo antigo)."""
+    body = f"{context}\n{task}" if context else task
+    return f"{body}\nCaloBot:" if SYSTEM_INSTRUCTION_ENABLED else f"{BASE_PERSONA_PROMPT}\n\n{body}\nCaloBot:"
+
+def get_nlu_prompt(user_message):
+    prompt = f'Mensagem do Usuário:"{user_message}"\nJSON:'
+    return prompt if SYSTEM_INSTRUCTION_ENABLED else f"{NLU_SCHEMA_PROMPT}\n\n{prompt}"
 
 # --- Função NLU com Gemini ---
-def get_nlu_understanding(user_message):
-    """Usa Gemini para NLU. Retorna dict ou None."""
+async def get_nlu_understanding_async(user_message, use_model=True):
+    """NLU em camadas: classificador local, cache e, por último, Gemini (se use_model). Retorna dict ou None."""
     logger.info(f"[NLU] Análise: '{user_message}'")
+    if NLU_LOCAL_ENABLED:
+        local = nlu_local.classify(user_message)
+        if local and local['confidence'] >= NLU_LOCAL_THRESHOLD: logger.info(f"[NLU] Local OK ({local['source']}, conf={local['confidence']:.2f}): {local['intent']}, Ents:{local['entities']}"); return {"intent": local['intent'], "entities": local['entities']}
+        logger.debug(f"[NLU] Local insuficiente: {local}")
+    if nlu_result_cache:
+        cached = await nlu_result_cache.get_async(user_message)
+        if cached: logger.info(f"[NLU] Cache hit: {cached['intent']}, Ents:{cached['entities']}"); return cached
+    if not use_model: logger.info("[NLU] Sem resultado local/cache (modelo não solicitado)."); return None
+    init()
     if not model: logger.error("[NLU] Abortado: Modelo off."); return None
-    nlu_prompt = f"""
-Analise a mensagem do usuário e retorne um JSON VÁLIDO contendo a intenção principal ("intent") e as entidades relevantes ("entities").
-
-Intenções Possíveis: {POSSIBLE_INTENTS}
-Entidades Possíveis: {POSSIBLE_ENTITIES} (retorne apenas as encontradas: food_items[], quantity, meal_time, profile_field, profile_value, info_value, dietary_constraint[], preference).
-Intents especiais: UNCLEAR, CHITCHAT, OUT_OF_SCOPE.
-
-Mensagem do Usuário: "{user_message}"
-
-JSON Result:
-```json
-{{
-  "intent": "...",
-  "entities": {{ ... }}
-}}
-```"""
+    nlu_prompt = get_nlu_prompt(user_message)
     try: # TRY EXTERNO (Chamada API)
+        from vertexai.generative_models import GenerationConfig
         nlu_config = GenerationConfig(temperature=0.2, top_p=0.95);
-        response = model.generate_content(nlu_prompt, generation_config=nlu_config, safety_settings=safety_settings)
+        response = await rate_limiter.model_limiter.call(nlu_model.generate_content_async, nlu_prompt, generation_config=nlu_config, safety_settings=safety_settings)
         if response.candidates and response.candidates[0].content.parts:
             raw = response.candidates[0].content.parts[0].text; logger.debug(f"[NLU] Raw: {raw}")
             try: # TRY INTERNO (Parse JSON)
                 match = re.search(r'```json\s*(\{.*?\})\s*```', raw, re.DOTALL|re.IGNORECASE); json_str = match.group(1) if match else raw; data = json.loads(json_str)
-                if isinstance(data, dict) and "intent" in data: data.setdefault("entities",{}); logger.info(f"[NLU] OK: {data['intent']}, Ents:{data['entities']}"); return data
+                if isinstance(data, dict) and "intent" in data:
+                    data.setdefault("entities",{}); logger.info(f"[NLU] OK: {data['intent']}, Ents:{data['entities']}"); nlu_local.log_nlu_result(user_message, data)
+                    if nlu_result_cache: await nlu_result_cache.set_async(user_message, data)
+                    return data
                 else: logger.error(f"[NLU] JSON inválido/sem intent: {data}"); return {"intent": "UNCLEAR", "entities": {}}
             except json.JSONDecodeError as json_err: logger.error(f"[NLU] Erro decode JSON: {json_err}. String: '{json_str if 'json_str' in locals() else raw}'"); return {"intent": "UNCLEAR", "entities": {}}
             except Exception as parse_err: logger.error(f"[NLU] Erro inesperado parse NLU: {parse_err}", exc_info=True); return {"intent": "UNCLEAR", "entities": {}}
         else: reason=getattr(response.candidates[0],'finish_reason','?') if response.candidates else 'X'; logger.error(f"[NLU] Resp Gemini vazia/bloq NLU. Razão:{reason}"); return None
     except Exception as e: logger.error(f"[NLU] Erro GERAL chamada Gemini NLU: {e}", exc_info=True); return None
 
+def get_nlu_understanding(user_message, use_model=True):
+    """Wrapper síncrono de get_nlu_understanding_async."""
+    return _run_sync(get_nlu_understanding_async(user_message, use_model))
+
+# --- Modo Chamada Única: NLU + Resposta num só JSON ---
+def get_single_call_prompt(user_display_name, status, profile_data, message_text):
+    task = TASK_TEMPLATES["SINGLE_CALL"].format(name=user_display_name, status=status, profile=_compact(profile_data), message=message_text)
+    return task if SYSTEM_INSTRUCTION_ENABLED else f"{BASE_PERSONA_PROMPT}\n\n{task}"
+
+async def get_single_call_response_async(prompt, user_message):
+    """Uma chamada ao Gemini que devolve {"intent","entities","reply","estimated_kcal"}. Retorna dict ou None."""
+    init()
+    if not model: logger.error("[Single] Abortado: Modelo off."); return None
+    try:
+        from vertexai.generative_models import GenerationConfig
+        single_config = GenerationConfig(temperature=0.7, top_p=0.95, response_mime_type="application/json") if SINGLE_CALL_JSON_MODE else generation_config
+        response = await rate_limiter.model_limiter.call(reply_model.generate_content_async, prompt, generation_config=single_config, safety_settings=safety_settings)
+        if not (response.candidates and response.candidates[0].content.parts): reason=getattr(response.candidates[0],'finish_reason','?') if response.candidates else 'X'; logger.error(f"[Single] Resp vazia/bloq. Razão:{reason}"); return None
+        raw = response.candidates[0].content.parts[0].text; logger.debug(f"[Single] Raw: {raw}")
+        match = re.search(r'```json\s*(\{.*\})\s*```', raw, re.DOTALL|re.IGNORECASE); data = json.loads(match.group(1) if match else raw)
+        if not isinstance(data, dict) or not data.get("intent") or not str(data.get("reply") or "").strip(): logger.error(f"[Single] JSON sem intent/reply: {data}"); return None
+        if data["intent"] not in POSSIBLE_INTENTS: logger.warning(f"[Single] Intent desconhecida '{data['intent']}' -> UNCLEAR"); data["intent"] = "UNCLEAR"
+        if not isinstance(data.get("entities"), dict): data["entities"] = {}
+        data["reply"] = str(data["reply"]).strip(); data.setdefault("estimated_kcal", None)
+        logger.info(f"[Single] OK: {data['intent']}, Ents:{data['entities']}, Kcal:{data['estimated_kcal']}")
+        nlu_part = {"intent": data["intent"], "entities": data["entities"]}; nlu_local.log_nlu_result(user_message, nlu_part)
+        if nlu_result_cache: await nlu_result_cache.set_async(user_message, nlu_part)
+        return data
+    except json.JSONDecodeError as json_err: logger.error(f"[Single] Erro decode JSON: {json_err}"); return None
+    except Exception as e: logger.error(f"[Single] Erro GERAL chamada única: {e}", exc_info=True); return None
+
 # --- Função Auxiliar para Verificar Perfil ---
 def is_profile_incomplete(user_data):
-    profile = user_data.get('profile', {}); required = ['birth_year','gender','height_cm','current_weight_kg','activity_level','goal']
-    missing = [f for f in required if profile.get(f) is None or profile.get(f) == ""]; is_inc = bool(missing)
+    profile = user_data.get('profile', {})
+    missing = [f for f in onboarding.PROFILE_FIELDS if profile.get(f) is None or profile.get(f) == ""]; is_inc = bool(missing)
     logger.debug(f"[Profile Check] {'Incompleto: '+str(missing) if is_inc else 'Completo.'}")
     return is_inc, missing
 
 # --- Função Auxiliar para Extrair Calorias ---
-def extract_calories(text):
-    """Extrai a estimativa de calorias da resposta do Gemini."""
+def extract_calories(text, structured_result=None):
+    """Extrai a estimativa de calorias: do campo 'estimated_kcal' (chamada única) ou do texto do Gemini."""
+    if structured_result and structured_result.get('estimated_kcal') is not None:
+        try: cal = int(float(str(structured_result['estimated_kcal']).replace(',','.')))
+        except (ValueError, TypeError): cal = None
+        if cal is not None and 0<cal<10000: return cal
+        logger.warning(f"[Extract Kcal] Campo estimated_kcal inválido: {structured_result.get('estimated_kcal')}. Tentando texto.")
     if not text: logger.warning("[Extract Kcal] Texto vazio."); return None
     logger.debug(f"[Extract Kcal] Tentando: '{text[:100]}...'")
     match_specific = re.search(r'Estimativa\s+CaloBot:\s*(\d+)\s*kcal', text, re.IGNORECASE)
@@ -102,26 +345,54 @@ def extract_calories(text):
 # --- Funções Auxiliares para Prompts de Resposta ---
 def get_onboarding_prompt(user_display_name, field_name):
     logger.debug(f"[Prompt] Onboarding '{field_name}' user {user_display_name}")
-    prompts = {'birth_year':"Ano nascimento (AAAA)? 🎂", 'gender':"Gênero (masc/fem)? 🧍", 'height_cm':"Altura em cm (ex:175)? 📏", 'current_weight_kg':"Peso atual kg (ex:70.5)? ⚖️", 'activity_level':"Nível atividade? Opções:'sedentário','leve','moderado','ativo','muito ativo' 🏃", 'goal':"Objetivo? Opções:'perder peso','manter peso','ganhar massa' 💪"}
-    q = prompts.get(field_name, f"'{field_name}'?")
-    task = f"Tarefa: Onboarding '{user_display_name}'. Peça '{field_name}' usando: '{q}'"; return f"{BASE_PERSONA_PROMPT}\n\n{task}\n\nCaloBot:"
+    return compose_prompt(TASK_TEMPLATES["ONBOARDING"].format(name=user_display_name, field=field_name, question=onboarding.question(field_name)))
 
 def get_reprompt(user_display_name, field_name, invalid_input=""):
     logger.debug(f"[Prompt] Re-prompt '{field_name}' (input:'{invalid_input}')")
-    reprompts = {'birth_year':"Ano inválido(AAAA).",'gender':"Inválido(masc/fem).",'height_cm':"Inválido(cm, números).",'current_weight_kg':"Inválido(kg, números).",'activity_level':"Inválido. Opções: 'sedentário',...,'muito ativo'.",'goal':"Inválido. Opções:'perder','manter','ganhar'.",'goal_confirmation':"Inválido. Digite 'sim' ou número kcal(1000-10000)."}
-    msg = reprompts.get(field_name, "Inválido. Tente de novo.")
-    task = f"Tarefa: User '{user_display_name}' deu input inválido ('{invalid_input}') p/ '{field_name}'. Peça de novo: '{msg}'"; return f"{BASE_PERSONA_PROMPT}\n\n{task}\n\nCaloBot:"
+    return compose_prompt(TASK_TEMPLATES["REPROMPT"].format(name=user_display_name, value=invalid_input, field=field_name, hint=onboarding.hint(field_name)))
 
-# --- Função Principal de Processamento (v33 - Simplificação EXTREMA try/except validação) ---
-def process_message(user_id, user_name_from_telegram, message_text):
-    if not db or not model: logger.critical(f"Abort {user_id}: Deps off."); return "Problemas técnicos internos 🤖💦."
+def get_intent_task(intent, message_text, entities, cal_rem, profile_data, food_price=None):
+    """Tarefa compacta do prompt de resposta para a intent da NLU (o status vai na linha de contexto)."""
+    t = TASK_TEMPLATES
+    if intent=="LOG_FOOD":
+        log_desc=entities.get('food_items',[message_text]); log_qty=entities.get('quantity'); log_meal=entities.get('meal_time'); extr=f"Alim:{','.join(log_desc)}"
+        if log_qty: extr+=f",Qtd:{log_qty}"
+        if log_meal: extr+=f",Ref:{log_meal}"
+        if not (food_price and food_price['items']): return t["LOG_FOOD"].format(message=message_text, extr=extr)
+        table=",".join(f"{i['query']}(~{i['grams']:g}g)={i['kcal']:g}kcal" if i['grams'] else f"{i['query']}={i['kcal']:g}kcal" for i in food_price['items'])
+        if not food_price['unknown']: return t["LOG_FOOD_TABLE"].format(message=message_text, extr=extr, table=table, total=round(food_price['total_kcal']))
+        return t["LOG_FOOD_PARTIAL"].format(message=message_text, extr=extr, table=table, unknown=",".join(food_price['unknown']))
+    if intent=="ASK_SUGGESTION":
+        pref=entities.get('preference'); constr=entities.get('dietary_constraint'); ctx=f"Restam {cal_rem if cal_rem is not None else 'Muitas'} kcal."
+        if pref: ctx+=f" Pref:{pref}."
+        if constr: ctx+=f" Restr:{','.join(constr)}."
+        return t["ASK_SUGGESTION"].format(message=message_text, ctx=ctx)
+    if intent=="GET_PROFILE": return t["GET_PROFILE"].format(message=message_text, field=entities.get('profile_field','geral'), profile=_compact(profile_data))
+    if intent in SOCIAL_INTENTS: return t["SOCIAL"].format(intent=intent, message=message_text)
+    if intent in ("GET_STATUS", "UPDATE_PROFILE", "OUT_OF_SCOPE"): return t[intent].format(message=message_text)
+    return t["UNCLEAR"].format(message=message_text)
+
+async def _timed(stage, awaitable, check=False):
+    """await dentro de um metrics.span (cabe nas linhas compactas do pipeline); check=True: resultado falso conta como erro."""
+    with metrics.span(stage) as sp:
+        result = await awaitable
+        if check and not result: sp.fail()
+        return result
+
+# --- Função Principal de Processamento (v41 - em etapas: preparar -> gerar -> finalizar) ---
+# Etapa 1: estado, onboarding, NLU e montagem do prompt. Retorna o dict do turno; com done=True a
+# resposta ('reply') já está decidida e não há chamada de geração.
+async def _prepare_turn(user_id, user_name_from_telegram, message_text):
+    if not init(): logger.critical(f"Abort {user_id}: Deps off."); return {"done": True, "reply": "Problemas técnicos internos 🤖💦."}
     logger.info(f"\n--- Processando user:{user_id}, Msg:'{message_text}' ---")
-    user_data = firestore_manager.get_or_create_user(user_id, user_name_from_telegram)
-    if not user_data: logger.error(f"Falha get/create {user_id}."); return "Problema buscar/criar dados."
+    user_data = await _timed("firestore_get", firestore_manager.get_or_create_user_async(user_id, user_name_from_telegram), check=True)
+    if not user_data: logger.error(f"Falha get/create {user_id}."); return {"done": True, "reply": "Problema buscar/criar dados."}
 
     current_user_data=user_data.copy(); user_display_name=current_user_data.get('user_name','Usuário'); profile_data=current_user_data.get('profile',{}).copy(); diet_settings=current_user_data.get('diet_settings',{}).copy(); daily_tracking=current_user_data.get('daily_tracking',{}).copy(); user_state=current_user_data.get('user_state',{'awaiting':None}).copy(); currently_awaiting=user_state.get('awaiting')
-    user_id_str=str(user_id); user_doc_ref=db.collection('users').document(user_id_str)
-    prompt_final=""; intent="UNKNOWN"; entities={}; run_normal_processing=True; data_to_update={}
+    prompt_final=""; intent="UNKNOWN"; entities={}; run_normal_processing=True; data_to_update={}; structured_result=None; food_price=None
+    direct_reply=""; onboarding_model_spent=False # Onboarding: no máximo uma chamada ao modelo por etapa
+    conversation=None # Memória da conversa: só carregada com o onboarding completo
+    single_call = ENGINE_MODE == "single_call"
 
     logger.info(f"Estado: awaiting='{currently_awaiting}'")
 
@@ -129,204 +400,239 @@ def process_message(user_id, user_name_from_telegram, message_text):
     if message_text == "__INTERNAL_ONBOARDING_CHECK__":
         logger.info("Check interno onboarding."); run_normal_processing = False; intent = "INTERNAL_CHECK"
         profile_incomplete, missing = is_profile_incomplete(current_user_data)
-        if profile_incomplete: first=missing[0]; logger.info(f"Onboarding perfil: {first}");
-             try: user_doc_ref.update({'user_state.awaiting': first}); logger.info(f"State='{first}'"); prompt_final=get_onboarding_prompt(user_display_name, first)
-             except Exception as e: logger.error(f"Erro set await {first}: {e}"); prompt_final="Erro iniciar perfil."
-        elif diet_settings.get('daily_calorie_goal') is None: logger.info("Onboarding meta."); prompt_final=f"{BASE_PERSONA_PROMPT}\n\nTarefa: Perfil ok! Diga prox passo=meta.\n\nCaloBot:"
+        if profile_incomplete:
+            first=missing[0]; logger.info(f"Onboarding perfil: {first}")
+            try:
+                await _timed("firestore_set", firestore_manager.update_user_async(user_id, {'user_state.awaiting': first})); logger.info(f"State='{first}'")
+                if response_pool.covers(response_pool.QUESTION, first): direct_reply=response_pool.question(user_display_name, first)
+                else: prompt_final=get_onboarding_prompt(user_display_name, first)
+            except Exception as e: logger.error(f"Erro set await {first}: {e}"); prompt_final="Erro iniciar perfil."
+        elif diet_settings.get('daily_calorie_goal') is None: logger.info("Onboarding meta."); prompt_final=compose_prompt(TASK_TEMPLATES["GOAL_NEXT"])
         else: logger.info("Onboarding OK."); prompt_final = ""
-        if not prompt_final: return None
+        if not prompt_final and not direct_reply: return {"done": True, "reply": None}
 
     # --- LÓGICA 2: PROCESSAR RESPOSTA ESPERADA (ONBOARDING) ---
+    # Parser local da etapa (onboarding.STEPS) primeiro; a NLU só quando ele não entende. A próxima pergunta (ou o
+    # reprompt) sai do response_pool quando há variações prontas, ou em texto fixo se a NLU já gastou a chamada da etapa.
     elif currently_awaiting:
-        logger.info(f"Proc. resposta p/ awaiting='{currently_awaiting}'...")
-        run_normal_processing = False; is_valid = False; value_to_save = None; dict_to_update_key = None; field_to_save = currently_awaiting
-        input_value_from_nlu = None; nlu_result = get_nlu_understanding(message_text)
-        if nlu_result and nlu_result.get('intent') == 'PROVIDE_INFO' and 'info_value' in nlu_result['entities']:
-            input_value_from_nlu = nlu_result['entities']['info_value']; logger.info(f"NLU extraiu: '{input_value_from_nlu}'")
-            text_input_to_validate = str(input_value_from_nlu)
-        else: logger.warning(f"NLU não ajudou ({nlu_result.get('intent') if nlu_result else 'N/A'}). Usando texto."); text_input_to_validate = message_text.strip()
-        logger.debug(f"Validando '{text_input_to_validate}' p/ '{currently_awaiting}'")
-
-        # --- Bloco de Validação (Com try/except EXTREMAMENTE simplificados) ---
-        if currently_awaiting == 'birth_year':
-            year = None
-            year_str = text_input_to_validate
-            # Validação básica primeiro
-            if year_str.isdigit() and len(year_str) == 4:
-                try: # TRY só para int()
-                    year = int(year_str)
-                except ValueError: # EXCEPT só para int()
-                     logger.warning(f"Input inválido (erro conversão int): {text_input_to_validate}")
-            # Lógica FORA do try/except
-            if year is not None:
-                 current_year = datetime.datetime.now(datetime.timezone.utc).year;
-                 if 1900 < year <= current_year: value_to_save=year; is_valid=True; dict_to_update_key='profile'
-                 else: logger.warning(f"Input inválido (range): {year}")
-            else: logger.warning(f"Input inválido (não 4 dígitos ou erro conversão): {text_input_to_validate}")
-
-        elif currently_awaiting == 'gender':
-            text_lower=text_input_to_validate.lower();
-            if text_lower in ['masculino','m','male']: value_to_save='male'; is_valid=True; dict_to_update_key='profile'
-            elif text_lower in ['feminino','f','female']: value_to_save='female'; is_valid=True; dict_to_update_key='profile'
-
-        elif currently_awaiting == 'height_cm':
-             height = None
-             try: # TRY só para float()
-                  height_str = text_input_to_validate.lower().replace('cm','').replace(',','.').strip()
-                  height = float(height_str)
-             except ValueError: # EXCEPT só para float()
-                  logger.warning(f"Input inválido (não float): {text_input_to_validate}")
-             # Lógica FORA do try/except
-             if height is not None:
-                  if 100 <= height <= 250: value_to_save=int(height); is_valid=True; dict_to_update_key='profile'
-                  else: logger.warning(f"Input inválido (range): {height}")
-
-        elif currently_awaiting == 'current_weight_kg':
-            weight = None
-            try: # TRY só para float()
-                 weight_str = text_input_to_validate.lower().replace('kg','').replace(',','.').strip()
-                 weight = float(weight_str)
-            except ValueError: # EXCEPT só para float()
-                 logger.warning(f"Input inválido (não float): {text_input_to_validate}")
-            # Lógica FORA do try/except
-            if weight is not None:
-                 if 30 <= weight <= 300: value_to_save=weight; is_valid=True; dict_to_update_key='profile'
-                 else: logger.warning(f"Input inválido (range): {weight}")
-
-        elif currently_awaiting == 'activity_level':
-            text_lower=text_input_to_validate.lower(); map_act={'sedentário':'sedentary','leve':'light','moderado':'moderate','ativo':'active','muito ativo':'extra_active'}; valid_en=['sedentary','light','moderate','active','extra_active']; matched=None;
-            for k,v in map_act.items():
-                 if k in text_lower or k==text_lower: matched=v; break
-            if not matched and text_lower in valid_en: matched=text_lower
-            if matched: value_to_save=matched; is_valid=True; dict_to_update_key='profile'
-        elif currently_awaiting == 'goal':
-            text_lower=text_input_to_validate.lower(); map_goal={'perder':'lose','emagrecer':'lose','manter':'maintain','ganhar':'gain','massa':'gain'}; valid_en=['lose','maintain','gain']; matched=None;
-            for k,v in map_goal.items():
-                if k in text_lower or k==text_lower: matched=v; break
-            if not matched and text_lower in valid_en: matched=text_lower
-            if matched: value_to_save=matched; is_valid=True; dict_to_update_key='profile'
-        elif currently_awaiting == 'goal_confirmation': # Mantém lógica v30
-            custom_goal = None; is_confirmation = False; is_valid = False; value_to_save = None;
-            dict_to_update_key = None; field_to_save = 'daily_calorie_goal';
-            potential_goal_str = None; nlu_intent = None; potential_goal = None
-            if nlu_result: nlu_intent = nlu_result.get('intent')
-            parsed_value_source = None
-            if nlu_intent == 'PROVIDE_INFO' and 'info_value' in nlu_result['entities']: potential_goal_str = str(nlu_result['entities']['info_value']); parsed_value_source = "NLU"
-            else: cal_match = re.search(r'\d+', message_text);
-                  if cal_match: potential_goal_str = cal_match.group(0); parsed_value_source = "REGEX_FALLBACK"
-                  else: logger.warning("Nenhuma string numérica encontrada.")
-            if potential_goal_str:
-                try: cleaned_str = re.sub(r'[^\d]', '', potential_goal_str);
-                     if cleaned_str: potential_goal = int(cleaned_str); logger.info(f"String convertida: {potential_goal}")
-                     else: logger.warning(f"String vazia pós limpeza: '{potential_goal_str}'"); potential_goal = None
-                except (ValueError, TypeError): logger.warning(f"Erro converter '{potential_goal_str}'"); potential_goal = None
-            if potential_goal is not None:
-                if 1000 <= potential_goal <= 10000: custom_goal = potential_goal; is_valid = True; value_to_save = custom_goal; dict_to_update_key = 'diet_settings'; logger.info(f"Meta custom ({parsed_value_source}) válida: {value_to_save}")
-                else: logger.warning(f"Meta num ({parsed_value_source}) fora range: {potential_goal}"); custom_goal = potential_goal
-            if not is_valid:
-                text_lower_orig = message_text.strip().lower(); yes_words = ['sim', 's', 'ok', 'k', 'aceito', 'confirmado', 'confirmo', 'yes', 'y']
-                if (nlu_intent in ['AFFIRMATION', 'CONFIRMATION']) or (text_lower_orig in yes_words):
-                    is_confirmation = True; logger.info(f"Confirmação (NLU: {nlu_intent in ['AFFIRMATION', 'CONFIRMATION']}, Fallback: {text_lower_orig in yes_words})")
-                    age=firestore_manager.calculate_age(profile_data.get('birth_year')); bmr=firestore_manager.calculate_bmr_mifflin(profile_data.get('current_weight_kg'),profile_data.get('height_cm'), age, profile_data.get('gender')); tdee=firestore_manager.calculate_tdee(bmr, profile_data.get('activity_level')); suggested=firestore_manager.suggest_calorie_goal(tdee, profile_data.get('goal'))
-                    if suggested: value_to_save=suggested; is_valid=True; dict_to_update_key='diet_settings'; logger.info(f"Meta sugerida ({value_to_save}) aceita.")
-                    else: logger.error("Erro recalcular meta.")
-            if not is_valid:
-                 logger.warning(f"Input goal_conf inválido final: {message_text}");
-                 if custom_goal is not None and not (1000<=custom_goal<=10000): prompt_final=get_reprompt(user_display_name,currently_awaiting,f"{message_text}(Meta fora range)")
-                 else: prompt_final=get_reprompt(user_display_name,currently_awaiting,message_text)
-                 intent=f"REPROMPT_{currently_awaiting.upper()}"; run_normal_processing=False
-        # --- Fim da Validação ---
-
-        if is_valid: logger.info(f"Input '{currently_awaiting}' OK:{value_to_save}")
-        else: logger.warning(f"Input '{currently_awaiting}' Inválido(final):{text_input_to_validate}")
-
-        # --- Ação Pós-Validação ---
-        if is_valid and dict_to_update_key and field_to_save is not None and value_to_save is not None:
-            logger.info("Validação OK. Preparando save..."); data_payload = None
-            if dict_to_update_key == 'profile': profile_data[field_to_save]=value_to_save; data_payload=profile_data; logger.debug(f"Profile local:{profile_data}")
-            elif dict_to_update_key == 'diet_settings': diet_settings[field_to_save]=value_to_save; data_payload=diet_settings; logger.debug(f"Diet local:{diet_settings}")
-            else: logger.error(f"Chave inválida '{dict_to_update_key}'")
-            if data_payload: user_state['awaiting']=None; data_to_update={dict_to_update_key:data_payload,'user_state':user_state}; currently_awaiting=None; run_normal_processing=True; logger.info("Pronto p/ salvar e continuar.")
-            else: run_normal_processing=False; prompt_final="Erro preparar dados."; intent="ERROR_PREPARE_SAVE"
-        elif not prompt_final: logger.warning("Input inválido, gerando reprompt."); prompt_final = get_reprompt(user_display_name, currently_awaiting, message_text); intent=f"REPROMPT_{currently_awaiting.upper()}"; run_normal_processing = False
-
-    # --- LÓGICA 3: SALVAR DADOS ---
+        logger.info(f"Proc. resposta p/ awaiting='{currently_awaiting}'..."); run_normal_processing = False
+        value_to_save, problem = onboarding.parse_answer(currently_awaiting, message_text)
+        if value_to_save is None and not problem:
+            logger.info("Parser local não entendeu. Usando NLU..."); nlu_result = await _timed("nlu", get_nlu_understanding_async(message_text, use_model=False))
+            if not nlu_result and not single_call: nlu_result = await _timed("nlu", get_nlu_understanding_async(message_text)); onboarding_model_spent = True # Chamada única: validação direta no texto
+            nlu_intent = nlu_result.get('intent') if nlu_result else None
+            if nlu_intent == 'PROVIDE_INFO' and nlu_result['entities'].get('info_value') is not None: logger.info(f"NLU extraiu: '{nlu_result['entities']['info_value']}'"); value_to_save, problem = onboarding.parse_answer(currently_awaiting, str(nlu_result['entities']['info_value']))
+            elif currently_awaiting == 'goal_confirmation' and nlu_intent in ('AFFIRMATION', 'CONFIRMATION'): value_to_save = onboarding.ACCEPT
+            else: logger.warning(f"NLU não ajudou ({nlu_intent or 'N/A'}).")
+        goal_source = 'suggested' if value_to_save == onboarding.ACCEPT else 'custom' # goal_batch só recalcula metas sugeridas
+        if value_to_save == onboarding.ACCEPT: # Meta sugerida aceita
+            derived, memoized = firestore_manager.get_derived_metrics(profile_data, any_year=True); value_to_save = derived['suggested_goal'] # O número que o usuário viu
+            if value_to_save: logger.info(f"Meta sugerida ({value_to_save}) aceita{' (memorizada)' if memoized else ' (recalculada)'}.")
+            else: logger.error("Erro recalcular meta."); value_to_save = None
+        if value_to_save is not None:
+            dict_to_update_key, field_to_save = onboarding.STEPS[currently_awaiting]['target']; logger.info(f"Input '{currently_awaiting}' OK:{value_to_save}")
+            data_payload = profile_data if dict_to_update_key == 'profile' else diet_settings; data_payload[field_to_save] = value_to_save
+            if dict_to_update_key == 'profile': data_payload.pop('derived', None) # Entrada mudou: derivados caem junto
+            if currently_awaiting == 'goal_confirmation': diet_settings['goal_source'] = goal_source
+            user_state['awaiting']=None; data_to_update={dict_to_update_key:data_payload,'user_state':user_state}; currently_awaiting=None; run_normal_processing=True; logger.info("Pronto p/ salvar e continuar.")
+        else:
+            logger.warning(f"Input '{currently_awaiting}' Inválido(final):{message_text} ({problem or 'não entendido'})"); intent=f"REPROMPT_{currently_awaiting.upper()}"
+            if onboarding_model_spent or response_pool.covers(response_pool.reprompt_kind(problem), currently_awaiting): direct_reply = response_pool.reprompt(user_display_name, currently_awaiting, problem)
+            else: prompt_final = get_reprompt(user_display_name, currently_awaiting, f"{message_text}({problem})" if problem else message_text)
+
+    # --- LÓGICA 3: SALVAR DADOS (recarga sai do cache write-through, sem nova leitura) ---
     if data_to_update:
-        try: logger.info(f"Salvando:{data_to_update}"); user_doc_ref.update(data_to_update); logger.info("Salvo OK."); user_data=firestore_manager.get_or_create_user(user_id,None); current_user_data=user_data.copy(); profile_data=current_user_data.get('profile',{}).copy(); diet_settings=current_user_data.get('diet_settings',{}).copy(); daily_tracking=current_user_data.get('daily_tracking',{}).copy(); user_state=current_user_data.get('user_state',{'awaiting':None}).copy(); logger.info("Dados recarregados.")
+        try: logger.info(f"Salvando:{data_to_update}"); await _timed("save", firestore_manager.update_user_async(user_id, data_to_update)); logger.info("Salvo OK."); user_data=await _timed("reload", firestore_manager.get_or_create_user_async(user_id,None));  current_user_data=user_data.copy(); profile_data=current_user_data.get('profile',{}).copy(); diet_settings=current_user_data.get('diet_settings',{}).copy(); daily_tracking=current_user_data.get('daily_tracking',{}).copy(); user_state=current_user_data.get('user_state',{'awaiting':None}).copy(); logger.info("Dados recarregados.")
         except Exception as e: logger.error(f"ERRO SAVE:{e}", exc_info=True); prompt_final="Problema ao salvar."; run_normal_processing=False; intent="ERROR_FIRESTORE_SAVE"
 
     # --- LÓGICA 4: PROCESSAMENTO NORMAL (via NLU) ---
-    if run_normal_processing and not prompt_final:
+    if run_normal_processing and not prompt_final and not direct_reply:
         logger.info("Bloco proc. normal/pós-onboarding.")
         profile_incomplete, missing = is_profile_incomplete(current_user_data)
         if profile_incomplete: # Onboarding Perfil
             first=missing[0]; logger.info(f"Onboarding perfil:{first}."); intent=f"ONBOARDING_{first.upper()}"
-            try: user_doc_ref.update({'user_state.awaiting':first}); logger.info(f"State='{first}'"); prompt_final=get_onboarding_prompt(user_display_name,first)
+            try:
+                await _timed("firestore_set", firestore_manager.update_user_async(user_id, {'user_state.awaiting':first})); logger.info(f"State='{first}'")
+                if onboarding_model_spent or response_pool.covers(response_pool.QUESTION, first): direct_reply=response_pool.question(user_display_name,first)
+                else: prompt_final=get_onboarding_prompt(user_display_name,first)
             except Exception as e: logger.error(f"Erro set await {first}:{e}"); prompt_final="Erro config perfil."; intent="ERROR_SET_AWAITING"
         elif diet_settings.get('daily_calorie_goal') is None: # Onboarding Meta
             logger.info("Onboarding meta."); intent="ONBOARDING_GOAL_SUGGESTION"
-            age=firestore_manager.calculate_age(profile_data.get('birth_year')); bmr=firestore_manager.calculate_bmr_mifflin(profile_data.get('current_weight_kg'), profile_data.get('height_cm'), age, profile_data.get('gender')); tdee=firestore_manager.calculate_tdee(bmr, profile_data.get('activity_level')); suggested=firestore_manager.suggest_calorie_goal(tdee, profile_data.get('goal'))
-            if suggested: logger.info(f"Meta sugerida:{suggested}");
-                 try: user_doc_ref.update({'user_state.awaiting':'goal_confirmation'}); logger.info("State='goal_confirmation'")
-                      prompt_tarefa=(f"Tarefa:Perfil ok! TDEE={tdee}, obj='{profile_data.get('goal')}'. Sugiro meta {suggested} kcal. Apresente, pergunte 'sim' ou número."); prompt_final=f"{BASE_PERSONA_PROMPT}\n\n{prompt_tarefa}\n\nCaloBot:"
-                 except Exception as e: logger.error(f"Erro set await goal_conf:{e}", exc_info=True); prompt_final="Erro prep pergunta meta."; intent="ERROR_SET_AWAITING_GOAL"
-            else: logger.error("Erro calc meta."); prompt_tarefa="Erro cálculo meta."; prompt_final=f"{BASE_PERSONA_PROMPT}\n\n{prompt_tarefa}\n\nCaloBot:"; intent="ERROR_CALC_SUGGESTION"
+            derived, memoized = firestore_manager.get_derived_metrics(profile_data); tdee=derived['tdee']; suggested=derived['suggested_goal']
+            if suggested:
+                logger.info(f"Meta sugerida:{suggested}{' (memorizada)' if memoized else ''}"); state_update={'user_state.awaiting':'goal_confirmation'}
+                if not memoized: state_update['profile.derived']=derived # Mesma escrita do estado; a confirmação reaproveita
+                try:
+                    await _timed("firestore_set", firestore_manager.update_user_async(user_id, state_update)); logger.info("State='goal_confirmation'")
+                    if onboarding_model_spent or response_pool.covers(response_pool.GOAL_SUGGESTION, 'goal'): direct_reply=response_pool.goal_suggestion(user_display_name, tdee, profile_data.get('goal'), suggested)
+                    else: prompt_final=compose_prompt(TASK_TEMPLATES["GOAL_SUGGESTION"].format(tdee=tdee, goal=profile_data.get('goal'), suggested=suggested))
+                except Exception as e: logger.error(f"Erro set await goal_conf:{e}", exc_info=True); prompt_final="Erro prep pergunta meta."; intent="ERROR_SET_AWAITING_GOAL"
+            else: logger.error("Erro calc meta."); prompt_final=compose_prompt(TASK_TEMPLATES["GOAL_ERROR"]); intent="ERROR_CALC_SUGGESTION"
         else: # Onboarding Completo -> NLU
-            logger.info("Onboarding OK. Usando NLU..."); nlu_result = get_nlu_understanding(message_text)
+            calorie_goal=diet_settings.get('daily_calorie_goal'); cal_today=daily_tracking.get('calories_consumed',0); cal_rem=calorie_goal-cal_today if calorie_goal else None; status=f"Meta:{calorie_goal} Cons:{cal_today}"
+            if cal_rem is not None: status += f" Restam:{cal_rem}"
+            history=daily_history.format_context(current_user_data.get('rolling_stats'), daily_tracking.get('date')) # Agregados gravados na troca de dia, sem ler histórico
+            if history and single_call: status += f" {history}" # Intent ainda desconhecida: vai junto
+            if conversation_memory.MEMORY_ENABLED:
+                conversation = conversation_memory.from_user(current_user_data); memory_text = conversation_memory.render(conversation)
+                if memory_text: status += f" Conversa:{memory_text}" # Tamanho limitado por MEMORY_TOKEN_BUDGET
+            logger.debug(f"Contexto:{status}")
+            logger.info("Onboarding OK. Usando NLU..."); nlu_result = await _timed("nlu", get_nlu_understanding_async(message_text, use_model=not single_call))
+            if not nlu_result and single_call:
+                logger.info("Modo chamada única: NLU+resposta numa só chamada."); structured_result = await _timed("single_call", get_single_call_response_async(get_single_call_prompt(user_display_name, status, profile_data, message_text), message_text), check=True)
+                if structured_result: nlu_result = {"intent": structured_result['intent'], "entities": structured_result['entities']}
+                else: logger.warning("Chamada única falhou. Voltando ao modo de duas chamadas."); nlu_result = await _timed("nlu", get_nlu_understanding_async(message_text))
             if nlu_result:
                 intent = nlu_result.get('intent', 'UNCLEAR'); entities = nlu_result.get('entities', {}); logger.info(f"NLU->Intent:{intent}, Entities:{entities}")
-                calorie_goal=diet_settings.get('daily_calorie_goal'); cal_today=daily_tracking.get('calories_consumed',0); cal_rem=calorie_goal-cal_today if calorie_goal else None; status=f"Meta:{calorie_goal} Cons:{cal_today}";
-                if cal_rem is not None: status += f" Restam:{cal_rem}"; logger.debug(f"Contexto:{status}")
-                prompt_persona = f"{BASE_PERSONA_PROMPT}\n\nContexto User '{user_display_name}': {status}."
                 # Roteamento NLU
-                if intent=="LOG_FOOD": log_desc=entities.get('food_items',[message_text]); log_qty=entities.get('quantity'); log_meal=entities.get('meal_time'); log_ctx=f"Alim:{','.join(log_desc)}"; if log_qty:log_ctx+=f",Qtd:{log_qty}"; if log_meal:log_ctx+=f",Ref:{log_meal}"; task=(f"Tarefa:User registrou:'{message_text}'(Extr:{log_ctx}). 1.Estime kcal('Estimativa CaloBot: XXX kcal.'). 2.Comente. 3.Mencione status({status},+estimativa).")
-                elif intent=="ASK_SUGGESTION": pref=entities.get('preference'); constr=entities.get('dietary_constraint'); sug_ctx=f"Restam {cal_rem if cal_rem is not None else 'Muitas'} kcal."; if pref:sug_ctx+=f" Pref:{pref}."; if constr:sug_ctx+=f" Restr:{','.join(constr)}."; task=(f"Tarefa:User pede sugestão:'{message_text}'. Contexto:{sug_ctx}. Sugira 2-3 opções c/ kcal.")
-                elif intent=="GET_STATUS": task=(f"Tarefa:User perguntou status('{message_text}'). Responda c/ contexto:{status}.")
-                elif intent=="GET_PROFILE": field=entities.get('profile_field','geral'); task=(f"Tarefa:User pediu perfil('{message_text}',campo:{field}). Apresente:{profile_data}. Foco no campo se esp.")
-                elif intent=="UPDATE_PROFILE": logger.warning(f"Intent UPDATE_PROFILE não impl. Ents:{entities}"); task=f"Tarefa:User tentou atualizar perfil('{message_text}'). Informe não impl."
-                elif intent in ["GREETING", "FAREWELL", "AFFIRMATION", "NEGATION", "HELP", "CHITCHAT"]: task=(f"Tarefa:User enviou '{intent}':'{message_text}'. Responda apropriadamente.")
-                elif intent=="OUT_OF_SCOPE": task=(f"Tarefa:User fora do escopo('{message_text}'). Diga foco nutrição/saúde.")
-                else: logger.warning(f"Intent não tratada/incerta:'{intent}'."); task=(f"Tarefa:User:'{message_text}'. Intenção incerta. Responda conversacionalmente.")
-                prompt_final = f"{prompt_persona}\n\n{task}\n\nCaloBot:"
-            else: logger.error("Falha NLU."); prompt_final=f"{BASE_PERSONA_PROMPT}\n\nTarefa:Erro entender:'{message_text}'.Peça desculpas/reformulaçao.\n\nCaloBot:"; intent="ERROR_NLU"
-
-    # --- LÓGICA 5: CHAMAR GEMINI PARA RESPOSTA FINAL ---
-    resposta_texto = "Eita! Cérebro engasgou 🧠💥 Tenta de novo?"; estimated_calories = None; update_success = False
-    if prompt_final:
+                if structured_result: task = "" # Resposta já veio na chamada única
+                else:
+                    if intent=="LOG_FOOD" and (FOOD_DB_ENABLED or kcal_cache) and entities.get('food_items'):
+                        log_desc=entities['food_items']; log_qty=entities.get('quantity')
+                        try:
+                            food_price = food_db.price_items(log_desc, log_qty) if FOOD_DB_ENABLED else {"items": [], "unknown": list(log_desc) if isinstance(log_desc, list) else [log_desc], "total_kcal": 0}
+                            if kcal_cache and food_price['unknown']: kcal_cache.resolve(food_price, log_qty) # Antes de pedir número ao Gemini
+                            logger.info(f"Tabela local/cache: {len(food_price['items'])} itens conhecidos, desconhecidos:{food_price['unknown']}")
+                        except Exception as e: logger.error(f"Erro tabela alimentos:{e}", exc_info=True); food_price = None
+                    if intent=="UPDATE_PROFILE": logger.warning(f"Intent UPDATE_PROFILE não impl. Ents:{entities}")
+                    elif intent not in TASK_TEMPLATES and intent not in SOCIAL_INTENTS: logger.warning(f"Intent não tratada/incerta:'{intent}'.")
+                    task = get_intent_task(intent, message_text, entities, cal_rem, profile_data, food_price)
+                if intent=="GET_STATUS" and history and not single_call: status += f" {history}"
+                if task: prompt_final = compose_prompt(task, TASK_TEMPLATES["CONTEXT"].format(name=user_display_name, status=status))
+            else: logger.error("Falha NLU."); prompt_final=compose_prompt(TASK_TEMPLATES["NLU_ERROR"].format(message=message_text)); intent="ERROR_NLU"
+
+    metrics.tag_message(intent=intent)
+    if direct_reply: logger.info(f"Resposta fixa do onboarding (Intent:{intent}), sem geração."); return {"done": True, "reply": direct_reply}
+    if not prompt_final and not structured_result: logger.info("Nenhum prompt final gerado."); return {"done": True, "reply": None}
+    return {"done": False, "user_id": user_id, "message_text": message_text, "intent": intent, "entities": entities, "prompt_final": prompt_final, "structured_result": structured_result, "food_price": food_price, "conversation": conversation}
+
+# Etapa 2 (sem streaming): LÓGICA 5 - chamar o Gemini para a resposta final. Retorna (texto, ok).
+async def _generate_reply(turn):
+    intent=turn['intent']; prompt_final=turn['prompt_final']; structured_result=turn['structured_result']
+    resposta_texto = "Eita! Cérebro engasgou 🧠💥 Tenta de novo?"; resposta_ok = False
+    if structured_result: # Modo chamada única: a resposta já veio junto com a NLU
+        resposta_texto = structured_result['reply']; resposta_ok = True; logger.info(f"Resposta da chamada única reutilizada(Intent:{intent}).")
+    elif prompt_final:
         logger.info(f"Enviando prompt final(Intent:{intent})..."); logger.debug(f"Prompt Final Completo:\n{prompt_final}")
         try:
             if not model or not generation_config or not safety_settings: logger.critical("Deps off p/ chamada final."); raise Exception("Modelo/Config não ok.")
-            response = model.generate_content(prompt_final, generation_config=generation_config, safety_settings=safety_settings); logger.info("Resp final recebida.")
+            response = await _timed("generate", rate_limiter.model_limiter.call(reply_model.generate_content_async, prompt_final, generation_config=generation_config, safety_settings=safety_settings, priority=rate_limiter.priority_for_intent(intent))); logger.info("Resp final recebida.")
             if response.candidates:
                 candidate = response.candidates[0]
                 if candidate.content and candidate.content.parts:
-                    try: resposta_texto = candidate.content.parts[0].text.strip(); logger.info("Texto resposta OK.")
-                         if intent == "LOG_FOOD": logger.info("Extraindo kcal p/ LOG_FOOD...")
-                              estimated_calories = extract_calories(resposta_texto)
-                              if estimated_calories and estimated_calories>0: logger.info(f"Kcal:{estimated_calories}. Salvando..."); update_success = firestore_manager.update_daily_calories(user_id, estimated_calories, message_text);
-                                   if update_success: logger.info("DB update OK.")
-                                   else: logger.error("Falha update DB LOG."); resposta_texto += "\n\n(Erro salvar 😟)"
-                              else: logger.warning("Não extraiu kcal LOG."); resposta_texto += "\n\n(Não estimei kcal 🤔)"
+                    try: resposta_texto = candidate.content.parts[0].text.strip(); resposta_ok = True; logger.info("Texto resposta OK.")
                     except Exception as e: logger.error(f"Erro proc resp final:{e}",exc_info=True); resposta_texto="Erro proc resp."
-                else: reason=getattr(candidate,'finish_reason','?'); safety=getattr(candidate,'safety_ratings','?'); logger.warning(f"Resp final vazia/bloq. Razão:{reason},Safety:{safety}"); resposta_texto=f"Não processei(Motivo:{reason})."; if reason=="SAFETY": logger.warning("BLOQUEIO SEG.")
+                else:
+                    reason=getattr(candidate,'finish_reason','?'); safety=getattr(candidate,'safety_ratings','?'); logger.warning(f"Resp final vazia/bloq. Razão:{reason},Safety:{safety}"); resposta_texto=f"Não processei(Motivo:{reason})."
+                    if reason=="SAFETY": logger.warning("BLOQUEIO SEG.")
             else: logger.error("Resp final sem candidates."); resposta_texto="Resp vazia inesperada."
         except Exception as e: logger.error(f"ERRO GERAL chamada final:{e}",exc_info=True); resposta_texto="Erro comunicação."
-    else: logger.info("Nenhum prompt final gerado."); return None
+    return resposta_texto, resposta_ok
+
+# Etapa 3: pós-processamento (kcal de LOG_FOOD e gravação). Pode acrescentar avisos ao fim do texto.
+async def _finalize_turn(turn, resposta_texto, resposta_ok):
+    user_id=turn['user_id']; message_text=turn['message_text']; intent=turn['intent']; entities=turn['entities']; structured_result=turn['structured_result']; food_price=turn['food_price']
+    estimated_calories = None; update_success = False
+    if resposta_ok and intent == "LOG_FOOD":
+        try:
+            logger.info("Extraindo kcal p/ LOG_FOOD...")
+            if food_price and food_price['items'] and not food_price['unknown']: estimated_calories = round(food_price['total_kcal']); logger.info("Kcal da tabela local/cache (sem extração).")
+            else: estimated_calories = extract_calories(resposta_texto, structured_result)
+            # Um único item estimado pelo Gemini alimenta o cache compartilhado
+            model_items = food_price['unknown'] if food_price else (entities.get('food_items') if structured_result else None)
+            if kcal_cache and estimated_calories and isinstance(model_items, list) and len(model_items) == 1:
+                kcal_cache.observe(model_items[0], entities.get('quantity') if not food_price or not food_price['items'] else None, estimated_calories)
+            if food_price and food_price['items'] and food_price['unknown']: # Gemini estimou só os desconhecidos: soma com a tabela
+                if not estimated_calories: logger.warning("Sem estimativa dos desconhecidos; registrando só a parte da tabela.")
+                estimated_calories = round(food_price['total_kcal'] + (estimated_calories or 0)); resposta_texto += f"\n\n(Total registrado: {estimated_calories} kcal)"
+            if estimated_calories and estimated_calories>0:
+                logger.info(f"Kcal:{estimated_calories}. Salvando..."); update_success = await _timed("log_food_save", firestore_manager.update_daily_calories_async(user_id, estimated_calories, message_text), check=True)
+                if update_success: logger.info("DB update OK.")
+                else: logger.error("Falha update DB LOG."); resposta_texto += "\n\n(Erro salvar 😟)"
+            else: logger.warning("Não extraiu kcal LOG."); resposta_texto += "\n\n(Não estimei kcal 🤔)"
+        except Exception as e: logger.error(f"Erro proc LOG_FOOD:{e}",exc_info=True); resposta_texto += "\n\n(Erro salvar 😟)"
 
     if intent == "LOG_FOOD": logger.info(f"LOG_FOOD:UpdOK?{update_success},Kcal?{estimated_calories}")
+    if resposta_ok and turn.get('conversation') is not None: conversation_memory.remember(user_id, turn['conversation'], message_text, intent, resposta_texto, estimated_calories if update_success else None)
     logger.info(f"--- FIM user:{user_id}(Intent:{intent}).Resp:'{resposta_texto[:100]}...' ---")
     return resposta_texto
 
+async def process_message_async(user_id, user_name_from_telegram, message_text):
+    """Processa a mensagem e retorna o texto completo da resposta (ou None se não houver resposta)."""
+    with rate_limiter.message_scope(), metrics.message_trace(): # Prazo para todas as chamadas ao modelo desta mensagem
+        turn = await _prepare_turn(user_id, user_name_from_telegram, message_text)
+        if turn['done']: metrics.tag_message(outcome="early" if turn['reply'] else "no_reply"); return turn['reply']
+        resposta_texto, resposta_ok = await _generate_reply(turn)
+        if not resposta_ok: metrics.tag_message(outcome="model_error")
+        return await _finalize_turn(turn, resposta_texto, resposta_ok)
+
+def _chunk_text(chunk):
+    """Texto de um pedaço do stream do Gemini ('' se vazio/bloqueado)."""
+    try:
+        candidate = chunk.candidates[0] if chunk.candidates else None
+        if not candidate or not candidate.content or not candidate.content.parts: return ""
+        return candidate.content.parts[0].text or ""
+    except Exception as e: logger.warning(f"Pedaço do stream ilegível:{e}"); return ""
+
+async def process_message_stream(user_id, user_name_from_telegram, message_text):
+    """Como process_message_async, mas produz a resposta em pedaços à medida que o Gemini gera.
+
+    O pós-processamento (kcal, gravação) roda quando o stream termina; o que ele acrescentar ao texto
+    sai como último pedaço. Respostas já decididas (erros, chamada única) saem num pedaço só.
+    Prazo e prioridade das chamadas ao modelo vêm do chamador (rate_limiter.message_scope).
+    """
+    with metrics.message_trace():
+        turn = await _prepare_turn(user_id, user_name_from_telegram, message_text)
+        if turn['done']:
+            metrics.tag_message(outcome="early" if turn['reply'] else "no_reply")
+            if turn['reply']: yield turn['reply']
+            return
+        if turn['structured_result']:
+            resposta_texto, resposta_ok = await _generate_reply(turn); yield resposta_texto
+        else:
+            logger.info(f"Enviando prompt final em streaming(Intent:{turn['intent']})..."); logger.debug(f"Prompt Final Completo:\n{turn['prompt_final']}")
+            parts = []; resposta_ok = False; timed_out = False
+            with metrics.span("generate_stream") as sp:
+                try:
+                    if not model or not generation_config or not safety_settings: logger.critical("Deps off p/ chamada final."); raise Exception("Modelo/Config não ok.")
+                    stream = await rate_limiter.model_limiter.call(reply_model.generate_content_async, turn['prompt_final'], generation_config=generation_config, safety_settings=safety_settings, stream=True, priority=rate_limiter.priority_for_intent(turn['intent']))
+                    # Cada pedaço espera no máximo até o prazo da mensagem: stream parado não segura a vaga do executor nem a fila do usuário.
+                    # Só o __anext__ fica dentro do timeout (um yield lá dentro cancelaria o consumidor)
+                    remaining = rate_limiter.remaining_seconds(); deadline = None if remaining is None else asyncio.get_running_loop().time() + remaining; chunks = stream.__aiter__()
+                    while True:
+                        try:
+                            async with asyncio.timeout_at(deadline): chunk = await chunks.__anext__()
+                        except StopAsyncIteration: break
+                        text = _chunk_text(chunk)
+                        if not parts: text = text.lstrip() # Igual ao strip() da resposta completa
+                        if text: parts.append(text); yield text
+                    resposta_ok = bool(parts); logger.info(f"Stream final concluído({len(parts)} pedaços).")
+                except TimeoutError:
+                    timed_out = True; rate_limiter.model_limiter.deadline_exceeded += 1; logger.warning(f"Stream final parado além do prazo da mensagem({len(parts)} pedaços); encerrando.")
+                    try: await chunks.aclose()
+                    except Exception: pass
+                except Exception as e: logger.error(f"ERRO GERAL stream final:{e}",exc_info=True)
+                if not resposta_ok: sp.fail(); metrics.tag_message(outcome="model_timeout" if timed_out else "model_error")
+            resposta_texto = "".join(parts)
+            if not resposta_ok:
+                aviso = "\n\n(Resposta interrompida 😟)" if parts else (STREAM_TIMEOUT_REPLY if timed_out else "Erro comunicação."); resposta_texto += aviso; yield aviso
+        final_texto = await _finalize_turn(turn, resposta_texto, resposta_ok)
+        if final_texto and final_texto.startswith(resposta_texto) and len(final_texto) > len(resposta_texto): yield final_texto[len(resposta_texto):]
+
+def process_message(user_id, user_name_from_telegram, message_text):
+    """Wrapper síncrono de process_message_async (mesma assinatura e retorno da API original)."""
+    return _run_sync(process_message_async(user_id, user_name_from_telegram, message_text))
+
 # --- Bloco de Teste (v33 - Usa código corrigido) ---
 if __name__ == "__main__":
-    if db and model and generation_config and safety_settings:
+    if warmup() and generation_config and safety_settings:
         print("\n--- INICIANDO TESTE DE INTEGRAÇÃO CALOBOT_CORE (v33 - NLU + Simplificação Extrema try/except) ---")
         test_user_id_nlu = 999999902; test_user_name_nlu = "Tester NLU V33"
         print(f"\n\n----- PREP: Resetando {test_user_id_nlu} -----"); user_doc_ref_reset = db.collection('users').document(str(test_user_id_nlu))
         try: user_doc_ref_reset.delete(); print(f"Doc {test_user_id_nlu} deletado.")
         except: print(f"Doc {test_user_id_nlu} não existia/erro delete.")
         print(f"\n----- PREP: Config user pré-onboarded -----")
-        try: initial_data={'telegram_user_id':test_user_id_nlu, 'user_name':test_user_name_nlu, 'created_at':firestore.SERVER_TIMESTAMP,'last_interaction_at':firestore.SERVER_TIMESTAMP,'profile':{'birth_year':1990,'gender':'male','height_cm':180,'current_weight_kg':80,'activity_level':'light','goal':'maintain'},'diet_settings':{'daily_calorie_goal':2000,'diet_type':'standard'},'daily_tracking':{'date':datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d'),'calories_consumed':0,'log_today':[]},'user_state':{'awaiting':None}}; user_doc_ref_reset.set(initial_data); print(f"User {test_user_id_nlu} config OK.")
+        try: initial_data={'telegram_user_id':test_user_id_nlu, 'user_name':test_user_name_nlu, 'created_at':firestore.SERVER_TIMESTAMP,'last_interaction_at':firestore.SERVER_TIMESTAMP,'profile':{'birth_year':1990,'gender':'male','height_cm':180,'current_weight_kg':80,'activity_level':'light','goal':'maintain'},'diet_settings':{'daily_calorie_goal':2000,'diet_type':'standard'},'daily_tracking':{'date':datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d'),'calories_consumed':0},'user_state':{'awaiting':None}}; user_doc_ref_reset.set(initial_data); print(f"User {test_user_id_nlu} config OK.")
         except Exception as e: print(f"ERRO config user: {e}"); exit()
         conversa_nlu = [ ("Oi CaloBot", "GREETING"), ("Comi um pão na chapa e café com leite no café da manhã", "LOG_FOOD"), ("Qual meu status de calorias hoje?", "GET_STATUS"), ("Sugere algo leve pro almoço, sem carne vermelha", "ASK_SUGGESTION"), ("Valeu!", "AFFIRMATION/FAREWELL?"), ("Qual minha altura mesmo?", "GET_PROFILE"), ("quem descobriu o brasil?", "OUT_OF_SCOPE"), ]
         print("\n--- Iniciando seq teste NLU ---")
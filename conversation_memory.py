@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: conversation_memory.py (v1 - Memória curta por usuário: últimos turnos + resumo rolante)
+#
+# Guardada no campo conversation do usuário: {"turns": [{u, i, b, k}, ...], "summary": [fragmentos]}.
+# "turns" é um buffer circular com os MEMORY_MAX_TURNS turnos mais recentes (texto cortado); o turno
+# que sai dele vira um fragmento curto do resumo (sem chamar o modelo: intent + texto do usuário +
+# kcal), e o resumo descarta os fragmentos mais antigos quando passa de MEMORY_SUMMARY_TOKENS.
+# render() monta a linha do prompt dentro de MEMORY_TOKEN_BUDGET, então o custo por chamada não
+# cresce com o tempo de conversa. A gravação vai pelo write-behind (firestore_manager.save_deferred).
+
+import logging
+import os
+
+import firestore_manager
+
+logger = logging.getLogger(__name__)
+
+# --- Configurações ---
+MEMORY_ENABLED = os.environ.get("MEMORY_ENABLED", "1") == "1"
+MEMORY_MAX_TURNS = int(os.environ.get("MEMORY_MAX_TURNS", "4"))
+MEMORY_TOKEN_BUDGET = int(os.environ.get("MEMORY_TOKEN_BUDGET", "240"))  # Linha inteira no prompt
+MEMORY_SUMMARY_TOKENS = int(os.environ.get("MEMORY_SUMMARY_TOKENS", "80"))
+MEMORY_TURN_CHARS = int(os.environ.get("MEMORY_TURN_CHARS", "160"))  # Corte de cada texto guardado
+CHARS_PER_TOKEN = 4  # Estimativa para pt-br; o orçamento não precisa ser exato
+
+# Turnos sem conteúdo para lembrar: saem do buffer sem deixar fragmento
+SKIP_SUMMARY_INTENTS = {"GREETING", "FAREWELL", "AFFIRMATION", "NEGATION", "HELP", "CHITCHAT", "OUT_OF_SCOPE", "UNCLEAR"}
+_SUMMARY_LABELS = {
+    "LOG_FOOD": "registrou",
+    "ASK_SUGGESTION": "pediu sugestão",
+    "GET_STATUS": "viu status",
+    "GET_PROFILE": "viu perfil",
+    "UPDATE_PROFILE": "quis mudar perfil",
+    "PROVIDE_INFO": "disse",
+}
+
+
+def approx_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def _clip(text, limit):
+    text = " ".join(str(text or "").split())
+    return text if len(text) <= limit else text[: limit - 1].rstrip() + "…"
+
+
+def empty():
+    return {"turns": [], "summary": []}
+
+
+def from_user(user_data):
+    """Memória do documento do usuário (tolerante a ausência/formato antigo)."""
+    memory = (user_data or {}).get("conversation")
+    if not isinstance(memory, dict):
+        return empty()
+    return {"turns": list(memory.get("turns") or []), "summary": list(memory.get("summary") or [])}
+
+
+def _fold(turn):
+    """Turno que saiu do buffer -> fragmento do resumo (None se não há o que lembrar)."""
+    intent = turn.get("i") or "UNCLEAR"
+    if intent in SKIP_SUMMARY_INTENTS:
+        return None
+    fragment = f"{_SUMMARY_LABELS.get(intent, intent.lower())} '{_clip(turn.get('u'), 60)}'"
+    if turn.get("k"):
+        fragment += f"({turn['k']}kcal)"
+    return fragment
+
+
+def add_turn(memory, user_text, intent, reply, kcal=None):
+    """Nova memória com o turno no fim do buffer; o que transbordar é dobrado no resumo."""
+    turns = memory["turns"] + [{"u": _clip(user_text, MEMORY_TURN_CHARS), "i": intent, "b": _clip(reply, MEMORY_TURN_CHARS), "k": kcal}]
+    summary = list(memory["summary"])
+    while len(turns) > MEMORY_MAX_TURNS:
+        fragment = _fold(turns.pop(0))
+        if fragment:
+            summary.append(fragment)
+    while summary and approx_tokens("; ".join(summary)) > MEMORY_SUMMARY_TOKENS:
+        summary.pop(0)  # Resumo rolante: o mais antigo sai primeiro
+    return {"turns": turns, "summary": summary}
+
+
+def render(memory, budget=MEMORY_TOKEN_BUDGET):
+    """Linha compacta para o contexto do prompt, sempre dentro do orçamento ('' se vazia).
+
+    Os turnos mais antigos são cortados primeiro; o resumo só sai se nem ele couber sozinho.
+    """
+    if not memory or not (memory["turns"] or memory["summary"]):
+        return ""
+    summary = f"Antes:{'; '.join(memory['summary'])}." if memory["summary"] else ""
+    turns = [f"U:'{t.get('u', '')}' B:'{t.get('b', '')}'" for t in memory["turns"]]
+    while True:
+        text = " ".join(part for part in [summary, f"Recentes:{' | '.join(turns)}" if turns else ""] if part)
+        if approx_tokens(text) <= budget or not (turns or summary):
+            return text
+        if turns:
+            turns.pop(0)
+        else:
+            summary = ""
+
+
+def remember(user_id, memory, user_text, intent, reply, kcal=None):
+    """Acrescenta o turno e agenda a gravação (write-behind). Retorna a memória nova."""
+    memory = add_turn(memory, user_text, intent, reply, kcal)
+    try:
+        firestore_manager.save_deferred(user_id, {"conversation": memory})
+    except Exception as e:  # Memória é acessório: nunca derruba a resposta
+        logger.warning(f"[Memória] Falha ao agendar gravação para {user_id}: {e}")
+    return memory
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: core_executor.py (v4 - Prioridade pela NLU local também sem cache do usuário)
+
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import random
+import time
+from collections import deque
+
+import firestore_manager
+import nlu_local
+import onboarding
+from rate_limiter import LOW_VALUE_INTENTS, PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL, remaining_seconds
+
+logger = logging.getLogger(__name__)
+
+# --- Configurações ---
+CORE_MAX_CONCURRENCY = int(os.environ.get("CORE_MAX_CONCURRENCY", "32"))  # Chamadas ao core em paralelo
+CORE_MAX_QUEUE = int(os.environ.get("CORE_MAX_QUEUE", "200"))  # Espera máxima; além disso, rejeita
+# Com a fila acima disso, intents de baixo valor recebem resposta pronta (0 = assim que lotar)
+CORE_SHED_QUEUE_DEPTH = int(os.environ.get("CORE_SHED_QUEUE_DEPTH", "0"))
+CORE_MAX_WAIT_SECONDS = float(os.environ.get("CORE_MAX_WAIT_SECONDS", "10"))
+# O prazo da mensagem (rate_limiter.message_scope) já corre durante a fila: só admite quem ainda
+# tem pelo menos isto de prazo para as chamadas ao modelo; senão responde BUSY_REPLY na hora
+CORE_MIN_BUDGET_SECONDS = float(os.environ.get("CORE_MIN_BUDGET_SECONDS", "8"))
+WAIT_SAMPLES = 1000  # Janela de tempos de espera para as métricas
+
+# Prioridades: PRIORITY_HIGH (onboarding, LOG_FOOD) nunca é descartada por baixo valor;
+# PRIORITY_LOW (LOW_VALUE_INTENTS) recebe resposta pronta quando o core está saturado
+LOW_VALUE_MIN_CONFIDENCE = 0.85
+
+CANNED_REPLIES = {
+    "GREETING": ["Oi! 👋 Estou com muita gente agora, mas pode me contar o que comeu que eu registro!"],
+    "FAREWELL": ["Até mais! 👋 Qualquer coisa é só chamar."],
+    "AFFIRMATION": ["Combinado! 👍", "Fechado! 😉"],
+    "NEGATION": ["Tudo bem! 😊 Se precisar, estou aqui."],
+    "CHITCHAT": ["Adoraria conversar, mas estou bem ocupado agora! 😅 Me conte o que comeu ou peça uma sugestão."],
+    "OUT_OF_SCOPE": ["Sou focado em nutrição e saúde! 🥗 Me conte o que comeu ou peça uma sugestão."],
+}
+BUSY_REPLY = "Estou recebendo muitas mensagens agora! 😵 Tenta de novo em alguns segundos?"
+
+
+class CoreOverloaded(Exception):
+    """Pedido não admitido; 'reply' é a resposta pronta a enviar no lugar da do core."""
+
+    def __init__(self, reply, reason):
+        super().__init__(reason)
+        self.reply = reply
+        self.reason = reason
+
+
+def _may_answer_onboarding(message_text):
+    """True se o texto seria aceito (ou recusado por faixa) por alguma etapa do onboarding."""
+    return any(onboarding.parse_answer(field, message_text) != (None, None) for field in onboarding.STEPS)
+
+
+def classify_priority(user_id, message_text):
+    """Prioridade do pedido sem I/O: estado em cache do usuário + NLU local. Retorna (prioridade, intent).
+
+    Sem cache (usuário novo, expirado ou webhook sem roteamento por usuário) o estado do onboarding
+    é desconhecido: a NLU local decide, mas texto que pode ser resposta de etapa ("sim", "1990")
+    nunca é tratado como baixo valor.
+    """
+    cached = firestore_manager.user_cache.get(str(user_id))
+    if cached is not None and (cached.get("user_state") or {}).get("awaiting"):
+        return PRIORITY_HIGH, None  # Resposta esperada é onboarding
+    result = nlu_local.classify(message_text)
+    if not result:
+        return PRIORITY_NORMAL, None
+    if result["intent"] == "LOG_FOOD":
+        return PRIORITY_HIGH, "LOG_FOOD"
+    if result["intent"] in LOW_VALUE_INTENTS and result["confidence"] >= LOW_VALUE_MIN_CONFIDENCE:
+        if cached is None and _may_answer_onboarding(message_text):
+            return PRIORITY_HIGH, None
+        return PRIORITY_LOW, result["intent"]
+    return PRIORITY_NORMAL, result["intent"]
+
+
+class CoreExecutor:
+    """Limita as chamadas simultâneas ao core, com fila de espera limitada e por prioridade.
+
+    Saturado (todas as vagas ocupadas e fila acima de shed_queue_depth), pedidos de baixo valor
+    são respondidos na hora com CANNED_REPLIES; com a fila cheia, os demais recebem BUSY_REPLY.
+    A espera na fila nunca passa do ponto em que o prazo da mensagem fica abaixo de min_budget_seconds.
+    """
+
+    def __init__(
+        self,
+        max_concurrency=CORE_MAX_CONCURRENCY,
+        max_queue=CORE_MAX_QUEUE,
+        shed_queue_depth=CORE_SHED_QUEUE_DEPTH,
+        max_wait_seconds=CORE_MAX_WAIT_SECONDS,
+        min_budget_seconds=CORE_MIN_BUDGET_SECONDS,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.shed_queue_depth = shed_queue_depth
+        self.max_wait_seconds = max_wait_seconds
+        self.min_budget_seconds = min_budget_seconds
+        self._in_flight = 0
+        self._waiters = []  # heap de (prioridade, seq, future)
+        self._seq = itertools.count()
+        self._wait_times = deque(maxlen=WAIT_SAMPLES)
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.late = 0  # Recusados porque o prazo da mensagem não daria para o core
+        self.max_queue_depth_seen = 0
+
+    @property
+    def queue_depth(self):
+        return sum(1 for _, _, f in self._waiters if not f.done())
+
+    def _saturated(self):
+        return self._in_flight >= self.max_concurrency
+
+    def _wait_budget(self):
+        """Quanto ainda pode esperar na fila: max_wait_seconds, limitado pelo prazo da mensagem."""
+        remaining = remaining_seconds()
+        if remaining is None:
+            return self.max_wait_seconds
+        return min(self.max_wait_seconds, remaining - self.min_budget_seconds)
+
+    async def _acquire(self, priority, intent):
+        wait_budget = self._wait_budget()
+        if wait_budget < 0:
+            self.late += 1
+            raise CoreOverloaded(BUSY_REPLY, "deadline")
+        if not self._saturated() and not self.queue_depth:
+            self._in_flight += 1
+            self._wait_times.append(0.0)
+            return
+        depth = self.queue_depth
+        if priority == PRIORITY_LOW and depth >= self.shed_queue_depth:
+            self.shed += 1
+            raise CoreOverloaded(random.choice(CANNED_REPLIES.get(intent, [BUSY_REPLY])), "shed")
+        if depth >= self.max_queue:
+            self.rejected += 1
+            raise CoreOverloaded(BUSY_REPLY, "queue_full")
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self.queued += 1
+        self.max_queue_depth_seen = max(self.max_queue_depth_seen, depth + 1)
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=wait_budget)
+        except asyncio.TimeoutError:
+            if not future.done():
+                future.cancel()  # Sai da fila; _release pula futures cancelados
+                self.timeouts += 1
+                raise CoreOverloaded(BUSY_REPLY, "timeout")
+            # A vaga chegou junto com o timeout: segue normalmente
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()  # Recebeu a vaga mas foi cancelado: devolve
+            else:
+                future.cancel()
+            raise
+        self._wait_times.append(time.monotonic() - start)
+
+    def _release(self):
+        # Passa a vaga direto para o próximo da fila (sem decrementar), se houver
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._in_flight -= 1
+
+    async def run(self, coro_factory, priority=PRIORITY_NORMAL, intent=None):
+        """Executa coro_factory() quando houver vaga. Levanta CoreOverloaded se não for admitido."""
+        await self._acquire(priority, intent)
+        self.admitted += 1
+        try:
+            return await coro_factory()
+        finally:
+            self._release()
+
+    def stats(self):
+        waits = sorted(self._wait_times)
+        return {
+            "in_flight": self._in_flight,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth_seen": self.max_queue_depth_seen,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "shed": self.shed,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "late": self.late,
+            "wait_avg_seconds": sum(waits) / len(waits) if waits else 0.0,
+            "wait_p95_seconds": waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+            "wait_max_seconds": waits[-1] if waits else 0.0,
+        }
+
+
+core_executor = CoreExecutor()
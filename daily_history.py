@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: daily_history.py (v1 - Resumo do dia fechado e agregados de 7/30 dias)
+#
+# Na troca de dia (firestore_manager) o dia que acabou vira um resumo compacto em
+# users/{id}/daily_logs/{data} e entra no documento users/{id}/stats/rolling, que guarda só os
+# últimos 30 dias ({data: {kcal, goal, on_target}}) e os agregados já prontos de 7 e 30 dias.
+# Os agregados também vão para o campo rolling_stats do usuário, então GET_STATUS e perguntas de
+# tendência não leem histórico nenhum. Funções puras; o I/O fica no firestore_manager.
+
+import datetime
+import os
+
+WINDOWS = (7, 30)
+KEEP_DAYS = max(WINDOWS)
+# Dia "na meta": consumo dentro de ±ON_TARGET_TOLERANCE da meta calórica
+ON_TARGET_TOLERANCE = float(os.environ.get("ON_TARGET_TOLERANCE", "0.10"))
+
+
+def _parse_date(date_str):
+    try:
+        return datetime.date.fromisoformat(str(date_str))
+    except ValueError:
+        return None
+
+
+def is_on_target(kcal, goal):
+    if not goal or not kcal:
+        return False
+    return abs(kcal - goal) <= goal * ON_TARGET_TOLERANCE
+
+
+def close_day(daily_tracking, diet_settings, today_str):
+    """Resumo do dia em daily_tracking se ele já fechou (data anterior a hoje); senão None."""
+    date_str = (daily_tracking or {}).get("date")
+    if not date_str or date_str >= today_str or _parse_date(date_str) is None:
+        return None
+    kcal = int(round((daily_tracking or {}).get("calories_consumed") or 0))
+    goal = (diet_settings or {}).get("daily_calorie_goal")
+    return {"date": date_str, "kcal": kcal, "goal": goal, "on_target": is_on_target(kcal, goal)}
+
+
+def day_doc_fields(closed_day):
+    """Campos (set merge=True) que fecham daily_logs/{data}; o total do dia já está lá (Increment)."""
+    return {"date": closed_day["date"], "goal_kcal": closed_day["goal"], "on_target": closed_day["on_target"], "closed": True}
+
+
+def _window(days, today, size):
+    start = (today - datetime.timedelta(days=size)).isoformat()
+    logged = [day for date_str, day in days.items() if date_str >= start]
+    total = sum(day["kcal"] for day in logged)
+    return {
+        "days_logged": len(logged),
+        "total_kcal": total,
+        "avg_kcal": round(total / len(logged)) if logged else 0,
+        "days_on_target": sum(1 for day in logged if day.get("on_target")),
+    }
+
+
+def roll(rolling_doc, closed_day, today_str):
+    """Novo stats/rolling: entra o dia fechado (se teve registro), saem os dias fora da janela maior.
+
+    Os agregados são refeitos só com os <= 30 dias guardados no próprio documento, então aplicar o
+    mesmo dia duas vezes (troca de dia detectada por dois caminhos) dá o mesmo resultado.
+    """
+    today = _parse_date(today_str)
+    oldest = (today - datetime.timedelta(days=KEEP_DAYS)).isoformat()
+    days = {date_str: day for date_str, day in ((rolling_doc or {}).get("days") or {}).items() if oldest <= date_str < today_str}
+    if closed_day and closed_day["kcal"] > 0 and closed_day["date"] >= oldest:
+        days[closed_day["date"]] = {"kcal": closed_day["kcal"], "goal": closed_day["goal"], "on_target": closed_day["on_target"]}
+    rolling = {"as_of": today_str, "days": days}
+    rolling.update(aggregates(days, today))
+    return rolling
+
+
+def aggregates(days, today):
+    return {f"last_{size}d": _window(days, today, size) for size in WINDOWS}
+
+
+def summary(rolling_doc):
+    """Só os agregados (o que vai para o campo rolling_stats do usuário)."""
+    return {key: value for key, value in (rolling_doc or {}).items() if key != "days"}
+
+
+def format_context(rolling_stats, today_str=None):
+    """Linha compacta para o contexto do prompt ('' sem histórico ou com agregados de outro dia)."""
+    if not rolling_stats or (today_str and rolling_stats.get("as_of") != today_str):
+        return ""
+    parts = []
+    for size in WINDOWS:
+        window = rolling_stats.get(f"last_{size}d") or {}
+        if window.get("days_logged"):
+            parts.append(f"{size}d:{window['days_logged']} dias reg.,méd {window['avg_kcal']}kcal,{window['days_on_target']} na meta")
+    return "Hist " + "; ".join(parts) if parts else ""
@@ -0,0 +1,601 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: fake_backends.py (v2 - FakeFirestore.load para dados iniciais sem latência)
+#
+# Substitutos sem rede dos clientes usados pelo bot, com latência e erros injetáveis:
+#   store = FakeFirestore(faults=FaultInjector(latency_seconds=0.005, seed=1))
+#   firestore_manager.set_clients(store, store.async_client())
+#   calobot_core.set_backends(db_client=store, model_obj=FakeGenerativeModel(seed=1))
+# Cobre a API que o projeto usa: documentos e subcoleções, set/update/delete (com SERVER_TIMESTAMP,
+# Increment, DELETE_FIELD, ArrayUnion/ArrayRemove), consultas simples, WriteBatch e transações
+# (compatíveis com firestore.transactional / async_transactional, com conflito otimista -> Aborted).
+
+import asyncio
+import copy
+import datetime
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import types
+import uuid
+
+from google.api_core import exceptions as google_exceptions
+from google.cloud import firestore
+
+import nlu_local
+
+
+class FaultInjector:
+    """Latência (base + jitter uniforme) e erros aleatórios, reproduzíveis pela seed."""
+
+    def __init__(self, latency_seconds=0.0, jitter_seconds=0.0, error_rate=0.0, error_factory=None, seed=None):
+        self.latency_seconds = latency_seconds
+        self.jitter_seconds = jitter_seconds
+        self.error_rate = error_rate
+        # error_factory(op) -> exceção; padrão: ServiceUnavailable (transitório, o rate limiter repete)
+        self.error_factory = error_factory or (lambda op: google_exceptions.ServiceUnavailable(f"Falha injetada ({op})"))
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+
+    def _draw(self):
+        with self._lock:
+            self.calls += 1
+            delay = self.latency_seconds + (self._rng.uniform(0, self.jitter_seconds) if self.jitter_seconds else 0.0)
+            fail = bool(self.error_rate) and self._rng.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        return delay, fail
+
+    def before_sync(self, op):
+        delay, fail = self._draw()
+        if delay:
+            time.sleep(delay)
+        if fail:
+            raise self.error_factory(op)
+
+    async def before(self, op):
+        delay, fail = self._draw()
+        if delay:
+            await asyncio.sleep(delay)
+        if fail:
+            raise self.error_factory(op)
+
+    def stats(self):
+        return {"calls": self.calls, "errors": self.errors}
+
+
+# --- Firestore ---
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _materialize(value, now, current=None):
+    """Valor final de um campo gravado (sentinelas resolvidas como o servidor faria)."""
+    if value is firestore.SERVER_TIMESTAMP:
+        return now
+    if isinstance(value, firestore.Increment):
+        return (current if isinstance(current, (int, float)) else 0) + value.value
+    if isinstance(value, firestore.ArrayUnion):
+        base = list(current) if isinstance(current, list) else []
+        return base + [v for v in value.values if v not in base]
+    if isinstance(value, firestore.ArrayRemove):
+        return [v for v in (current if isinstance(current, list) else []) if v not in value.values]
+    if isinstance(value, dict):
+        return {k: _materialize(v, now) for k, v in value.items() if v is not firestore.DELETE_FIELD}
+    return copy.deepcopy(value)
+
+
+def _apply_fields(doc, updates, now, merge):
+    # update(): chaves com ponto são caminhos; set(merge=True): dicts aninhados são mesclados
+    for path, value in updates.items():
+        keys = [path] if merge else path.split(".")
+        target = doc
+        for key in keys[:-1]:
+            if not isinstance(target.get(key), dict):
+                target[key] = {}
+            target = target[key]
+        last = keys[-1]
+        if value is firestore.DELETE_FIELD:
+            target.pop(last, None)
+        elif merge and isinstance(value, dict) and isinstance(target.get(last), dict):
+            _apply_fields(target[last], value, now, merge=True)
+        else:
+            target[last] = _materialize(value, now, target.get(last))
+
+
+def _field(data, path):
+    for key in str(path).split("."):
+        if not isinstance(data, dict) or key not in data:
+            return None
+        data = data[key]
+    return data
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, reference, data, update_time=None):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.exists = data is not None
+        self.update_time = update_time
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path):
+        return _field(self._data, field_path)
+
+
+class _Store:
+    """Documentos por caminho completo ('users/1/daily_logs/2024-01-01'), com versão por documento."""
+
+    def __init__(self):
+        self.docs = {}
+        self.versions = {}
+        self.update_times = {}
+        self.lock = threading.RLock()
+        self._clock = itertools.count(1)
+        self.reads = 0
+        self.writes = 0
+
+    def read(self, path):
+        with self.lock:
+            data = self.docs.get(path)
+            return (copy.deepcopy(data) if data is not None else None), self.versions.get(path, 0), self.update_times.get(path)
+
+    def commit(self, writes, expected_versions=None):
+        """Aplica as escritas atomicamente; expected_versions (transação) -> Aborted se algo mudou."""
+        with self.lock:
+            for path, version in (expected_versions or {}).items():
+                if self.versions.get(path, 0) != version:
+                    raise google_exceptions.Aborted(f"Documento alterado durante a transação: {path}")
+            for op, path, _, _ in writes:
+                if op == "update" and path not in self.docs:
+                    raise google_exceptions.NotFound(f"Documento inexistente: {path}")
+                if op == "create" and path in self.docs:
+                    raise google_exceptions.AlreadyExists(f"Documento já existe: {path}")
+            now = _now()
+            for op, path, data, merge in writes:
+                if op == "delete":
+                    self.docs.pop(path, None)
+                elif op in ("set", "create") and not merge:
+                    self.docs[path] = _materialize(data, now)
+                else:
+                    doc = self.docs.setdefault(path, {})
+                    _apply_fields(doc, data, now, merge=(op != "update"))
+                self.versions[path] = next(self._clock)
+                self.update_times[path] = now
+            return [types.SimpleNamespace(update_time=now) for _ in writes]
+
+    def children(self, collection_path):
+        prefix = collection_path + "/"
+        with self.lock:
+            return sorted(p for p in self.docs if p.startswith(prefix) and "/" not in p[len(prefix):])
+
+
+class FakeDocumentReference:
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def __eq__(self, other):
+        return isinstance(other, FakeDocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    @property
+    def parent(self):
+        return self._client._collection_cls(self._client, self.path.rsplit("/", 1)[0])
+
+    def collection(self, name):
+        return self._client._collection_cls(self._client, f"{self.path}/{name}")
+
+    def _snapshot(self, transaction=None):
+        data, version, update_time = self._client._store.read(self.path)
+        if transaction is not None:
+            transaction._reads.setdefault(self.path, version)
+        self._client._store.reads += 1
+        return FakeDocumentSnapshot(self, data, update_time)
+
+    def _write(self, op, data=None, merge=False):
+        self._client._store.writes += 1
+        return self._client._store.commit([(op, self.path, data, merge)])[0]
+
+    def get(self, field_paths=None, transaction=None):
+        self._client.faults.before_sync("get")
+        return self._snapshot(transaction)
+
+    def set(self, document_data, merge=False):
+        self._client.faults.before_sync("set")
+        return self._write("set", document_data, merge)
+
+    def create(self, document_data):
+        self._client.faults.before_sync("create")
+        return self._write("create", document_data)
+
+    def update(self, field_updates):
+        self._client.faults.before_sync("update")
+        return self._write("update", field_updates)
+
+    def delete(self):
+        self._client.faults.before_sync("delete")
+        return self._write("delete")
+
+
+class FakeAsyncDocumentReference(FakeDocumentReference):
+    async def get(self, field_paths=None, transaction=None):
+        await self._client.faults.before("get")
+        return self._snapshot(transaction)
+
+    async def set(self, document_data, merge=False):
+        await self._client.faults.before("set")
+        return self._write("set", document_data, merge)
+
+    async def create(self, document_data):
+        await self._client.faults.before("create")
+        return self._write("create", document_data)
+
+    async def update(self, field_updates):
+        await self._client.faults.before("update")
+        return self._write("update", field_updates)
+
+    async def delete(self):
+        await self._client.faults.before("delete")
+        return self._write("delete")
+
+
+_OPS = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a is not None and a < b,
+    "<=": lambda a, b: a is not None and a <= b,
+    ">": lambda a, b: a is not None and a > b,
+    ">=": lambda a, b: a is not None and a >= b,
+    "in": lambda a, b: a in b,
+    "not-in": lambda a, b: a not in b,
+    "array_contains": lambda a, b: isinstance(a, list) and b in a,
+    "array_contains_any": lambda a, b: isinstance(a, list) and any(v in a for v in b),
+}
+
+
+class FakeQuery:
+    def __init__(self, client, collection_path, filters=(), orders=(), limit_count=None, cursor=None):
+        self._client = client
+        self._path = collection_path
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit_count
+        self._cursor = cursor
+
+    def _copy(self, **changes):
+        state = {"filters": self._filters, "orders": self._orders, "limit_count": self._limit, "cursor": self._cursor}
+        state.update(changes)
+        return self._client._query_cls(self._client, self._path, **state)
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path, direction="ASCENDING"):
+        return self._copy(orders=self._orders + ((str(field_path), direction == "DESCENDING"),))
+
+    def limit(self, count):
+        return self._copy(limit_count=count)
+
+    def start_after(self, document_fields_or_snapshot):
+        return self._copy(cursor=document_fields_or_snapshot)
+
+    def _run(self, transaction=None):
+        store = self._client._store
+        rows = []
+        for path in store.children(self._path):
+            data, version, update_time = store.read(path)
+            if all(_OPS[op](path.rsplit("/", 1)[-1] if field == "__name__" else _field(data, field), value) for field, op, value in self._filters):
+                if transaction is not None:
+                    transaction._reads.setdefault(path, version)
+                rows.append(FakeDocumentSnapshot(self._client._document_cls(self._client, path), data, update_time))
+        for field, descending in reversed(self._orders):  # Ordenação estável, do último critério para o primeiro
+            def key(snap, field=field):
+                value = snap.id if field == "__name__" else snap.get(field)
+                return (value is not None, value)
+            rows.sort(key=key, reverse=descending)
+        if self._cursor is not None:
+            cursor_path = getattr(getattr(self._cursor, "reference", None), "path", None)
+            paths = [snap.reference.path for snap in rows]
+            rows = rows[paths.index(cursor_path) + 1:] if cursor_path in paths else rows
+        self._client._store.reads += len(rows[: self._limit] if self._limit is not None else rows)
+        return rows[: self._limit] if self._limit is not None else rows
+
+    def stream(self, transaction=None):
+        self._client.faults.before_sync("query")
+        return iter(self._run(transaction))
+
+    def get(self, transaction=None):
+        return list(self.stream(transaction))
+
+
+class FakeAsyncQuery(FakeQuery):
+    async def stream(self, transaction=None):
+        await self._client.faults.before("query")
+        for snap in self._run(transaction):
+            yield snap
+
+    async def get(self, transaction=None):
+        return [snap async for snap in self.stream(transaction)]
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, client, collection_path, **state):
+        super().__init__(client, collection_path, **state)
+        self.id = collection_path.rsplit("/", 1)[-1]
+
+    def document(self, document_id=None):
+        return self._client._document_cls(self._client, f"{self._path}/{document_id or uuid.uuid4().hex[:20]}")
+
+
+class FakeAsyncCollectionReference(FakeAsyncQuery, FakeCollectionReference):
+    pass
+
+
+class FakeWriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append(("set", reference.path, document_data, merge))
+
+    def create(self, reference, document_data):
+        self._writes.append(("create", reference.path, document_data, False))
+
+    def update(self, reference, field_updates):
+        self._writes.append(("update", reference.path, field_updates, False))
+
+    def delete(self, reference):
+        self._writes.append(("delete", reference.path, None, False))
+
+    def _commit_writes(self, expected_versions=None):
+        writes, self._writes = self._writes, []
+        self._client._store.writes += len(writes)
+        return self._client._store.commit(writes, expected_versions)
+
+    def commit(self):
+        self._client.faults.before_sync("commit")
+        return self._commit_writes()
+
+
+class FakeAsyncWriteBatch(FakeWriteBatch):
+    async def commit(self):
+        await self._client.faults.before("commit")
+        return self._commit_writes()
+
+
+class FakeTransaction(FakeWriteBatch):
+    """Transação otimista: lê registrando versões; no commit, Aborted se algum documento lido mudou."""
+
+    def __init__(self, client, max_attempts=5, read_only=False):
+        super().__init__(client)
+        self._max_attempts = max_attempts
+        self._read_only = read_only
+        self._id = None
+        self._reads = {}
+
+    @property
+    def in_progress(self):
+        return self._id is not None
+
+    @property
+    def id(self):
+        return self._id
+
+    def _clean_up(self):
+        self._writes = []
+        self._reads = {}
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self._id = uuid.uuid4().bytes
+
+    def _rollback(self):
+        self._clean_up()
+
+    def _commit(self):
+        try:
+            return self._commit_writes(self._reads)
+        finally:
+            self._clean_up()
+
+    def get(self, ref_or_query, **kwargs):
+        if isinstance(ref_or_query, FakeDocumentReference):
+            return FakeDocumentReference.get(ref_or_query, transaction=self)
+        return FakeQuery.stream(ref_or_query, transaction=self)
+
+
+class FakeAsyncTransaction(FakeTransaction):
+    async def _begin(self, retry_id=None):
+        FakeTransaction._begin(self, retry_id)
+
+    async def _rollback(self):
+        FakeTransaction._rollback(self)
+
+    async def _commit(self):
+        await self._client.faults.before("commit")
+        return FakeTransaction._commit(self)
+
+    async def get(self, ref_or_query, **kwargs):
+        if isinstance(ref_or_query, FakeDocumentReference):
+            return await FakeAsyncDocumentReference.get(ref_or_query, transaction=self)
+        return FakeAsyncQuery.stream(ref_or_query, transaction=self)
+
+
+class FakeFirestore:
+    """Cliente síncrono em memória (mesma forma de firestore.Client para o que o projeto usa)."""
+
+    _document_cls = FakeDocumentReference
+    _collection_cls = FakeCollectionReference
+    _query_cls = FakeQuery
+    _batch_cls = FakeWriteBatch
+    _transaction_cls = FakeTransaction
+
+    def __init__(self, faults=None, project="fake-project", _store=None):
+        self.project = project
+        self.faults = faults or FaultInjector()
+        self._store = _store or _Store()
+
+    def collection(self, *path):
+        return self._collection_cls(self, "/".join(path))
+
+    def document(self, *path):
+        return self._document_cls(self, "/".join(path))
+
+    def batch(self):
+        return self._batch_cls(self)
+
+    def transaction(self, max_attempts=5, read_only=False):
+        return self._transaction_cls(self, max_attempts=max_attempts, read_only=read_only)
+
+    def async_client(self, faults=None):
+        """AsyncClient sobre os mesmos dados (não fica preso a um event loop)."""
+        return FakeAsyncFirestore(faults=faults or self.faults, project=self.project, _store=self._store)
+
+    def load(self, docs):
+        """Grava {caminho: dados} direto no armazenamento, sem latência nem erros (dados iniciais)."""
+        self._store.commit([("set", path, data, False) for path, data in docs.items()])
+
+    def dump(self):
+        """Cópia de todos os documentos: {caminho: dados}."""
+        with self._store.lock:
+            return copy.deepcopy(self._store.docs)
+
+    def stats(self):
+        return {"documents": len(self._store.docs), "reads": self._store.reads, "writes": self._store.writes, **self.faults.stats()}
+
+
+class FakeAsyncFirestore(FakeFirestore):
+    _document_cls = FakeAsyncDocumentReference
+    _collection_cls = FakeAsyncCollectionReference
+    _query_cls = FakeAsyncQuery
+    _batch_cls = FakeAsyncWriteBatch
+    _transaction_cls = FakeAsyncTransaction
+
+
+# --- Gemini ---
+class _Part:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeResponse:
+    def __init__(self, text, finish_reason="STOP"):
+        content = types.SimpleNamespace(parts=[_Part(text)] if text else [])
+        self.candidates = [types.SimpleNamespace(content=content, finish_reason=finish_reason, safety_ratings=[])]
+        self.text = text
+
+
+_MESSAGE_RE = re.compile(r'Mensagem do Usuário:\s*"(.*?)"', re.DOTALL)
+_FOOD_VERBS_RE = re.compile(r"^(?:eu\s+)?(?:comi|tomei|bebi|almocei|jantei|lanchei)\s+", re.IGNORECASE)
+_ESTIMATE_RE = re.compile(r"Estimativa CaloBot: (\d+) kcal")
+
+
+def fake_nlu(message):
+    """NLU determinística para o Gemini falso: regras do nlu_local + heurísticas simples."""
+    local = nlu_local.classify(message) or {}
+    intent = local.get("intent")
+    entities = dict(local.get("entities") or {})
+    text = message.strip()
+    if intent == "LOG_FOOD" or (not intent and _FOOD_VERBS_RE.match(text)):
+        intent = "LOG_FOOD"
+        items = re.split(r",|\s+e\s+|\s+com\s+", _FOOD_VERBS_RE.sub("", text))
+        entities.setdefault("food_items", [i.strip(" .!") for i in items if i.strip(" .!")] or [text])
+    elif not intent:
+        intent = "PROVIDE_INFO" if len(text.split()) <= 3 else "CHITCHAT"
+        if intent == "PROVIDE_INFO":
+            entities["info_value"] = text
+    return {"intent": intent, "entities": entities}
+
+
+def scripted_responder(prompt, model):
+    """Resposta padrão do FakeGenerativeModel pelo tipo de prompt (NLU, chamada única ou resposta)."""
+    message_match = _MESSAGE_RE.search(prompt)
+    message = message_match.group(1) if message_match else ""
+    if "APENAS um JSON" in prompt:
+        nlu = fake_nlu(message)
+        kcal = model.kcal_for(prompt) if nlu["intent"] == "LOG_FOOD" else None
+        reply = f"Anotado! 😊 Estimativa CaloBot: {kcal} kcal." if kcal else "Claro! 😊 Estou aqui para ajudar com sua alimentação."
+        return json.dumps({**nlu, "reply": reply, "estimated_kcal": kcal}, ensure_ascii=False)
+    if message_match and prompt.rstrip().endswith("JSON:"):
+        return json.dumps(fake_nlu(message), ensure_ascii=False)
+    known = _ESTIMATE_RE.search(prompt)  # Tabela local já calculou: o prompt traz o número
+    if known or "Estime kcal" in prompt:
+        kcal = known.group(1) if known else model.kcal_for(prompt)
+        return f"Boa escolha! 🍎 Estimativa CaloBot: {kcal} kcal. Lembre de beber água e siga firme na sua meta, você está indo muito bem! 💪"
+    return "Claro! 😊 Aqui vai: mantenha refeições equilibradas, com proteína, vegetais e carboidratos na medida certa. Qualquer dúvida é só chamar! 🥗"
+
+
+class FakeGenerativeModel:
+    """Substituto de vertexai GenerativeModel: respostas roteirizadas, latência e erros injetáveis."""
+
+    def __init__(self, model_name="fake-gemini", system_instruction=None, responder=None, faults=None,
+                 chunk_words=6, chunk_latency_seconds=0.0, seed=None):
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.responder = responder or scripted_responder
+        self.faults = faults or FaultInjector(seed=seed)
+        self.chunk_words = chunk_words
+        self.chunk_latency_seconds = chunk_latency_seconds
+        self.seed = seed
+        self.calls = 0
+        self.prompt_chars = 0
+
+    def with_system_instruction(self, system_instruction):
+        """Cópia com outra system_instruction, compartilhando respostas, falhas e contadores de latência."""
+        clone = copy.copy(self)
+        clone.system_instruction = system_instruction
+        return clone
+
+    def kcal_for(self, prompt):
+        # Determinístico por prompt e seed: mesma entrada, mesma estimativa entre execuções
+        digest = hashlib.sha1(f"{self.seed}:{prompt}".encode("utf-8")).digest()
+        return 80 + int.from_bytes(digest[:4], "big") % 720
+
+    def _respond(self, contents):
+        prompt = contents if isinstance(contents, str) else "\n".join(map(str, contents))
+        self.calls += 1
+        self.prompt_chars += len(prompt)
+        return self.responder(prompt, self)
+
+    async def _stream(self, text):
+        words = text.split(" ")
+        for start in range(0, len(words), self.chunk_words):
+            if self.chunk_latency_seconds:
+                await asyncio.sleep(self.chunk_latency_seconds)
+            piece = " ".join(words[start:start + self.chunk_words])
+            yield FakeResponse(piece if start == 0 else " " + piece)
+
+    async def generate_content_async(self, contents, generation_config=None, safety_settings=None, stream=False, **kwargs):
+        await self.faults.before("generate")
+        text = self._respond(contents)
+        return self._stream(text) if stream else FakeResponse(text)
+
+    def generate_content(self, contents, generation_config=None, safety_settings=None, stream=False, **kwargs):
+        self.faults.before_sync("generate")
+        return FakeResponse(self._respond(contents))
+
+    def count_tokens(self, contents):
+        text = contents if isinstance(contents, str) else "\n".join(map(str, contents))
+        text = f"{self.system_instruction or ''}{text}"
+        return types.SimpleNamespace(total_tokens=max(1, round(len(text) / 4)), total_billable_characters=len(text))
+
+    async def count_tokens_async(self, contents):
+        return self.count_tokens(contents)
+
+    def stats(self):
+        return {"calls": self.calls, "prompt_chars": self.prompt_chars, **self.faults.stats()}
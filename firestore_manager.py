@@ -1,10 +1,21 @@
 # -*- coding: utf-8 -*-
-# Nome do arquivo: firestore_manager.py (v4 - Sem mudanças funcionais, consistência)
+# Nome do arquivo: firestore_manager.py (v18 - Troca de dia em transação: só uma réplica zera o total; calorias sempre por Increment)
 
 # Importar as bibliotecas necessárias
 from google.cloud import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+import asyncio
+import atexit
+import copy
 import datetime
 import logging  # Adicionado para consistência de logging
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+import daily_history
 
 # Configuração básica de logging (opcional, mas útil)
 logging.basicConfig(
@@ -12,24 +23,589 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-logger.info("Tentando inicializar o cliente Firestore...")
-# Inicializar o cliente Firestore
+PROJECT_ID = "gen-lang-client-0288576877"  # <<< SEU PROJECT ID AQUI
+
+# Cliente Firestore: criado por init(), chamada pela primeira operação que precisa dele (ou pelo
+# warmup do calobot_core). Importar o módulo não abre conexão nem procura credenciais.
 db = None
-try:
-    project_id = "gen-lang-client-0288576877"  # <<< SEU PROJECT ID AQUI
-    db = firestore.Client(project=project_id)
+_initialized = False
+_init_lock = threading.Lock()
+
+
+def init():
+    """Cria o cliente Firestore (idempotente). Retorna o cliente, ou None se a criação falhou."""
+    global db, _initialized
+    if _initialized:
+        return db
+    with _init_lock:
+        if _initialized:
+            return db
+        logger.info("Tentando inicializar o cliente Firestore...")
+        try:
+            db = firestore.Client(project=PROJECT_ID)
+            logger.info(
+                f"Cliente Firestore inicializado com sucesso para o projeto: {PROJECT_ID}."
+            )
+        except Exception as e:
+            logger.error(f"ERRO CRÍTICO ao inicializar cliente Firestore: {e}", exc_info=True)
+            db = None
+        _initialized = True  # Falhou: não tenta de novo a cada mensagem (close() permite nova tentativa)
+    return db
+
+
+def close():
+    """Grava os touches pendentes e fecha os clientes; o próximo init() cria clientes novos."""
+    global db, _initialized, _async_client_override
+    touch_flusher.flush()
+    with _init_lock:
+        for client in [db, _async_client_override, *_async_clients.values()]:
+            try:
+                if client is not None and hasattr(client, "close"):
+                    client.close()
+            except Exception as e:
+                logger.warning(f"Falha ao fechar cliente Firestore: {e}")
+        _async_clients.clear()
+        db = None
+        _async_client_override = None
+        _initialized = False
+    logger.info("Clientes do Firestore fechados.")
+
+# Clientes assíncronos: o canal gRPC fica preso ao event loop em que foi criado,
+# então mantemos um AsyncClient por loop.
+_async_clients = weakref.WeakKeyDictionary()
+_async_client_override = None  # Definido por set_clients (cliente que não depende do event loop)
+
+
+def get_async_db():
+    """Retorna o AsyncClient do Firestore para o event loop em execução (ou None)."""
+    if not init():
+        return None
+    if _async_client_override is not None:
+        return _async_client_override
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = firestore.AsyncClient(project=db.project)
+        _async_clients[loop] = client
+        logger.info("AsyncClient do Firestore criado para o event loop atual.")
+    return client
+
+
+def set_clients(sync_client, async_client=None):
+    """Troca os clientes do Firestore (ex: fake_backends.FakeFirestore) e limpa o cache de usuários.
+
+    async_client é usado em qualquer event loop; sem ele, volta a criar um AsyncClient real por loop.
+    """
+    global db, _initialized, _async_client_override
+    db = sync_client
+    _initialized = True
+    _async_client_override = async_client
+    _async_clients.clear()
+    user_cache.clear()
+    logger.info(f"Clientes do Firestore trocados ({type(sync_client).__name__}).")
+
+
+# --- Cache de documentos de usuário (write-through) ---
+USER_CACHE_MAX_ENTRIES = int(os.environ.get("USER_CACHE_MAX_ENTRIES", "10000"))
+# TTL limita o quanto um processo pode ficar desatualizado se outro processo escrever no mesmo usuário
+USER_CACHE_TTL_SECONDS = float(os.environ.get("USER_CACHE_TTL_SECONDS", "300"))
+
+
+def _resolve_value(value, now):
+    """Converte sentinelas do Firestore no valor que o servidor vai gravar."""
+    if value is firestore.SERVER_TIMESTAMP:
+        return now
+    if isinstance(value, dict):
+        return {k: _resolve_value(v, now) for k, v in value.items() if v is not firestore.DELETE_FIELD}
+    return copy.deepcopy(value)
+
+
+def _apply_updates(doc, updates, merge=False):
+    """Aplica em memória um update() (caminhos com ponto) ou set(merge=True) (dicts aninhados)."""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for path, value in updates.items():
+        keys = [path] if merge else path.split(".")
+        target = doc
+        for key in keys[:-1]:
+            if not isinstance(target.get(key), dict):
+                target[key] = {}
+            target = target[key]
+        last = keys[-1]
+        if value is firestore.DELETE_FIELD:
+            target.pop(last, None)
+        elif isinstance(value, firestore.Increment):
+            target[last] = (target.get(last) or 0) + value.value
+        elif merge and isinstance(value, dict) and isinstance(target.get(last), dict):
+            _apply_updates(target[last], value, merge=True)
+        else:
+            target[last] = _resolve_value(value, now)
+    return doc
+
+
+class UserCache:
+    """Cache LRU em processo dos documentos de usuário, atualizado pelas nossas próprias escritas."""
+
+    def __init__(self, max_entries=USER_CACHE_MAX_ENTRIES, ttl_seconds=USER_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._data = OrderedDict()  # user_id_str -> (expira_em, documento)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id_str):
+        """Cópia do documento em cache, ou None."""
+        with self._lock:
+            entry = self._data.get(user_id_str)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._data[user_id_str]
+                self.misses += 1
+                return None
+            self._data.move_to_end(user_id_str)
+            self.hits += 1
+            return copy.deepcopy(entry[1])
+
+    def put(self, user_id_str, doc):
+        if self.max_entries <= 0:
+            return
+        doc = _resolve_value(doc, datetime.datetime.now(datetime.timezone.utc))
+        with self._lock:
+            self._data[user_id_str] = (time.monotonic() + self.ttl_seconds, doc)
+            self._data.move_to_end(user_id_str)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def apply(self, user_id_str, updates, merge=False):
+        """Write-through: reflete no cache uma escrita já confirmada no Firestore."""
+        with self._lock:
+            entry = self._data.get(user_id_str)
+            if entry is not None:
+                _apply_updates(entry[1], updates, merge=merge)
+
+    def invalidate(self, user_id_str):
+        with self._lock:
+            self._data.pop(user_id_str, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+user_cache = UserCache()
+
+
+# --- Write-behind de "touches" (last_interaction_at) ---
+TOUCH_FLUSH_INTERVAL_SECONDS = float(os.environ.get("TOUCH_FLUSH_INTERVAL_SECONDS", "10"))
+BATCH_MAX_WRITES = 500  # Limite de operações por WriteBatch no Firestore
+
+
+class WriteBehindFlusher:
+    """Acumula escritas de baixo valor por documento e as grava em WriteBatch numa thread de fundo.
+
+    Várias escritas do mesmo documento entre dois flushes viram uma só (a mais recente vence).
+    Por padrão grava em "users" (documento = user_id_str).
+    """
+
+    def __init__(self, interval_seconds=TOUCH_FLUSH_INTERVAL_SECONDS, batch_size=BATCH_MAX_WRITES, collection="users"):
+        self.interval_seconds = interval_seconds
+        self.batch_size = batch_size
+        self.collection = collection
+        self.flush_immediately = False  # Acorda a thread a cada defer (ver disable_process_user_state)
+        self._pending = {}  # id do documento -> campos a gravar (set merge=True)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._stopped = False
+        self.queued = 0
+        self.coalesced = 0
+        self.flushed_writes = 0
+        self.batches = 0
+        self.errors = 0
+
+    def touch(self, user_id_str):
+        """Agenda last_interaction_at = agora para o usuário."""
+        self.defer(user_id_str, {"last_interaction_at": datetime.datetime.now(datetime.timezone.utc)})
+
+    def defer(self, user_id_str, fields):
+        """Agenda um set(merge=True) de campos de nível superior do documento."""
+        with self._lock:
+            self.queued += 1
+            if user_id_str in self._pending:
+                self.coalesced += 1
+                self._pending[user_id_str].update(fields)
+            else:
+                self._pending[user_id_str] = dict(fields)
+            if self._thread is None and not self._stopped:
+                self._thread = threading.Thread(target=self._run, name=f"firestore-write-behind-{self.collection}", daemon=True)
+                self._thread.start()
+        if self._stopped:
+            # Depois do shutdown não há thread: grava na hora para não perder nada
+            self.flush()
+        elif self.flush_immediately:
+            self._wake.set()
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self.interval_seconds)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Grava tudo o que está pendente, em lotes de até batch_size documentos."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            if not init():
+                logger.error(f"[Write-behind] Firestore off; {len(pending)} escritas descartadas.")
+                return 0
+            items = list(pending.items())
+            written = 0
+            for start in range(0, len(items), self.batch_size):
+                chunk = items[start:start + self.batch_size]
+                try:
+                    batch = db.batch()
+                    for user_id_str, fields in chunk:
+                        batch.set(db.collection(self.collection).document(user_id_str), fields, merge=True)
+                    batch.commit()
+                    written += len(chunk)
+                    self.batches += 1
+                except Exception as e:
+                    self.errors += 1
+                    logger.error(f"[Write-behind] Falha no lote de {len(chunk)} escritas: {e}")
+                    with self._lock:
+                        # Devolve à fila sem sobrescrever valores mais novos que chegaram nesse meio-tempo
+                        for user_id_str, fields in chunk:
+                            self._pending[user_id_str] = {**fields, **self._pending.get(user_id_str, {})}
+            self.flushed_writes += written
+            logger.debug(f"[Write-behind] {written} escritas gravadas.")
+            return written
+
+    def stop(self, flush=True):
+        """Para a thread de fundo e (por padrão) grava o que estiver pendente."""
+        self._stopped = True
+        self._wake.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.interval_seconds + 5)
+        if flush:
+            self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "queued": self.queued,
+                "coalesced": self.coalesced,
+                "flushed_writes": self.flushed_writes,
+                "batches": self.batches,
+                "errors": self.errors,
+            }
+
+
+touch_flusher = WriteBehindFlusher()
+atexit.register(touch_flusher.stop)
+
+
+def disable_process_user_state():
+    """Para várias réplicas sem roteamento por usuário: nada do usuário fica só neste processo.
+
+    O cache de usuários é desligado (toda leitura vai ao Firestore, então a escrita de uma réplica
+    é vista pela próxima mensagem em outra) e o write-behind grava logo após cada defer, em vez de
+    esperar o intervalo. Os touches continuam em lote, mas sem atraso perceptível.
+    """
+    user_cache.max_entries = 0
+    user_cache.clear()
+    touch_flusher.flush_immediately = True
+    logger.info("Estado por usuário em processo desligado (cache de usuários e atraso do write-behind).")
+
+
+def _save_prepared_user_payload(user_doc_ref, user_id_str, payload):
+    """Grava o payload de _prepare_existing_user: só o touch vai para o write-behind.
+
+    Retorna a escrita síncrona pendente (ou None) para a versão assíncrona poder aguardá-la.
+    """
+    if set(payload) == {"last_interaction_at"}:
+        touch_flusher.touch(user_id_str)
+        user_cache.apply(user_id_str, payload, merge=True)
+        return None
+    # Troca de dia: grava na hora, pois o reset de daily_tracking não pode se perder
+    return user_doc_ref.set(payload, merge=True)
+
+
+def _rolling_ref(user_doc_ref):
+    return user_doc_ref.collection("stats").document("rolling")
+
+
+def _fill_rollover_batch(batch, user_doc_ref, closed_day, rolling_snapshot, today_str):
+    """Fecha o dia em daily_logs/{data} e regrava stats/rolling no lote.
+
+    Retorna os agregados (rolling_stats) a espelhar no documento do usuário.
+    """
+    rolling = daily_history.roll(
+        rolling_snapshot.to_dict() if rolling_snapshot.exists else None, closed_day, today_str
+    )
+    if closed_day["kcal"] > 0:  # Dia sem registro não tem documento diário para fechar
+        batch.set(
+            user_doc_ref.collection("daily_logs").document(closed_day["date"]),
+            dict(daily_history.day_doc_fields(closed_day), closed_at=firestore.SERVER_TIMESTAMP),
+            merge=True,
+        )
+    batch.set(_rolling_ref(user_doc_ref), dict(rolling, updated_at=firestore.SERVER_TIMESTAMP))
     logger.info(
-        f"Cliente Firestore inicializado com sucesso para o projeto: {project_id}."
+        f"[Histórico] Dia {closed_day['date']} fechado ({closed_day['kcal']} kcal, na meta: "
+        f"{closed_day['on_target']}); agregados de {today_str} atualizados."
+    )
+    return daily_history.summary(rolling)
+
+
+def _already_rolled(current, user_data, today_str):
+    """Outra réplica já trocou o dia: user_data passa a refletir o que está gravado (nada é zerado)."""
+    if ((current or {}).get("daily_tracking") or {}).get("date") != today_str:
+        return False
+    user_data["daily_tracking"] = current["daily_tracking"]
+    user_data["rolling_stats"] = current.get("rolling_stats")
+    return True
+
+
+def _save_rollover(client, user_doc_ref, user_data, payload, closed_day):
+    """Troca de dia: reset do daily_tracking + dia arquivado + stats/rolling numa transação.
+
+    A transação relê o usuário: se outra réplica já trocou o dia (e talvez já somou calorias),
+    o reset não é gravado de novo.
+    """
+    today_str = user_data["daily_tracking"]["date"]
+
+    @firestore.transactional
+    def run(transaction):
+        current = user_doc_ref.get(transaction=transaction).to_dict()
+        rolling_snapshot = _rolling_ref(user_doc_ref).get(transaction=transaction)
+        if _already_rolled(current, user_data, today_str):
+            return
+        payload["rolling_stats"] = _fill_rollover_batch(transaction, user_doc_ref, closed_day, rolling_snapshot, today_str)
+        transaction.set(user_doc_ref, payload, merge=True)
+        user_data["rolling_stats"] = payload["rolling_stats"]
+
+    run(client.transaction())
+
+
+async def _save_rollover_async(client, user_doc_ref, user_data, payload, closed_day):
+    """Versão assíncrona de _save_rollover."""
+    today_str = user_data["daily_tracking"]["date"]
+
+    @firestore.async_transactional
+    async def run(transaction):
+        current = (await user_doc_ref.get(transaction=transaction)).to_dict()
+        rolling_snapshot = await _rolling_ref(user_doc_ref).get(transaction=transaction)
+        if _already_rolled(current, user_data, today_str):
+            return
+        payload["rolling_stats"] = _fill_rollover_batch(transaction, user_doc_ref, closed_day, rolling_snapshot, today_str)
+        transaction.set(user_doc_ref, payload, merge=True)
+        user_data["rolling_stats"] = payload["rolling_stats"]
+
+    await run(client.transaction())
+
+
+# --- Funções auxiliares (sem I/O) compartilhadas pelas versões síncrona e assíncrona ---
+def _prepare_existing_user(user_data, user_id_str):
+    """Completa estruturas de usuários antigos e resolve troca de dia.
+
+    Retorna (user_data, payload, closed_day): payload é o set(merge=True) a gravar e closed_day o
+    resumo do dia que acabou (daily_history.close_day) quando houve troca de dia, senão None.
+    """
+    # Garante que estruturas aninhadas existam para usuários antigos ou com dados incompletos
+    user_data.setdefault("profile", {})
+    user_data.setdefault("diet_settings", {})
+    user_data.setdefault("daily_tracking", {})
+    user_data.setdefault("user_state", {"awaiting": None})
+
+    # Garante campos padrão dentro das estruturas se ausentes
+    user_data["profile"].setdefault("activity_level", "light")
+    user_data["profile"].setdefault("goal", "maintain")
+    user_data["diet_settings"].setdefault("daily_calorie_goal", None)
+    user_data["diet_settings"].setdefault("diet_type", "standard")
+
+    now_utc = datetime.datetime.now(datetime.timezone.utc)
+    today_str = now_utc.strftime("%Y-%m-%d")
+    closed_day = None
+    if user_data["daily_tracking"].get("date") != today_str:
+        closed_day = daily_history.close_day(
+            user_data["daily_tracking"], user_data["diet_settings"], today_str
+        )
+        logger.info(
+            f"Resetando daily_tracking para novo dia ({today_str}) para usuário {user_id_str}."
+        )
+        had_legacy_log = "log_today" in user_data["daily_tracking"]
+        user_data["daily_tracking"] = {
+            "date": today_str,
+            "calories_consumed": 0,
+        }
+        payload = {
+            "daily_tracking": dict(user_data["daily_tracking"]),
+            "last_interaction_at": firestore.SERVER_TIMESTAMP,
+        }
+        if had_legacy_log:
+            # Formato antigo (array no documento): os registros agora ficam em daily_logs
+            payload["daily_tracking"]["log_today"] = firestore.DELETE_FIELD
+    else:
+        payload = {"last_interaction_at": firestore.SERVER_TIMESTAMP}
+    return user_data, payload, closed_day
+
+
+def _build_new_user(telegram_user_id, user_name, user_id_str):
+    """Monta o documento padrão de um novo usuário."""
+    now_creation = datetime.datetime.now(datetime.timezone.utc)
+    today_str = now_creation.strftime("%Y-%m-%d")
+
+    # --- ESTRUTURA DE DADOS ATUALIZADA PARA NOVO USUÁRIO ---
+    return {
+        "telegram_user_id": telegram_user_id,
+        "user_name": user_name if user_name else f"Usuário {user_id_str}",
+        "created_at": firestore.SERVER_TIMESTAMP,
+        "profile": {
+            "height_cm": None,
+            "initial_weight_kg": None,  # Pode ser útil no futuro
+            "current_weight_kg": None,
+            # "goal_weight_kg": None, # Removido por simplicidade, foco na meta calórica
+            "birth_year": None,
+            "gender": None,  # male / female
+            "activity_level": None,  # sedentary, light, moderate, active, extra_active
+            "goal": None,  # lose, maintain, gain
+        },
+        "diet_settings": {
+            "daily_calorie_goal": None,  # Começa como None
+            "diet_type": "standard",  # Pode ser expandido (low_carb, etc.)
+            # "intermittent_fasting": { # Removido por simplicidade inicial
+            #     "enabled": False,
+            #     "window_start_hour": None,
+            #     "window_end_hour": None,
+            # },
+        },
+        "daily_tracking": {
+            "date": today_str,
+            "calories_consumed": 0,  # Registros do dia ficam em users/{id}/daily_logs/{data}/entries
+        },
+        "user_state": {
+            "awaiting": None  # Indica o que o bot está esperando (None = nada específico)
+        },
+        "last_interaction_at": firestore.SERVER_TIMESTAMP,
+    }
+    # --- FIM DA ESTRUTURA ATUALIZADA ---
+
+
+def _build_calorie_log(tracking_date, calories_add, description):
+    """Monta as escritas de um registro de calorias, sem transação.
+
+    O total do dia no documento do usuário e no documento diário sobe com Increment no servidor;
+    o registro vira um documento novo em daily_logs/{data}/entries (nada é reescrito).
+    Retorna (today_str, entrada, campos_do_documento_diario, update_do_usuario).
+    """
+    now_utc = datetime.datetime.now(datetime.timezone.utc)
+    today_str = now_utc.strftime("%Y-%m-%d")
+
+    log_entry = {
+        "description": description if description else "Registro sem descrição",
+        "estimated_kcal": calories_add,
+        "time": now_utc,  # Usar timestamp do servidor seria mais robusto se a latência for alta
+    }
+    day_fields = {
+        "date": today_str,
+        "calories_consumed": firestore.Increment(calories_add),
+        "entry_count": firestore.Increment(1),
+        "updated_at": firestore.SERVER_TIMESTAMP,
+    }
+
+    if tracking_date == today_str:
+        logger.info(f"Mesmo dia ({today_str}). Adicionando calorias.")
+        user_updates = {
+            "daily_tracking.calories_consumed": firestore.Increment(calories_add),
+            "last_interaction_at": firestore.SERVER_TIMESTAMP,
+        }
+    else:
+        # Novo dia: o dia anterior já está fechado em daily_logs; o total foi zerado na mesma
+        # transação (_fill_calorie_batch) e também sobe por Increment
+        logger.info(
+            f"Novo dia detectado ({today_str}, anterior: {tracking_date}). Resetando calorias."
+        )
+        user_updates = {
+            "daily_tracking.calories_consumed": firestore.Increment(calories_add),
+            "last_interaction_at": firestore.SERVER_TIMESTAMP,
+        }
+    return today_str, log_entry, day_fields, user_updates
+
+
+def _fill_calorie_batch(batch, user_doc_ref, calories_add, description, tracking_date, rolling_stats=None):
+    today_str, log_entry, day_fields, user_updates = _build_calorie_log(
+        tracking_date, calories_add, description
     )
-except Exception as e:
-    logger.error(f"ERRO CRÍTICO ao inicializar cliente Firestore: {e}", exc_info=True)
-    db = None
+    rollover_fields = None
+    if tracking_date != today_str:
+        # Campos da troca de dia antes do Increment, no mesmo lote (aplicados em ordem)
+        rollover_fields = {"daily_tracking.date": today_str, "daily_tracking.calories_consumed": 0}
+        if rolling_stats is not None:
+            rollover_fields["rolling_stats"] = rolling_stats
+        batch.update(user_doc_ref, rollover_fields)
+    day_doc_ref = user_doc_ref.collection("daily_logs").document(today_str)
+    batch.set(day_doc_ref, day_fields, merge=True)
+    batch.set(day_doc_ref.collection("entries").document(), log_entry)
+    batch.update(user_doc_ref, user_updates)
+    return [u for u in (rollover_fields, user_updates) if u]
+
+
+def _log_with_rollover(client, user_doc_ref, calories_add, description, today_str):
+    """Registro que também troca o dia, numa transação: relê o usuário e só fecha o dia/zera o
+    total se ninguém fez isso antes (outra réplica); senão é um registro comum com Increment.
+    Retorna os updates aplicados ao documento do usuário (em ordem)."""
+
+    @firestore.transactional
+    def run(transaction):
+        current = user_doc_ref.get(transaction=transaction).to_dict() or {}
+        rolling_snapshot = _rolling_ref(user_doc_ref).get(transaction=transaction)
+        return _fill_logged_rollover(transaction, user_doc_ref, current, rolling_snapshot, calories_add, description, today_str)
+
+    return run(client.transaction())
+
+
+async def _log_with_rollover_async(client, user_doc_ref, calories_add, description, today_str):
+    """Versão assíncrona de _log_with_rollover."""
+
+    @firestore.async_transactional
+    async def run(transaction):
+        current = (await user_doc_ref.get(transaction=transaction)).to_dict() or {}
+        rolling_snapshot = await _rolling_ref(user_doc_ref).get(transaction=transaction)
+        return _fill_logged_rollover(transaction, user_doc_ref, current, rolling_snapshot, calories_add, description, today_str)
+
+    return await run(client.transaction())
+
+
+def _fill_logged_rollover(transaction, user_doc_ref, current, rolling_snapshot, calories_add, description, today_str):
+    tracking = current.get("daily_tracking") or {}
+    closed_day = daily_history.close_day(tracking, current.get("diet_settings"), today_str)
+    rolling_stats = None
+    if closed_day is not None:
+        rolling_stats = _fill_rollover_batch(transaction, user_doc_ref, closed_day, rolling_snapshot, today_str)
+    return _fill_calorie_batch(transaction, user_doc_ref, calories_add, description, tracking.get("date"), rolling_stats)
 
 
 # --- Função para buscar ou criar dados do usuário ---
 def get_or_create_user(telegram_user_id, user_name=None):
     """Busca dados do usuário no Firestore ou cria um novo documento se não existir."""
-    if not db:
+    if not init():
         logger.error("Erro: Cliente Firestore não está inicializado.")
         return None
 
@@ -38,96 +614,102 @@ def get_or_create_user(telegram_user_id, user_name=None):
     logger.info(f"Buscando/Criando usuário: {user_id_str}")
 
     try:
+        cached = user_cache.get(user_id_str)
+        if cached is not None:
+            logger.info(f"Usuário {user_id_str} encontrado no cache.")
+            user_data, payload, closed_day = _prepare_existing_user(cached, user_id_str)
+            if closed_day is not None:
+                _save_rollover(db, user_doc_ref, user_data, payload, closed_day)
+                user_cache.put(user_id_str, user_data)
+                return user_data
+            if _save_prepared_user_payload(user_doc_ref, user_id_str, payload) is not None:
+                user_cache.apply(user_id_str, payload, merge=True)
+            return user_data
+
         doc_snapshot = user_doc_ref.get()
 
         if doc_snapshot.exists:
             logger.info(f"Usuário {user_id_str} encontrado no Firestore.")
-            user_data = doc_snapshot.to_dict()
-            # Garante que estruturas aninhadas existam para usuários antigos ou com dados incompletos
-            user_data.setdefault("profile", {})
-            user_data.setdefault("diet_settings", {})
-            user_data.setdefault("daily_tracking", {})
-            user_data.setdefault("user_state", {"awaiting": None})
-
-            # Garante campos padrão dentro das estruturas se ausentes
-            user_data["profile"].setdefault("activity_level", "light")
-            user_data["profile"].setdefault("goal", "maintain")
-            user_data["diet_settings"].setdefault("daily_calorie_goal", None)
-            user_data["diet_settings"].setdefault("diet_type", "standard")
-
-            now_utc = datetime.datetime.now(datetime.timezone.utc)
-            today_str = now_utc.strftime("%Y-%m-%d")
-            if user_data["daily_tracking"].get("date") != today_str:
-                logger.info(
-                    f"Resetando daily_tracking para novo dia ({today_str}) para usuário {user_id_str}."
-                )
-                user_data["daily_tracking"] = {
-                    "date": today_str,
-                    "calories_consumed": 0,
-                    "log_today": [],
-                }
-                user_doc_ref.set(
-                    {
-                        "daily_tracking": user_data["daily_tracking"],
-                        "last_interaction_at": firestore.SERVER_TIMESTAMP,
-                    },
-                    merge=True,
-                )
-            else:
-                user_doc_ref.set(
-                    {"last_interaction_at": firestore.SERVER_TIMESTAMP}, merge=True
-                )
-
+            user_data, payload, closed_day = _prepare_existing_user(doc_snapshot.to_dict(), user_id_str)
+            if closed_day is not None:
+                _save_rollover(db, user_doc_ref, user_data, payload, closed_day)
+                user_cache.put(user_id_str, user_data)
+                return user_data
+            user_cache.put(user_id_str, user_data)
+            _save_prepared_user_payload(user_doc_ref, user_id_str, payload)
             return user_data
         else:
             logger.info(
                 f"Usuário {user_id_str} não encontrado. Criando novo registro..."
             )
-            now_creation = datetime.datetime.now(datetime.timezone.utc)
-            today_str = now_creation.strftime("%Y-%m-%d")
-
-            # --- ESTRUTURA DE DADOS ATUALIZADA PARA NOVO USUÁRIO ---
-            new_user_data = {
-                "telegram_user_id": telegram_user_id,
-                "user_name": user_name if user_name else f"Usuário {user_id_str}",
-                "created_at": firestore.SERVER_TIMESTAMP,
-                "profile": {
-                    "height_cm": None,
-                    "initial_weight_kg": None,  # Pode ser útil no futuro
-                    "current_weight_kg": None,
-                    # "goal_weight_kg": None, # Removido por simplicidade, foco na meta calórica
-                    "birth_year": None,
-                    "gender": None,  # male / female
-                    "activity_level": None,  # sedentary, light, moderate, active, extra_active
-                    "goal": None,  # lose, maintain, gain
-                },
-                "diet_settings": {
-                    "daily_calorie_goal": None,  # Começa como None
-                    "diet_type": "standard",  # Pode ser expandido (low_carb, etc.)
-                    # "intermittent_fasting": { # Removido por simplicidade inicial
-                    #     "enabled": False,
-                    #     "window_start_hour": None,
-                    #     "window_end_hour": None,
-                    # },
-                },
-                "daily_tracking": {
-                    "date": today_str,
-                    "calories_consumed": 0,
-                    "log_today": [],  # Lista de dicionários {description, estimated_kcal, time}
-                },
-                "user_state": {
-                    "awaiting": None  # Indica o que o bot está esperando (None = nada específico)
-                },
-                "last_interaction_at": firestore.SERVER_TIMESTAMP,
-            }
-            # --- FIM DA ESTRUTURA ATUALIZADA ---
-
+            new_user_data = _build_new_user(telegram_user_id, user_name, user_id_str)
             user_doc_ref.set(new_user_data)
+            user_cache.put(user_id_str, new_user_data)
             logger.info(f"Novo usuário {user_id_str} criado com estrutura padrão.")
             # Retorna os dados criados (sem o ID do documento explicitamente, pois já o temos)
             return new_user_data
 
     except Exception as e:
+        user_cache.invalidate(user_id_str)
+        logger.error(
+            f"ERRO CRÍTICO ao acessar Firestore para usuário {user_id_str}: {e}",
+            exc_info=True,
+        )
+        return None
+
+
+async def get_or_create_user_async(telegram_user_id, user_name=None):
+    """Versão assíncrona de get_or_create_user (AsyncClient)."""
+    async_db = get_async_db()
+    if not async_db:
+        logger.error("Erro: Cliente Firestore não está inicializado.")
+        return None
+
+    user_id_str = str(telegram_user_id)
+    user_doc_ref = async_db.collection("users").document(user_id_str)
+    logger.info(f"Buscando/Criando usuário (async): {user_id_str}")
+
+    try:
+        cached = user_cache.get(user_id_str)
+        if cached is not None:
+            logger.info(f"Usuário {user_id_str} encontrado no cache.")
+            user_data, payload, closed_day = _prepare_existing_user(cached, user_id_str)
+            if closed_day is not None:
+                await _save_rollover_async(async_db, user_doc_ref, user_data, payload, closed_day)
+                user_cache.put(user_id_str, user_data)
+                return user_data
+            pending_write = _save_prepared_user_payload(user_doc_ref, user_id_str, payload)
+            if pending_write is not None:
+                await pending_write
+                user_cache.apply(user_id_str, payload, merge=True)
+            return user_data
+
+        doc_snapshot = await user_doc_ref.get()
+
+        if doc_snapshot.exists:
+            logger.info(f"Usuário {user_id_str} encontrado no Firestore.")
+            user_data, payload, closed_day = _prepare_existing_user(doc_snapshot.to_dict(), user_id_str)
+            if closed_day is not None:
+                await _save_rollover_async(async_db, user_doc_ref, user_data, payload, closed_day)
+                user_cache.put(user_id_str, user_data)
+                return user_data
+            user_cache.put(user_id_str, user_data)
+            pending_write = _save_prepared_user_payload(user_doc_ref, user_id_str, payload)
+            if pending_write is not None:
+                await pending_write
+            return user_data
+        else:
+            logger.info(
+                f"Usuário {user_id_str} não encontrado. Criando novo registro..."
+            )
+            new_user_data = _build_new_user(telegram_user_id, user_name, user_id_str)
+            await user_doc_ref.set(new_user_data)
+            user_cache.put(user_id_str, new_user_data)
+            logger.info(f"Novo usuário {user_id_str} criado com estrutura padrão.")
+            return new_user_data
+
+    except Exception as e:
+        user_cache.invalidate(user_id_str)
         logger.error(
             f"ERRO CRÍTICO ao acessar Firestore para usuário {user_id_str}: {e}",
             exc_info=True,
@@ -135,96 +717,218 @@ def get_or_create_user(telegram_user_id, user_name=None):
         return None
 
 
-# --- Função para atualizar calorias (com logging melhorado) ---
+# --- Atualização de campos do usuário (write-through no cache) ---
+def update_user(telegram_user_id, updates):
+    """doc.update(updates) + reflexo no cache. Propaga exceções do Firestore."""
+    user_id_str = str(telegram_user_id)
+    try:
+        init()
+        db.collection("users").document(user_id_str).update(updates)
+    except Exception:
+        user_cache.invalidate(user_id_str)
+        raise
+    user_cache.apply(user_id_str, updates)
+
+
+async def update_user_async(telegram_user_id, updates):
+    """Versão assíncrona de update_user."""
+    user_id_str = str(telegram_user_id)
+    try:
+        await get_async_db().collection("users").document(user_id_str).update(updates)
+    except Exception:
+        user_cache.invalidate(user_id_str)
+        raise
+    user_cache.apply(user_id_str, updates)
+
+
+def save_deferred(telegram_user_id, fields):
+    """Campos de nível superior gravados pelo write-behind (set merge=True), já visíveis no cache.
+
+    Para dados que podem se perder num crash sem prejuízo (ex: memória da conversa).
+    """
+    user_id_str = str(telegram_user_id)
+    touch_flusher.defer(user_id_str, fields)
+    user_cache.apply(user_id_str, fields, merge=True)
+
+
+# --- Função para atualizar calorias (sem transação: incrementos atômicos + log diário) ---
 def update_daily_calories(telegram_user_id, calories_to_add, food_description=""):
     """Adiciona calorias ao total diário do usuário e lida com a troca de dia."""
-    if not db:
+    if not init():
         logger.error(
             "Erro: Cliente Firestore não está inicializado para update_daily_calories."
         )
         return False
     user_id_str = str(telegram_user_id)
     user_doc_ref = db.collection("users").document(user_id_str)
-    logger.info(
-        f"Iniciando transação para adicionar {calories_to_add} kcal para user {user_id_str}."
-    )
+    logger.info(f"Registrando {calories_to_add} kcal para user {user_id_str}.")
 
     try:
-
-        @firestore.transactional
-        def update_in_transaction(transaction, doc_ref, calories_add, description):
-            snapshot = doc_ref.get(transaction=transaction)
+        cached = user_cache.get(user_id_str)
+        if cached is None:
+            snapshot = user_doc_ref.get()
             if not snapshot.exists:
-                logger.warning(
-                    f"Usuário {user_id_str} não encontrado durante transação."
-                )
+                logger.warning(f"Usuário {user_id_str} não encontrado para registro.")
                 return False  # Usuário não existe
+            cached = snapshot.to_dict()
+        tracking_date = cached.get("daily_tracking", {}).get("date")
+        today_str = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d")
 
-            user_data = snapshot.to_dict()
-            daily_tracking = user_data.get("daily_tracking", {})
-            saved_date_str = daily_tracking.get("date")
-            now_utc = datetime.datetime.now(datetime.timezone.utc)
-            today_str = now_utc.strftime("%Y-%m-%d")
+        if tracking_date == today_str:
+            batch = db.batch()
+            user_updates = _fill_calorie_batch(
+                batch, user_doc_ref, calories_to_add, food_description, tracking_date
+            )
+            batch.commit()
+        else:  # Troca de dia que não passou por get_or_create_user
+            user_updates = _log_with_rollover(
+                db, user_doc_ref, calories_to_add, food_description, today_str
+            )
+        for updates in user_updates:
+            user_cache.apply(user_id_str, updates)
+        logger.info(
+            f"Sucesso no registro para {user_id_str}. Calorias adicionadas: {calories_to_add}."
+        )
+        return True
+    except Exception as e:
+        user_cache.invalidate(user_id_str)
+        logger.error(
+            f"ERRO GERAL no registro de calorias para {user_id_str}: {e}", exc_info=True
+        )
+        return False
 
-            log_entry = {
-                "description": description if description else "Registro sem descrição",
-                "estimated_kcal": calories_add,
-                "time": now_utc,  # Usar timestamp do servidor seria mais robusto se a latência for alta
-            }
-            current_log = daily_tracking.get("log_today", [])
-
-            if saved_date_str == today_str:
-                logger.info(f"Mesmo dia ({today_str}). Adicionando calorias.")
-                new_calories = daily_tracking.get("calories_consumed", 0) + calories_add
-                current_log.append(log_entry)
-                transaction.update(
-                    doc_ref,
-                    {
-                        "daily_tracking.calories_consumed": new_calories,
-                        "daily_tracking.log_today": current_log,
-                        "last_interaction_at": firestore.SERVER_TIMESTAMP,
-                    },
-                )
-            else:  # Novo dia
-                logger.info(
-                    f"Novo dia detectado ({today_str}, anterior: {saved_date_str}). Resetando calorias e log."
-                )
-                new_calories = calories_add
-                current_log = [log_entry]
-                transaction.update(
-                    doc_ref,
-                    {
-                        "daily_tracking.date": today_str,
-                        "daily_tracking.calories_consumed": new_calories,
-                        "daily_tracking.log_today": current_log,
-                        "last_interaction_at": firestore.SERVER_TIMESTAMP,
-                    },
-                )
-            logger.info(f"Transação preparada para user {user_id_str}.")
-            return True  # Transação bem sucedida (a ser commitada)
-
-        transaction = db.transaction()
-        update_result = update_in_transaction(
-            transaction, user_doc_ref, calories_to_add, food_description
+
+async def update_daily_calories_async(telegram_user_id, calories_to_add, food_description=""):
+    """Versão assíncrona de update_daily_calories."""
+    async_db = get_async_db()
+    if not async_db:
+        logger.error(
+            "Erro: Cliente Firestore não está inicializado para update_daily_calories."
         )
+        return False
+    user_id_str = str(telegram_user_id)
+    user_doc_ref = async_db.collection("users").document(user_id_str)
+    logger.info(f"Registrando (async) {calories_to_add} kcal para user {user_id_str}.")
 
-        if update_result:
-            logger.info(
-                f"Sucesso na transação de update para {user_id_str}. Calorias adicionadas: {calories_to_add}."
+    try:
+        cached = user_cache.get(user_id_str)
+        if cached is None:
+            snapshot = await user_doc_ref.get()
+            if not snapshot.exists:
+                logger.warning(f"Usuário {user_id_str} não encontrado para registro.")
+                return False
+            cached = snapshot.to_dict()
+        tracking_date = cached.get("daily_tracking", {}).get("date")
+        today_str = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d")
+
+        if tracking_date == today_str:
+            batch = async_db.batch()
+            user_updates = _fill_calorie_batch(
+                batch, user_doc_ref, calories_to_add, food_description, tracking_date
             )
-        else:
-            logger.warning(
-                f"Falha na transação de update para {user_id_str} (usuário não encontrado ou outro erro)."
+            await batch.commit()
+        else:  # Troca de dia que não passou por get_or_create_user
+            user_updates = await _log_with_rollover_async(
+                async_db, user_doc_ref, calories_to_add, food_description, today_str
             )
-        return update_result
+        for updates in user_updates:
+            user_cache.apply(user_id_str, updates)
+        logger.info(
+            f"Sucesso no registro para {user_id_str}. Calorias adicionadas: {calories_to_add}."
+        )
+        return True
     except Exception as e:
+        user_cache.invalidate(user_id_str)
         logger.error(
-            f"ERRO GERAL na transação de update para {user_id_str}: {e}", exc_info=True
+            f"ERRO GERAL no registro de calorias para {user_id_str}: {e}", exc_info=True
         )
         return False
 
 
+# --- Migração: daily_tracking.log_today (array) -> daily_logs/{data}/entries ---
+def migrate_daily_tracking(page_size=200, dry_run=False):
+    """Move os arrays log_today legados para a subcoleção diária, em páginas de usuários.
+
+    Idempotente: usuários sem log_today são ignorados e os registros recebem IDs fixos
+    (legacy-0000, ...), então reexecutar após uma falha não duplica nada. Retorna contadores.
+    """
+    if not init():
+        logger.error("Erro: Cliente Firestore não está inicializado para a migração.")
+        return None
+    stats = {"users_scanned": 0, "users_migrated": 0, "entries_moved": 0}
+    users_ref = db.collection("users")
+    last_snapshot = None
+    while True:
+        query = users_ref.order_by(FieldPath.document_id()).limit(page_size)
+        if last_snapshot is not None:
+            query = query.start_after(last_snapshot)
+        page = list(query.stream())
+        if not page:
+            break
+        for snapshot in page:
+            stats["users_scanned"] += 1
+            daily_tracking = (snapshot.to_dict() or {}).get("daily_tracking") or {}
+            legacy_log = daily_tracking.get("log_today")
+            if legacy_log is None:
+                continue
+            date_str = daily_tracking.get("date") or datetime.datetime.now(
+                datetime.timezone.utc
+            ).strftime("%Y-%m-%d")
+            logger.info(
+                f"[Migração] User {snapshot.id}: {len(legacy_log)} registros de {date_str}."
+            )
+            stats["users_migrated"] += 1
+            stats["entries_moved"] += len(legacy_log)
+            if dry_run:
+                continue
+            day_doc_ref = snapshot.reference.collection("daily_logs").document(date_str)
+            # Um lote por usuário (2 escritas fixas + 1 por registro), dividido se passar do limite
+            for start in range(0, len(legacy_log), BATCH_MAX_WRITES - 2):
+                batch = db.batch()
+                for index in range(start, min(start + BATCH_MAX_WRITES - 2, len(legacy_log))):
+                    batch.set(
+                        day_doc_ref.collection("entries").document(f"legacy-{index:04d}"),
+                        legacy_log[index],
+                    )
+                batch.commit()
+            batch = db.batch()
+            batch.set(
+                day_doc_ref,
+                {
+                    "date": date_str,
+                    "calories_consumed": daily_tracking.get("calories_consumed", 0),
+                    "entry_count": len(legacy_log),
+                    "updated_at": firestore.SERVER_TIMESTAMP,
+                },
+                merge=True,
+            )
+            batch.update(snapshot.reference, {"daily_tracking.log_today": firestore.DELETE_FIELD})
+            batch.commit()
+            user_cache.invalidate(snapshot.id)
+        last_snapshot = page[-1]
+    logger.info(f"[Migração] Concluída{' (dry-run)' if dry_run else ''}: {stats}")
+    return stats
+
+
 # --- FUNÇÕES DE CÁLCULO (com logging) ---
+# Tabelas e política de meta; goal_batch (versão vetorizada) usa as mesmas constantes
+ACTIVITY_MULTIPLIERS = {
+    "sedentary": 1.2,
+    "light": 1.375,
+    "moderate": 1.55,
+    "active": 1.725,
+    "extra_active": 1.9,
+}
+# Déficit entre 15-25% do TDEE, com mínimo de 300 e máximo de 750, sem baixar de 1200 kcal
+LOSE_DEFICIT_RATIO = 0.20
+LOSE_DEFICIT_MIN, LOSE_DEFICIT_MAX = 300, 750
+LOSE_GOAL_FLOOR = 1200
+# Superávit entre 10-20% do TDEE, com mínimo de 250 e máximo de 500
+GAIN_SURPLUS_RATIO = 0.15
+GAIN_SURPLUS_MIN, GAIN_SURPLUS_MAX = 250, 500
+GOAL_ROUNDING = 50  # Meta arredondada para o múltiplo mais próximo
+
+
 def calculate_age(birth_year):
     if not birth_year:
         logger.warning("[Cálculo Idade] Ano de nascimento ausente.")
@@ -270,7 +974,7 @@ def calculate_bmr_mifflin(weight_kg, height_cm, age, gender):
             logger.warning(f"[Cálculo BMR] Gênero inválido fornecido: {gender}")
             return None
         result = round(bmr)
-        logger.info(
+        logger.debug(
             f"[Cálculo BMR] Sucesso: Peso={weight_kg_f}, Altura={height_cm_f}, Idade={age_int}, Gênero={gender_processed} -> BMR={result}"
         )
         return result
@@ -290,13 +994,7 @@ def calculate_tdee(bmr, activity_level):
             f"[Cálculo TDEE] BMR ({bmr}) ou Nível de Atividade ({activity_level}) ausente."
         )
         return None
-    multipliers = {
-        "sedentary": 1.2,
-        "light": 1.375,
-        "moderate": 1.55,
-        "active": 1.725,
-        "extra_active": 1.9,
-    }
+    multipliers = ACTIVITY_MULTIPLIERS
     activity_level_processed = str(activity_level).lower().strip()
     multiplier = multipliers.get(activity_level_processed)
 
@@ -308,7 +1006,7 @@ def calculate_tdee(bmr, activity_level):
     try:
         bmr_f = float(bmr)
         tdee = round(bmr_f * multiplier)
-        logger.info(
+        logger.debug(
             f"[Cálculo TDEE] Sucesso: BMR={bmr_f}, Nível={activity_level_processed}, Multiplicador={multiplier} -> TDEE={tdee}"
         )
         return tdee
@@ -332,30 +1030,28 @@ def suggest_calorie_goal(tdee, goal):
         suggested_goal = tdee_f  # Default para manter
 
         if goal_processed == "lose":
-            # Déficit entre 15-25% do TDEE, com mínimo de 300 e máximo de 750, sem baixar de 1200 kcal
-            deficit = min(750, max(300, round(tdee_f * 0.20)))
-            suggested_goal = max(1200, tdee_f - deficit)
-            logger.info(
+            deficit = min(LOSE_DEFICIT_MAX, max(LOSE_DEFICIT_MIN, round(tdee_f * LOSE_DEFICIT_RATIO)))
+            suggested_goal = max(LOSE_GOAL_FLOOR, tdee_f - deficit)
+            logger.debug(
                 f"[Sugestão Meta] Objetivo 'perder'. TDEE={tdee_f}, Déficit={deficit}"
             )
         elif goal_processed == "gain":
-            # Superávit entre 10-20% do TDEE, com mínimo de 250 e máximo de 500
-            surplus = min(500, max(250, round(tdee_f * 0.15)))
+            surplus = min(GAIN_SURPLUS_MAX, max(GAIN_SURPLUS_MIN, round(tdee_f * GAIN_SURPLUS_RATIO)))
             suggested_goal = tdee_f + surplus
-            logger.info(
+            logger.debug(
                 f"[Sugestão Meta] Objetivo 'ganhar'. TDEE={tdee_f}, Superávit={surplus}"
             )
         elif goal_processed == "maintain":
-            logger.info(f"[Sugestão Meta] Objetivo 'manter'. TDEE={tdee_f}")
+            logger.debug(f"[Sugestão Meta] Objetivo 'manter'. TDEE={tdee_f}")
         else:
             logger.warning(
                 f"[Sugestão Meta] Objetivo inválido: '{goal}'. Válidos: lose, maintain, gain"
             )
             return None
 
-        # Arredonda para o múltiplo de 50 mais próximo
-        final_goal = round(suggested_goal / 50) * 50
-        logger.info(
+        # Arredonda para o múltiplo de GOAL_ROUNDING mais próximo
+        final_goal = round(suggested_goal / GOAL_ROUNDING) * GOAL_ROUNDING
+        logger.debug(
             f"[Sugestão Meta] Meta sugerida: {final_goal} kcal (arredondado de {suggested_goal:.2f})"
         )
         return final_goal
@@ -369,9 +1065,53 @@ def suggest_calorie_goal(tdee, goal):
         return None
 
 
+# --- Métricas derivadas memorizadas no perfil ---
+# profile.derived = {inputs, year, age, bmr, tdee, suggested_goal}. Vale enquanto os campos de
+# entrada (e o ano, por causa da idade) forem os mesmos; qualquer mudança invalida sozinha.
+DERIVED_INPUT_FIELDS = ("birth_year", "gender", "height_cm", "current_weight_kg", "activity_level", "goal")
+
+
+def derived_inputs_key(profile):
+    return "|".join(str(profile.get(field)) for field in DERIVED_INPUT_FIELDS)
+
+
+def compute_derived_metrics(profile):
+    """Cadeia idade -> BMR -> TDEE -> meta sugerida (valores None onde a cadeia parou)."""
+    age = calculate_age(profile.get("birth_year"))
+    bmr = calculate_bmr_mifflin(profile.get("current_weight_kg"), profile.get("height_cm"), age, profile.get("gender"))
+    tdee = calculate_tdee(bmr, profile.get("activity_level"))
+    return {
+        "inputs": derived_inputs_key(profile),
+        "year": datetime.datetime.now(datetime.timezone.utc).year,
+        "age": age,
+        "bmr": bmr,
+        "tdee": tdee,
+        "suggested_goal": suggest_calorie_goal(tdee, profile.get("goal")),
+    }
+
+
+def get_derived_metrics(profile, any_year=False):
+    """profile.derived se ainda vale para as entradas atuais; senão recalcula.
+
+    any_year=True aceita valores de um ano anterior (ex: confirmar a meta já mostrada ao usuário).
+    Retorna (derived, memorizado?).
+    """
+    derived = profile.get("derived")
+    if (
+        isinstance(derived, dict)
+        and derived.get("inputs") == derived_inputs_key(profile)
+        and (any_year or derived.get("year") == datetime.datetime.now(datetime.timezone.utc).year)
+    ):
+        logger.debug(f"[Derivados] Reaproveitados: {derived}")
+        return derived, True
+    derived = compute_derived_metrics(profile)
+    logger.debug(f"[Derivados] Recalculados: {derived}")
+    return derived, False
+
+
 # --- Bloco de Teste ---
 if __name__ == "__main__":
-    if db:
+    if init():
         logger.info("\n--- INICIANDO TESTE DE FIRESTORE_MANAGER (v4) ---")
         test_user_id = 999999997  # ID para testar criação/leitura
         test_user_name = "Usuário Teste Firestore v4"
@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: food_db.py (v1 - Tabela de alimentos local com índice de trigramas)
+
+import array
+import bisect
+import csv
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+
+from text_utils import normalize_text
+
+logger = logging.getLogger(__name__)
+
+# --- Configurações ---
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CSV_PATH = os.environ.get("FOOD_TABLE_CSV_PATH", os.path.join(_BASE_DIR, "food_table.csv"))
+# Arquivo binário gerado a partir do CSV (recompilado quando o CSV for mais novo)
+BIN_PATH = os.environ.get("FOOD_TABLE_BIN_PATH", os.path.join(_BASE_DIR, "food_table.bin"))
+MIN_MATCH_SCORE = float(os.environ.get("FOOD_MATCH_MIN_SCORE", "0.6"))  # Dice de trigramas
+
+# Formato do binário: cabeçalho + arrays de 4 bytes (ordem nativa) + blob de strings UTF-8
+_MAGIC = b"CALOFDB1"
+_HEADER = struct.Struct("=8sBIIII")  # magic, byteorder, n_foods, n_entries, n_trigrams, n_postings
+_BYTEORDER = 1 if sys.byteorder == "little" else 2
+
+_CLEAN_RE = re.compile(r"[^a-z0-9]+")
+_TOKEN_RE = re.compile(r"\d+(?:\.\d+)?(?:/\d+)?[a-z]*|[a-z0-9]+")
+_NUMBER_UNIT_RE = re.compile(r"^(\d+(?:\.\d+)?)(g|gr|kg|ml|l)$")
+_NUMBER_RE = re.compile(r"^\d+(?:\.\d+)?$")
+_FRACTION_RE = re.compile(r"^(\d+)/(\d+)$")
+_SPLIT_ITEMS_RE = re.compile(r"\s*,\s*|\s+e\s+")
+
+NUMBER_WORDS = {
+    "um": 1, "uma": 1, "dois": 2, "duas": 2, "tres": 3, "quatro": 4, "cinco": 5,
+    "seis": 6, "sete": 7, "oito": 8, "nove": 9, "dez": 10, "meio": 0.5, "meia": 0.5,
+}
+# Unidades de massa/volume (ml conta como g: boa aproximação para bebidas)
+UNIT_GRAMS = {"g": 1, "gr": 1, "grama": 1, "kg": 1000, "quilo": 1000, "ml": 1, "l": 1000, "litro": 1000}
+# Medidas caseiras; None = usar a porção típica do alimento
+MEASURE_GRAMS = {
+    "colher de cha": 5, "colher de sopa": 15, "colher de servir": 45, "colher": 15, "concha": 86,
+    "xicara": None, "copo": None, "lata": None, "fatia": None, "unidade": None, "un": None,
+    "pedaco": None, "porcao": None, "prato": None, "pote": None, "tigela": None,
+}
+_MEASURES_BY_LENGTH = sorted(((m.split(), g) for m, g in MEASURE_GRAMS.items()), key=lambda mg: -len(mg[0]))
+_CONNECTORS = {"de", "do", "da"}
+# Palavras que não precisam aparecer no nome do alimento para a busca aceitar o candidato
+_STOPWORDS = {"a", "ao", "com", "da", "de", "do", "e", "em", "na", "no", "o"}
+TOKEN_MATCH_SCORE = 0.6  # Dice mínimo entre uma palavra da busca e uma do nome ("strogonof" ~ "strogonoff")
+
+
+def _singular(token):
+    """Plural -> singular aproximado, o suficiente para casar 'pães' com 'pão' e 'ovos' com 'ovo'."""
+    if len(token) <= 3:
+        return token
+    if token.endswith(("oes", "aes")):
+        return token[:-3] + "ao"
+    if token.endswith(("res", "zes")):
+        return token[:-2]
+    if token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+
+def food_key(text):
+    """Chave de busca: sem acentos, só [a-z0-9], tokens no singular ('Pães de Queijo' -> 'pao de queijo')."""
+    return " ".join(_singular(t) for t in _CLEAN_RE.sub(" ", normalize_text(text)).split())
+
+
+def _trigram_codes(key):
+    padded = f" {key} "
+    return {_trigram_code(padded[i : i + 3]) for i in range(len(padded) - 2)}
+
+
+def _trigram_code(trigram):
+    # [a-z0-9 ] cabe em base 37: cada trigrama vira um inteiro (ordenável no binário)
+    code = 0
+    for c in trigram:
+        code = code * 37 + (0 if c == " " else (ord(c) - 96 if c.isalpha() else 27 + ord(c) - 48))
+    return code
+
+
+def _dice(a, b):
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+def _covers(query_key, candidate_key):
+    """Toda palavra relevante da busca precisa casar com alguma do candidato.
+
+    Evita aceitar 'tapioca de frango' como 'coxa de frango' só porque os trigramas se parecem.
+    """
+    candidate = [_trigram_codes(t) for t in candidate_key.split()]
+    for token in query_key.split():
+        if token in _STOPWORDS:
+            continue
+        codes = _trigram_codes(token)
+        if not any(_dice(codes, c) >= TOKEN_MATCH_SCORE for c in candidate):
+            return False
+    return True
+
+
+def build_food_db(csv_path=CSV_PATH):
+    """Compila o CSV (nome;kcal_100g;porcao_g;apelidos) no formato binário; retorna os bytes."""
+    names, kcals, portions, entries = [], [], [], []
+    with open(csv_path, encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f, delimiter=";"):
+            food_id = len(names)
+            names.append(row["nome"].strip())
+            kcals.append(float(row["kcal_100g"]))
+            portions.append(float(row["porcao_g"]))
+            aliases = [a for a in (row.get("apelidos") or "").split("|") if a.strip()]
+            for key in dict.fromkeys(food_key(n) for n in [row["nome"], *aliases]):
+                entries.append((key, food_id))
+
+    postings_by_code = {}
+    for entry_id, (key, _) in enumerate(entries):
+        for code in _trigram_codes(key):
+            postings_by_code.setdefault(code, []).append(entry_id)
+    codes = sorted(postings_by_code)
+    tri_offsets, postings = array.array("I", [0]), array.array("I")
+    for code in codes:
+        postings.extend(postings_by_code[code])
+        tri_offsets.append(len(postings))
+
+    blob = bytearray()
+    name_offsets, key_offsets = array.array("I", [0]), array.array("I", [0])
+    for text, offsets in [(n, name_offsets) for n in names] + [(k, key_offsets) for k, _ in entries]:
+        blob += text.encode("utf-8")
+        offsets.append(len(blob))
+
+    parts = [
+        _HEADER.pack(_MAGIC, _BYTEORDER, len(names), len(entries), len(codes), len(postings)),
+        array.array("f", kcals),
+        array.array("f", portions),
+        array.array("I", [food_id for _, food_id in entries]),
+        array.array("I", [len(_trigram_codes(key)) for key, _ in entries]),
+        array.array("I", codes),
+        tri_offsets,
+        postings,
+        name_offsets,
+        key_offsets,
+    ]
+    out = bytearray()
+    for part in parts:
+        out += part.tobytes() if isinstance(part, array.array) else part
+        out += b"\0" * (-len(out) % 4)  # mantém os arrays alinhados em 4 bytes
+    return bytes(out + blob)
+
+
+class FoodDatabase:
+    """Tabela de alimentos sobre um buffer (mmap ou bytes), sem copiar os arrays para objetos Python."""
+
+    def __init__(self, buffer):
+        self._buffer = buffer
+        view = memoryview(buffer)
+        magic, byteorder, n_foods, n_entries, n_trigrams, n_postings = _HEADER.unpack_from(view, 0)
+        if magic != _MAGIC or byteorder != _BYTEORDER:
+            raise ValueError("Formato da tabela de alimentos inválido ou de outra arquitetura")
+        self._views = []
+        pos = _HEADER.size + (-_HEADER.size % 4)
+
+        def take(fmt, count):
+            nonlocal pos
+            v = view[pos : pos + 4 * count].cast(fmt)
+            self._views.append(v)
+            pos += 4 * count
+            return v
+
+        self.kcal_100g = take("f", n_foods)
+        self.portion_g = take("f", n_foods)
+        self._entry_food = take("I", n_entries)
+        self._entry_ntri = take("I", n_entries)
+        self._tri_codes = take("I", n_trigrams)
+        self._tri_offsets = take("I", n_trigrams + 1)
+        self._postings = take("I", n_postings)
+        self._name_offsets = take("I", n_foods + 1)
+        self._key_offsets = take("I", n_entries + 1)
+        self._blob = view[pos:]
+        self._views += [self._blob, view]
+        self._keys = None  # índice exato chave -> entrada, montado no primeiro uso
+
+    @classmethod
+    def open(cls, path):
+        with open(path, "rb") as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __len__(self):
+        return len(self.kcal_100g)
+
+    def close(self):
+        for v in self._views:
+            v.release()
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+
+    def _string(self, offsets, i):
+        return bytes(self._blob[offsets[i] : offsets[i + 1]]).decode("utf-8")
+
+    def name(self, food_id):
+        return self._string(self._name_offsets, food_id)
+
+    def _food(self, food_id, score):
+        return {
+            "food_id": food_id,
+            "name": self.name(food_id),
+            "kcal_100g": self.kcal_100g[food_id],
+            "portion_g": self.portion_g[food_id],
+            "score": score,
+        }
+
+    def lookup(self, text, min_score=None):
+        """Busca aproximada (Dice de trigramas). Retorna dict do alimento ou None."""
+        key = food_key(text)
+        if not key:
+            return None
+        if self._keys is None:
+            self._keys = {self._string(self._key_offsets, i): i for i in range(len(self._entry_food))}
+        entry_id = self._keys.get(key)
+        if entry_id is not None:
+            return self._food(self._entry_food[entry_id], 1.0)
+
+        query = _trigram_codes(key)
+        shared = {}
+        for code in query:
+            i = bisect.bisect_left(self._tri_codes, code)
+            if i < len(self._tri_codes) and self._tri_codes[i] == code:
+                for p in range(self._tri_offsets[i], self._tri_offsets[i + 1]):
+                    entry_id = self._postings[p]
+                    shared[entry_id] = shared.get(entry_id, 0) + 1
+        min_score = MIN_MATCH_SCORE if min_score is None else min_score
+        scored = sorted(
+            ((2 * count / (len(query) + self._entry_ntri[entry_id]), entry_id) for entry_id, count in shared.items()),
+            reverse=True,
+        )
+        for score, entry_id in scored:
+            if score < min_score:
+                break
+            if _covers(key, self._string(self._key_offsets, entry_id)):
+                return self._food(self._entry_food[entry_id], score)
+        return None
+
+
+def parse_quantity(text):
+    """Separa quantidade e alimento: '2 pães de queijo' -> (2, None, None, 'paes de queijo').
+
+    Retorna (contagem, gramas_por_medida, gramas_absolutas, resto); os campos ausentes vêm None.
+    """
+    tokens = _TOKEN_RE.findall(normalize_text(text).replace(",", "."))
+    count = grams = measure_grams = None
+    if tokens:
+        first = tokens[0]
+        unit_match = _NUMBER_UNIT_RE.match(first)
+        fraction = _FRACTION_RE.match(first)
+        if unit_match:
+            grams = float(unit_match.group(1)) * UNIT_GRAMS[unit_match.group(2)]
+            tokens = tokens[1:]
+        elif fraction and int(fraction.group(2)):
+            count = int(fraction.group(1)) / int(fraction.group(2))
+            tokens = tokens[1:]
+        elif _NUMBER_RE.match(first):
+            count = float(first)
+            tokens = tokens[1:]
+        elif first in NUMBER_WORDS:
+            count = NUMBER_WORDS[first]
+            tokens = tokens[1:]
+    if count is not None and tokens and _singular(tokens[0]) in UNIT_GRAMS:
+        grams = count * UNIT_GRAMS[_singular(tokens[0])]
+        count, tokens = None, tokens[1:]
+    singular = [_singular(t) for t in tokens]
+    for measure, measure_g in _MEASURES_BY_LENGTH:
+        if singular[: len(measure)] == measure:
+            measure_grams = measure_g
+            tokens = tokens[len(measure) :]
+            count = 1 if count is None else count
+            break
+    while tokens and tokens[0] in _CONNECTORS:
+        tokens = tokens[1:]
+    # Quantidade no fim também vale ("açaí 500ml")
+    unit_match = _NUMBER_UNIT_RE.match(tokens[-1]) if tokens and grams is None else None
+    if unit_match:
+        grams = float(unit_match.group(1)) * UNIT_GRAMS[unit_match.group(2)] * (count or 1)
+        count, tokens = None, tokens[:-1]
+    return count, measure_grams, grams, " ".join(tokens)
+
+
+def _price_one(db, text, quantity=None):
+    count, measure_g, grams, rest = parse_quantity(text)
+    if quantity is not None and count is None and grams is None:
+        count, measure_g, grams, _ = parse_quantity(str(quantity))
+    food = db.lookup(rest or text)
+    if not food:
+        return None
+    if grams is None:
+        grams = (count or 1) * (measure_g or food["portion_g"])
+    food["query"] = str(text)
+    food["grams"] = round(grams, 1)
+    food["kcal"] = round(grams * food["kcal_100g"] / 100, 1)
+    return food
+
+
+def price_items(food_items, quantity=None, db=None):
+    """Calcula as kcal dos itens da NLU pela tabela local.
+
+    Retorna {"items": [...], "unknown": [...], "total_kcal": float}; os itens desconhecidos
+    ficam para o modelo estimar.
+    """
+    db = db or get_food_db()
+    if isinstance(food_items, str):
+        food_items = [food_items]
+    food_items = [str(i) for i in (food_items or []) if str(i).strip()]
+    quantities = quantity if isinstance(quantity, list) and len(quantity) == len(food_items) else None
+    if quantities is None:
+        # Quantidade solta só vale quando há um único item
+        quantities = [quantity if len(food_items) == 1 and not isinstance(quantity, list) else None] * len(food_items)
+
+    items, unknown = [], []
+    for text, qty in zip(food_items, quantities):
+        priced = _price_one(db, text, qty)
+        if priced:
+            items.append(priced)
+            continue
+        parts = [p for p in _SPLIT_ITEMS_RE.split(text) if p.strip()]
+        if len(parts) < 2:
+            unknown.append(text)
+            continue
+        for part in parts:
+            priced = _price_one(db, part)
+            if priced:
+                items.append(priced)
+            else:
+                unknown.append(part)
+    return {"items": items, "unknown": unknown, "total_kcal": round(sum(i["kcal"] for i in items), 1)}
+
+
+_db = None
+_db_lock = threading.Lock()
+
+
+def load_food_db(csv_path=CSV_PATH, bin_path=BIN_PATH):
+    """Abre o binário via mmap, recompilando-o se não existir ou se o CSV for mais novo."""
+    try:
+        stale = not os.path.exists(bin_path) or os.path.getmtime(bin_path) < os.path.getmtime(csv_path)
+    except OSError:
+        stale = not os.path.exists(bin_path)
+    if not stale:
+        try:
+            return FoodDatabase.open(bin_path)
+        except (OSError, ValueError) as e:
+            logger.warning(f"[Food DB] Binário inválido ({e}); recompilando.")
+    data = build_food_db(csv_path)
+    try:
+        tmp_path = f"{bin_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, bin_path)
+        logger.info(f"[Food DB] Tabela compilada em {bin_path}.")
+        return FoodDatabase.open(bin_path)
+    except OSError as e:
+        logger.warning(f"[Food DB] Não foi possível gravar {bin_path} ({e}); usando tabela em memória.")
+        return FoodDatabase(data)
+
+
+def get_food_db():
+    global _db
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                _db = load_food_db()
+                logger.info(f"[Food DB] {len(_db)} alimentos carregados.")
+    return _db
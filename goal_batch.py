@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: goal_batch.py (v3 - Paginação por FieldPath de firestore_v1 (não exportado em google.cloud.firestore))
+#
+# Uso: python goal_batch.py [--dry-run] [--backfill-unmarked] [--page-size N] [--year AAAA]
+# Versões NumPy de calculate_age, calculate_bmr_mifflin, calculate_tdee e suggest_calorie_goal
+# (firestore_manager): recebem colunas (um valor por usuário) e devolvem (valores, máscara de
+# válidos), com os mesmos resultados bit a bit das escalares para toda entrada que elas aceitam.
+# recompute_goals percorre users em páginas, recalcula e grava só as metas que mudaram, em lotes.
+# Usado quando muda a política de déficit/superávit ou na virada do ano (idades).
+
+import argparse
+import datetime
+import logging
+
+import numpy as np
+from google.cloud.firestore_v1.field_path import FieldPath
+
+import firestore_manager
+from firestore_manager import (
+    ACTIVITY_MULTIPLIERS,
+    GAIN_SURPLUS_MAX,
+    GAIN_SURPLUS_MIN,
+    GAIN_SURPLUS_RATIO,
+    GOAL_ROUNDING,
+    LOSE_DEFICIT_MAX,
+    LOSE_DEFICIT_MIN,
+    LOSE_DEFICIT_RATIO,
+    LOSE_GOAL_FLOOR,
+)
+
+logger = logging.getLogger(__name__)
+
+GENDER_CODES = {"male": 1, "female": 2}  # 0 = inválido
+GOAL_CODES = {"lose": 1, "maintain": 2, "gain": 3}
+# Acima disso o float64 deixa de representar inteiros exatos (as escalares devolveriam int enorme)
+_EXACT_LIMIT = 2.0**53
+
+
+def _int_or_none(value):
+    """Mesma coerção de calculate_age: falsy ou int() inválido -> None."""
+    if not value:
+        return None
+    try:
+        return int(value)
+    except (ValueError, TypeError, OverflowError):
+        return None
+
+
+def _float_or_nan(value):
+    """Mesma coerção de calculate_bmr_mifflin (float()); None/inválido -> nan."""
+    if value is None:
+        return np.nan
+    try:
+        return float(value)
+    except (ValueError, TypeError, OverflowError):
+        return np.nan
+
+
+def _code(value, codes):
+    return codes.get(str(value).lower().strip(), 0) if value is not None else 0
+
+
+def profile_columns(profiles):
+    """Lista de dicts profile -> colunas NumPy (a normalização de texto acontece só aqui)."""
+    birth_year = [_int_or_none(p.get("birth_year")) for p in profiles]
+    return {
+        "birth_year": np.array([b if b is not None else 0 for b in birth_year], dtype=np.int64),
+        "birth_year_ok": np.array([b is not None for b in birth_year], dtype=bool),
+        "weight_kg": np.array([_float_or_nan(p.get("current_weight_kg")) for p in profiles], dtype=np.float64),
+        "height_cm": np.array([_float_or_nan(p.get("height_cm")) for p in profiles], dtype=np.float64),
+        "gender": np.array([_code(p.get("gender"), GENDER_CODES) for p in profiles], dtype=np.int8),
+        "activity_multiplier": np.array(
+            [ACTIVITY_MULTIPLIERS.get(str(p.get("activity_level")).lower().strip(), np.nan)
+             if p.get("activity_level") is not None else np.nan for p in profiles],
+            dtype=np.float64,
+        ),
+        "goal": np.array([_code(p.get("goal"), GOAL_CODES) for p in profiles], dtype=np.int8),
+    }
+
+
+def _to_int(values, valid):
+    """rint (meia-para-par, igual ao round() do Python) -> int64, invalidando não finitos/enormes."""
+    valid = valid & np.isfinite(values) & (np.abs(values) < _EXACT_LIMIT)
+    return np.where(valid, np.rint(np.where(valid, values, 0.0)), 0.0).astype(np.int64), valid
+
+
+def ages(birth_year, birth_year_ok, this_year=None):
+    if this_year is None:
+        this_year = datetime.datetime.now(datetime.timezone.utc).year
+    age = this_year - birth_year
+    return age, birth_year_ok & (age > 0) & (age < 120)
+
+
+def bmr_mifflin(weight_kg, height_cm, age, age_ok, gender):
+    # Mesma ordem de operações da escalar: ((10*peso + 6.25*altura) - 5*idade) +/- constante
+    base = (10 * weight_kg) + (6.25 * height_cm) - (5 * age.astype(np.float64))
+    bmr = np.where(gender == GENDER_CODES["male"], base + 5, base - 161)
+    return _to_int(bmr, age_ok & (gender != 0))
+
+
+def tdee(bmr, bmr_ok, activity_multiplier):
+    return _to_int(bmr.astype(np.float64) * activity_multiplier, bmr_ok & ~np.isnan(activity_multiplier))
+
+
+def suggest_goal(tdee_values, tdee_ok, goal):
+    tdee_f = tdee_values.astype(np.float64)
+    deficit = np.clip(np.rint(tdee_f * LOSE_DEFICIT_RATIO), LOSE_DEFICIT_MIN, LOSE_DEFICIT_MAX)
+    surplus = np.clip(np.rint(tdee_f * GAIN_SURPLUS_RATIO), GAIN_SURPLUS_MIN, GAIN_SURPLUS_MAX)
+    suggested = np.select(
+        [goal == GOAL_CODES["lose"], goal == GOAL_CODES["gain"]],
+        [np.maximum(LOSE_GOAL_FLOOR, tdee_f - deficit), tdee_f + surplus],
+        default=tdee_f,
+    )
+    rounded, valid = _to_int(suggested / GOAL_ROUNDING, tdee_ok & (goal != 0))
+    return rounded * GOAL_ROUNDING, valid
+
+
+def compute(columns, this_year=None):
+    """Cadeia completa idade -> BMR -> TDEE -> meta. Cada etapa traz sua máscara de válidos."""
+    age, age_ok = ages(columns["birth_year"], columns["birth_year_ok"], this_year)
+    bmr, bmr_ok = bmr_mifflin(columns["weight_kg"], columns["height_cm"], age, age_ok, columns["gender"])
+    tdee_values, tdee_ok = tdee(bmr, bmr_ok, columns["activity_multiplier"])
+    goal, goal_ok = suggest_goal(tdee_values, tdee_ok, columns["goal"])
+    return {
+        "age": age, "age_ok": age_ok,
+        "bmr": bmr, "bmr_ok": bmr_ok,
+        "tdee": tdee_values, "tdee_ok": tdee_ok,
+        "goal_kcal": goal, "goal_ok": goal_ok,
+    }
+
+
+def recompute_goals(page_size=500, dry_run=False, this_year=None, backfill_unmarked=False):
+    """Recalcula daily_calorie_goal dos usuários com meta sugerida e grava só as que mudaram.
+
+    Só entra quem tem diet_settings.goal_source == 'suggested'. Metas próprias ('custom') e
+    documentos anteriores ao campo (meta sem goal_source) nunca são recalculados: os sem marca são
+    contados em users_unmarked. Com backfill_unmarked, os sem marca cuja meta é exatamente a que
+    a política atual sugere recebem goal_source = 'suggested' (a meta não muda); os demais podem
+    ser metas digitadas e continuam sem marca. Idempotente: reexecutar não gera novas escritas.
+    Retorna contadores (ou None sem Firestore).
+    """
+    if not firestore_manager.init():
+        logger.error("Erro: Cliente Firestore não está inicializado para o recálculo de metas.")
+        return None
+    db = firestore_manager.db
+    stats = {
+        "users_scanned": 0, "users_eligible": 0, "users_invalid": 0, "goals_changed": 0,
+        "users_unmarked": 0, "unmarked_backfilled": 0, "batches": 0,
+    }
+    users_ref = db.collection("users")
+    last_snapshot = None
+    while True:
+        query = users_ref.order_by(FieldPath.document_id()).limit(page_size)
+        if last_snapshot is not None:
+            query = query.start_after(last_snapshot)
+        page = list(query.stream())
+        if not page:
+            break
+        docs = [snapshot.to_dict() or {} for snapshot in page]
+        settings = [doc.get("diet_settings") or {} for doc in docs]
+        has_goal = np.array([s.get("daily_calorie_goal") is not None for s in settings], dtype=bool)
+        source = [s.get("goal_source") for s in settings]
+        eligible = has_goal & np.array([value == "suggested" for value in source], dtype=bool)
+        unmarked = has_goal & np.array([value is None for value in source], dtype=bool)
+        current = np.array([_float_or_nan(s.get("daily_calorie_goal")) for s in settings], dtype=np.float64)
+        result = compute(profile_columns([doc.get("profile") or {} for doc in docs]), this_year)
+        changed = np.flatnonzero(eligible & result["goal_ok"] & (current != result["goal_kcal"]))
+        backfill = np.flatnonzero(unmarked & result["goal_ok"] & (current == result["goal_kcal"])) if backfill_unmarked else changed[:0]
+        stats["users_scanned"] += len(page)
+        stats["users_eligible"] += int(eligible.sum())
+        stats["users_invalid"] += int((eligible & ~result["goal_ok"]).sum())
+        stats["goals_changed"] += len(changed)
+        stats["users_unmarked"] += int(unmarked.sum())
+        stats["unmarked_backfilled"] += len(backfill)
+        if not dry_run:
+            writes = [(index, {"diet_settings.daily_calorie_goal": int(result["goal_kcal"][index])}) for index in changed]
+            writes += [(index, {"diet_settings.goal_source": "suggested"}) for index in backfill]
+            for start in range(0, len(writes), firestore_manager.BATCH_MAX_WRITES):
+                batch = db.batch()
+                chunk = writes[start:start + firestore_manager.BATCH_MAX_WRITES]
+                for index, fields in chunk:
+                    batch.update(page[index].reference, fields)
+                batch.commit()
+                stats["batches"] += 1
+                for index, _ in chunk:
+                    firestore_manager.user_cache.invalidate(page[index].id)
+        logger.info(
+            f"[Metas] Página até {page[-1].id}: {len(changed)} metas alteradas, {len(backfill)} marcadas. Parcial: {stats}"
+        )
+        last_snapshot = page[-1]
+    logger.info(f"[Metas] Concluído{' (dry-run)' if dry_run else ''}: {stats}")
+    return stats
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Recalcula as metas calóricas sugeridas de todos os usuários.")
+    parser.add_argument("--dry-run", action="store_true", help="Só conta, não grava.")
+    parser.add_argument(
+        "--backfill-unmarked", action="store_true",
+        help="Marca como 'suggested' as metas sem goal_source iguais à sugestão atual (sem mudar a meta).",
+    )
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--year", type=int, help="Ano de referência das idades (padrão: ano atual UTC).")
+    args = parser.parse_args()
+
+    stats = recompute_goals(
+        page_size=args.page_size, dry_run=args.dry_run, this_year=args.year, backfill_unmarked=args.backfill_unmarked
+    )
+    if stats is None:
+        logger.critical("Recálculo não executado: Firestore indisponível.")
+        return
+    logger.info(f"Resultado do recálculo: {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: http_server.py (v1 - Servidor HTTP assíncrono mínimo para webhook e health checks)
+
+import asyncio
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_BYTES = 1024 * 1024  # Updates do Telegram são pequenos; protege contra corpos enormes
+KEEP_ALIVE_SECONDS = 75  # Tempo ocioso máximo de uma conexão reaproveitada
+_REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 403: "Forbidden", 404: "Not Found",
+            405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error",
+            503: "Service Unavailable"}
+
+
+class Request:
+    def __init__(self, method, path, query, headers, body):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers  # nomes em minúsculas
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body.decode("utf-8"))
+
+
+def text_response(status, text, content_type="text/plain; charset=utf-8"):
+    return status, {"Content-Type": content_type}, text.encode("utf-8")
+
+
+def json_response(status, data):
+    return status, {"Content-Type": "application/json"}, json.dumps(data, ensure_ascii=False).encode("utf-8")
+
+
+class HTTPServer:
+    """HTTP/1.1 sobre asyncio.start_server, só com o necessário para o bot (sem dependências extras).
+
+    routes: {(método, caminho): async handler(Request) -> (status, headers, body_bytes)}.
+    """
+
+    def __init__(self, routes=None):
+        self.routes = dict(routes or {})
+        self._server = None
+
+    def add_route(self, method, path, handler):
+        self.routes[(method.upper(), path)] = handler
+
+    async def start(self, host="0.0.0.0", port=8080):
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        logger.info(f"[HTTP] Escutando em {host}:{port} ({len(self.routes)} rotas).")
+        return self._server
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+            logger.info("[HTTP] Servidor parado.")
+
+    async def _read_request(self, reader):
+        request_line = await asyncio.wait_for(reader.readline(), timeout=KEEP_ALIVE_SECONDS)
+        if not request_line:
+            return None
+        try:
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            raise ValueError("Linha de requisição inválida")
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length") or 0)
+        if length > MAX_BODY_BYTES:
+            raise OverflowError(length)
+        body = await reader.readexactly(length) if length else b""
+        path, _, query = target.partition("?")
+        return Request(method.upper(), path, query, headers, body)
+
+    async def _dispatch(self, request):
+        handler = self.routes.get((request.method, request.path))
+        if handler is None:
+            if any(path == request.path for _, path in self.routes):
+                return text_response(405, "method not allowed")
+            return text_response(404, "not found")
+        try:
+            return await handler(request)
+        except Exception as e:
+            logger.error(f"[HTTP] Erro em {request.method} {request.path}: {e}", exc_info=True)
+            return text_response(500, "internal error")
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except OverflowError:
+                    await self._write(writer, *text_response(413, "payload too large"), keep_alive=False)
+                    break
+                except ValueError:
+                    await self._write(writer, *text_response(400, "bad request"), keep_alive=False)
+                    break
+                if request is None:
+                    break
+                status, headers, body = await self._dispatch(request)
+                keep_alive = request.headers.get("connection", "").lower() != "close"
+                await self._write(writer, status, headers, body, keep_alive)
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    @staticmethod
+    async def _write(writer, status, headers, body, keep_alive=True):
+        head = [f"HTTP/1.1 {status} {_REASONS.get(status, '')}"]
+        headers = {**headers, "Content-Length": str(len(body)), "Connection": "keep-alive" if keep_alive else "close"}
+        head += [f"{name}: {value}" for name, value in headers.items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
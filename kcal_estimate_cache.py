@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: kcal_estimate_cache.py (v1 - Cache compartilhado de estimativas de kcal por alimento)
+
+import datetime
+import hashlib
+import logging
+import statistics
+import threading
+from collections import OrderedDict, deque
+
+from food_db import food_key, parse_quantity
+
+logger = logging.getLogger(__name__)
+
+MAX_OBSERVATIONS = 15  # Janela de estimativas guardadas por chave (as mais recentes)
+
+
+def _format_quantity(count, measure_grams, grams):
+    if grams is not None:
+        return f"{grams:g}g"
+    if count is None:
+        return ""
+    return f"{count:g}x{measure_grams:g}g" if measure_grams else f"{count:g}"
+
+
+def make_key(item, quantity=None):
+    """Chave: alimento normalizado + quantidade canônica ('2 Pães na chapa' -> 'pao na chapa|2')."""
+    count, measure_grams, grams, rest = parse_quantity(str(item))
+    if count is None and grams is None and quantity is not None:
+        count, measure_grams, grams, _ = parse_quantity(str(quantity))
+    name = food_key(rest or item)
+    if not name:
+        return None
+    return f"{name}|{_format_quantity(count, measure_grams, grams)}"
+
+
+class KcalEstimateCache:
+    """Estimativas de kcal do modelo por alimento, agregadas pela mediana entre usuários.
+
+    LRU com limite de tamanho; só responde a partir de min_observations estimativas. Se houver
+    writer (um firestore_manager.WriteBehindFlusher), as chaves alteradas são persistidas em lote.
+    """
+
+    def __init__(self, max_entries=20000, min_observations=2, max_observations=MAX_OBSERVATIONS, writer=None):
+        self.max_entries = max_entries
+        self.min_observations = min_observations
+        self.max_observations = max_observations
+        self.writer = writer
+        self._data = OrderedDict()  # chave -> deque de estimativas (kcal)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.observations = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _doc_id(key):
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def get(self, item, quantity=None):
+        """Mediana das estimativas para o item, ou None se ainda não há observações suficientes."""
+        key = make_key(item, quantity)
+        with self._lock:
+            values = self._data.get(key) if key else None
+            if values is None or len(values) < self.min_observations:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return round(statistics.median(values))
+
+    def observe(self, item, quantity, kcal):
+        """Registra uma estimativa do modelo (ex: vinda de extract_calories)."""
+        key = make_key(item, quantity)
+        if not key or not kcal or kcal <= 0:
+            return
+        with self._lock:
+            values = self._put(key, [])
+            values.append(int(kcal))
+            self.observations += 1
+            snapshot = list(values)
+        if self.writer:
+            self.writer.defer(
+                self._doc_id(key),
+                {"key": key, "observations": snapshot, "updated_at": datetime.datetime.now(datetime.timezone.utc)},
+            )
+
+    def _put(self, key, values):
+        # Chamado com o lock; devolve a deque da chave (criando se preciso) e aplica o limite LRU
+        entry = self._data.get(key)
+        if entry is None:
+            entry = self._data[key] = deque(values, maxlen=self.max_observations)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def resolve(self, price, quantity=None):
+        """Resolve pelo cache os itens 'unknown' de food_db.price_items (altera price); retorna quantos."""
+        single = len(price["items"]) + len(price["unknown"]) == 1
+        still_unknown = []
+        for item in price["unknown"]:
+            kcal = self.get(item, quantity if single else None)
+            if kcal is None:
+                still_unknown.append(item)
+                continue
+            price["items"].append({"query": item, "grams": None, "kcal": kcal, "source": "estimate_cache"})
+            price["total_kcal"] = round(price["total_kcal"] + kcal, 1)
+        resolved = len(price["unknown"]) - len(still_unknown)
+        price["unknown"] = still_unknown
+        return resolved
+
+    def load(self, db, collection="kcal_estimates", limit=None):
+        """Aquece o cache com as chaves mais recentes do Firestore; retorna quantas carregou."""
+        query = db.collection(collection).order_by("updated_at", direction="DESCENDING")
+        query = query.limit(limit or self.max_entries)
+        docs = [doc.to_dict() for doc in query.stream()]
+        with self._lock:
+            for data in reversed(docs):  # Mais recentes por último = mais protegidas no LRU
+                if data.get("key") and data.get("observations"):
+                    self._data.pop(data["key"], None)
+                    self._put(data["key"], data["observations"][-self.max_observations :])
+            return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "observations": self.observations,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
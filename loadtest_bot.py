@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: loadtest_bot.py (v3 - Conta recusas por prazo do core_executor)
+#
+# Uso: python loadtest_bot.py [--rates 5,10,20,40] [--duration 20] [--mix onboarding=0.2,logger=0.5,chatter=0.3]
+#                             [--stream] [--json saida.json] [--compare base.json]
+# Monta um Application do PTB com os handlers reais (telegram_bot.register_handlers) e um
+# transporte falso da Bot API (nada sai para a rede), e o alimenta com Updates sintéticos.
+# Firestore e Gemini são os de fake_backends (mesmos parâmetros do bench_calobot). Para cada taxa
+# alvo (mensagens/s, chegadas Poisson) roda 'duration' segundos com usuários novos e reporta vazão,
+# latência até a resposta, ocupação do core_executor e erros. A maior taxa que cumpre o SLO
+# (--slo-p95, --max-error-rate) é a capacidade do processo.
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import platform
+import random
+import sys
+import time
+from collections import defaultdict, deque
+
+import bench_calobot
+import core_executor
+import fake_backends
+import firestore_manager
+import telegram_bot
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import BaseRequest
+
+logger = logging.getLogger(__name__)
+
+BOT_USER = {"id": 999000, "is_bot": True, "first_name": "CaloBot", "username": "calobot_loadtest_bot",
+            "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+FIRST_USER_ID = 5_000_000
+SAMPLE_INTERVAL_SECONDS = 0.05  # Amostragem do core_executor
+
+LOGGER_MESSAGES = [
+    "comi 2 pães de queijo e um café com leite",
+    "almocei arroz, feijão e bife",
+    "comi uma tapioca de frango",
+    "tomei um suco de laranja",
+    "comi uma banana",
+    "jantei uma salada com frango grelhado",
+    "comi um iogurte com granola",
+    "lanchei um pão francês com manteiga",
+]
+CHATTER_MESSAGES = [
+    "oi",
+    "tudo bem?",
+    "qual meu status?",
+    "me sugere um jantar leve sem lactose",
+    "qual minha altura?",
+    "quem ganhou o jogo ontem?",
+    "quanto ainda posso comer hoje?",
+    "valeu!",
+]
+PROFILES = {
+    # perfil -> (roteiro(rng), usuário já cadastrado?)
+    "onboarding": (lambda rng: ["/start"] + bench_calobot.ONBOARDING_SCRIPT[1:] + rng.sample(LOGGER_MESSAGES, 2), False),
+    "logger": (lambda rng: rng.sample(LOGGER_MESSAGES, 6) + ["qual meu status?"], True),
+    "chatter": (lambda rng: rng.sample(CHATTER_MESSAGES, 5), True),
+}
+SEEDED_PROFILE = {"birth_year": 1990, "gender": "female", "height_cm": 165, "current_weight_kg": 62.5,
+                  "initial_weight_kg": 62.5, "activity_level": "light", "goal": "lose"}
+
+# Respostas que indicam falha ou descarte (não contam como atendidas)
+ERROR_MARKERS = ("Xiii, deu um bug", "Desculpe, ocorreu um erro inesperado", "(Erro salvar")
+BUSY_REPLIES = {core_executor.BUSY_REPLY, "Calma, ainda estou processando suas mensagens anteriores! ⏳ Já te respondo."}
+SHED_REPLIES = {reply for replies in core_executor.CANNED_REPLIES.values() for reply in replies}
+
+
+def classify_reply(text):
+    if text in BUSY_REPLIES:
+        return "busy"
+    if text in SHED_REPLIES:
+        return "shed"
+    if text.startswith("Erro ") or any(marker in text for marker in ERROR_MARKERS):
+        return "error"
+    return "ok"
+
+
+class StubTelegramRequest(BaseRequest):
+    """Bot API falsa: responde sendMessage/editMessageText/sendChatAction/getMe e avisa o loadtest."""
+
+    def __init__(self, faults=None, on_send=None):
+        self.faults = faults or fake_backends.FaultInjector()
+        self.on_send = on_send  # fn(chat_id, texto, método)
+        self._message_ids = itertools.count(1)
+        self.calls = defaultdict(int)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] += 1
+        await self.faults.before(endpoint)
+        if endpoint == "getMe":
+            result = BOT_USER
+        elif endpoint in ("sendMessage", "editMessageText"):
+            chat_id = int(params["chat_id"])
+            result = {
+                "message_id": int(params.get("message_id") or next(self._message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+            if self.on_send:
+                self.on_send(chat_id, params.get("text", ""), endpoint)
+        else:  # sendChatAction, setWebhook, deleteWebhook...
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
+
+
+class VirtualUser:
+    def __init__(self, user_id, profile, script):
+        self.user_id = user_id
+        self.name = f"Carga{user_id % 100000}"
+        self.profile = profile
+        self.script = deque(script)
+        self.waiter = None  # (future, respostas esperadas, [textos])
+
+
+class LoadRun:
+    """Uma taxa alvo: chegadas Poisson distribuídas entre usuários virtuais ociosos."""
+
+    def __init__(self, application, transport, args, rate, rng):
+        self.application = application
+        self.args = args
+        self.rate = rate
+        self.rng = rng
+        self.mix = args.mix
+        self.users = {}
+        self.idle = deque()
+        self.next_user_id = itertools.count(FIRST_USER_ID)
+        self.update_ids = itertools.count(1)
+        self.latencies = defaultdict(list)  # perfil -> segundos até a resposta
+        self.results = defaultdict(int)  # ok / busy / shed / error / timeout
+        self.sent = 0
+        self.samples = []  # (in_flight, queue_depth)
+        self.completed_at = []  # instantes (desde o início) das respostas atendidas
+        self.start = 0.0
+        transport.on_send = self._on_send
+
+    def _on_send(self, chat_id, text, endpoint):
+        user = self.users.get(chat_id)
+        if user is None or user.waiter is None or endpoint != "sendMessage":
+            return  # Edições do streaming não contam: a latência é até a primeira parte
+        future, expected, texts = user.waiter
+        texts.append(text)
+        if len(texts) >= expected and not future.done():
+            future.set_result(texts)
+
+    def _spawn_user(self):
+        profile = self.rng.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        script_fn, seeded = PROFILES[profile]
+        user = VirtualUser(next(self.next_user_id), profile, script_fn(self.rng))
+        if seeded:
+            doc = firestore_manager._build_new_user(user.user_id, user.name, str(user.user_id))
+            doc["profile"].update(SEEDED_PROFILE)
+            doc["diet_settings"]["daily_calorie_goal"] = 1700
+            firestore_manager.db.load({f"users/{user.user_id}": doc})
+        self.users[user.user_id] = user
+        return user
+
+    def _build_update(self, user, text):
+        update_id = next(self.update_ids)
+        message = {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user.user_id, "type": "private", "first_name": user.name},
+            "from": {"id": user.user_id, "is_bot": False, "first_name": user.name, "language_code": "pt-br"},
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return Update.de_json({"update_id": update_id, "message": message}, self.application.bot)
+
+    async def _send(self, user):
+        text = user.script.popleft()
+        # /start de usuário novo: saudação, aviso do onboarding e a primeira pergunta
+        expected = 3 if text == "/start" else 1
+        future = asyncio.get_running_loop().create_future()
+        user.waiter = (future, expected, [])
+        self.sent += 1
+        start = time.perf_counter()
+        await self.application.update_queue.put(self._build_update(user, text))
+        try:
+            texts = await asyncio.wait_for(future, timeout=self.args.reply_timeout)
+            kind = classify_reply(texts[-1])
+            self.results[kind] += 1
+            if kind == "ok":
+                self.latencies[user.profile].append(time.perf_counter() - start)
+                self.completed_at.append(time.perf_counter() - self.start)
+        except asyncio.TimeoutError:
+            self.results["timeout"] += 1
+        user.waiter = None
+        if user.script:
+            if self.args.think_time:
+                await asyncio.sleep(self.rng.expovariate(1 / self.args.think_time))
+            self.idle.append(user)
+
+    async def _sample(self):
+        executor = core_executor.core_executor
+        while True:
+            self.samples.append((executor._in_flight, executor.queue_depth))
+            await asyncio.sleep(SAMPLE_INTERVAL_SECONDS)
+
+    async def run(self):
+        sampler = asyncio.create_task(self._sample())
+        tasks = set()
+        self.start = time.perf_counter()
+        while True:
+            await asyncio.sleep(self.rng.expovariate(self.rate))
+            if time.perf_counter() - self.start >= self.args.duration:
+                break
+            user = self.idle.popleft() if self.idle else self._spawn_user()
+            task = asyncio.create_task(self._send(user))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)  # Cada envio já tem o próprio timeout
+        wall = time.perf_counter() - self.start
+        sampler.cancel()
+        return wall
+
+    def report(self, wall):
+        all_latencies = [v for values in self.latencies.values() for v in values]
+        in_flight = [s[0] for s in self.samples] or [0]
+        depths = [s[1] for s in self.samples] or [0]
+        max_concurrency = core_executor.core_executor.max_concurrency
+        failed = self.sent - self.results["ok"]
+        return {
+            "offered_rate": self.rate,
+            "sent": self.sent,
+            "users": len(self.users),
+            "wall_seconds": round(wall, 3),
+            # Vazão na janela de chegadas (o esvaziamento no fim não entra)
+            "achieved_rate": round(sum(1 for t in self.completed_at if t <= self.args.duration) / self.args.duration, 2),
+            "results": dict(self.results),
+            "error_rate": round(failed / self.sent, 4) if self.sent else 0.0,
+            "latency": bench_calobot.summarize(all_latencies),
+            "latency_by_profile": {p: bench_calobot.summarize(v) for p, v in sorted(self.latencies.items())},
+            "executor": {
+                "utilization_avg": round(sum(in_flight) / len(in_flight) / max_concurrency, 3),
+                "saturated_fraction": round(sum(1 for n in in_flight if n >= max_concurrency) / len(in_flight), 3),
+                "queue_depth_avg": round(sum(depths) / len(depths), 2),
+                "queue_depth_max": max(depths),
+                **{k: v for k, v in core_executor.core_executor.stats().items() if k in ("shed", "rejected", "timeouts", "late")},
+            },
+            "dispatcher": telegram_bot.user_dispatcher.stats(),
+        }
+
+
+def reset_bot_state(args):
+    """Fakes, executor e dispatcher novos: cada taxa começa do zero."""
+    bench_calobot.install_backends(args)
+    core_executor.core_executor = core_executor.CoreExecutor(max_concurrency=args.core_concurrency)
+    telegram_bot.user_dispatcher = telegram_bot.UserDispatcher(telegram_bot._process_text)
+    telegram_bot.STREAM_REPLIES = args.stream
+
+
+async def run_rate(args, rate):
+    reset_bot_state(args)
+    transport = StubTelegramRequest(fake_backends.FaultInjector(
+        latency_seconds=args.telegram_latency, jitter_seconds=args.telegram_jitter, seed=args.seed + 2))
+    application = (
+        Application.builder()
+        .token("123456:LOADTEST")
+        .request(transport)
+        .get_updates_request(StubTelegramRequest())
+        .updater(None)
+        .concurrent_updates(telegram_bot.BOT_CONCURRENT_UPDATES)
+        .build()
+    )
+    telegram_bot.register_handlers(application)
+    load = LoadRun(application, transport, args, rate, random.Random(args.seed * 7919 + int(rate * 1000)))
+    async with application:
+        await application.start()
+        try:
+            wall = await load.run()
+        finally:
+            await application.stop()
+    result = load.report(wall)
+    result["telegram_calls"] = dict(transport.calls)
+    return result
+
+
+def capacity(steps, slo_p95_ms, max_error_rate):
+    """Maior taxa oferecida que cumpriu o SLO (p95 e taxa de erro), ou 0."""
+    passing = [s["offered_rate"] for s in steps if s["latency"]["p95_ms"] <= slo_p95_ms and s["error_rate"] <= max_error_rate]
+    return max(passing, default=0)
+
+
+def print_report(result, baseline=None):
+    meta = result["meta"]
+    print(f"\n=== loadtest_bot @ {meta['git']} (seed {meta['seed']}, mix {meta['params']['mix']}) ===")
+    print(f"{'taxa':>6}{'env':>6}{'ok/s':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'erro%':>7}{'busy':>6}{'shed':>6}{'tmout':>6}"
+          f"{'util':>6}{'sat%':>6}{'fila':>6}  (ms)")
+    for s in result["steps"]:
+        r, lat, ex = s["results"], s["latency"], s["executor"]
+        print(f"{s['offered_rate']:>6g}{s['sent']:>6}{s['achieved_rate']:>8.1f}{lat['p50_ms']:>9.1f}{lat['p95_ms']:>9.1f}"
+              f"{lat['p99_ms']:>9.1f}{100 * s['error_rate']:>7.1f}{r.get('busy', 0):>6}{r.get('shed', 0):>6}{r.get('timeout', 0):>6}"
+              f"{ex['utilization_avg']:>6.2f}{100 * ex['saturated_fraction']:>6.0f}{ex['queue_depth_max']:>6}")
+    line = f"\nCapacidade (p95 <= {meta['params']['slo_p95']:g} ms, erros <= {meta['params']['max_error_rate']:.1%}): {result['capacity']:g} msg/s"
+    if baseline:
+        line += f" (antes: {baseline['capacity']:g} msg/s @ {baseline['meta']['git']})"
+    print(line)
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in PROFILES:
+            raise argparse.ArgumentTypeError(f"perfil desconhecido: {name} (use {', '.join(PROFILES)})")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Carga sintética pelos handlers do Telegram (Bot API, Firestore e Gemini falsos).")
+    parser.add_argument("--rates", default="5,10,20,40", help="Taxas alvo em mensagens/s, separadas por vírgula.")
+    parser.add_argument("--duration", type=float, default=20.0, help="Segundos de chegadas por taxa.")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("onboarding=0.2,logger=0.5,chatter=0.3"))
+    parser.add_argument("--think-time", type=float, default=1.0, help="Média (s) entre a resposta e a próxima mensagem do usuário.")
+    parser.add_argument("--reply-timeout", type=float, default=30.0)
+    parser.add_argument("--slo-p95", type=float, default=5000.0, help="p95 máximo (ms) para contar na capacidade.")
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--engine", choices=["two_call", "single_call"], default="two_call")
+    parser.add_argument("--stream", action="store_true", help="Respostas em streaming (CALOBOT_STREAM_REPLIES).")
+    parser.add_argument("--core-concurrency", type=int, default=core_executor.CORE_MAX_CONCURRENCY)
+    parser.add_argument("--telegram-latency", type=float, default=0.03, help="Ida e volta da Bot API.")
+    parser.add_argument("--telegram-jitter", type=float, default=0.02)
+    parser.add_argument("--model-latency", type=float, default=0.8)
+    parser.add_argument("--model-jitter", type=float, default=0.4)
+    parser.add_argument("--model-error-rate", type=float, default=0.0)
+    parser.add_argument("--chunk-latency", type=float, default=0.05, help="Atraso entre pedaços no streaming.")
+    parser.add_argument("--firestore-latency", type=float, default=0.01)
+    parser.add_argument("--firestore-jitter", type=float, default=0.01)
+    parser.add_argument("--firestore-error-rate", type=float, default=0.0)
+    parser.add_argument("--model-quota", type=float, default=1e6, help="Cota do rate limiter (req/min).")
+    parser.add_argument("--log-level", default="ERROR")
+    parser.add_argument("--json", help="Grava o resultado neste arquivo.")
+    parser.add_argument("--compare", help="JSON de uma execução anterior para comparar a capacidade.")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(args.log_level)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    rates = [float(r) for r in args.rates.split(",") if r.strip()]
+    steps = []
+    for rate in rates:
+        print(f"Taxa {rate:g} msg/s por {args.duration:g}s...", flush=True)
+        steps.append(asyncio.run(run_rate(args, rate)))
+    firestore_manager.touch_flusher.stop()
+
+    result = {
+        "meta": {
+            "git": bench_calobot.git_revision(),
+            "seed": args.seed,
+            "python": platform.python_version(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "params": {k: v for k, v in vars(args).items() if k not in ("json", "compare")},
+        },
+        "steps": steps,
+        "capacity": capacity(steps, args.slo_p95, args.max_error_rate),
+    }
+    print_report(result, baseline)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"\nResultado gravado em {args.json}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: metrics.py (v2 - Listeners com as amostras brutas de cada mensagem (benchmark))
+#
+# Uso no core:
+#   with metrics.message_trace():          # uma mensagem
+#       with metrics.span("nlu") as sp:    # uma etapa; sp.fail() marca outcome="error"
+#           ...
+#       metrics.tag_message(intent="LOG_FOOD")
+# As etapas ficam guardadas no trace e são registradas ao fim da mensagem, já com a intent e o
+# resultado finais. Com METRICS_ENABLED=0 (padrão) span/message_trace devolvem objetos nulos prontos.
+
+import bisect
+import contextvars
+import logging
+import os
+import threading
+import time
+
+import http_server
+
+logger = logging.getLogger(__name__)
+
+# --- Configurações ---
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "0") == "1"
+# Porta do /metrics no modo polling (no modo webhook a rota fica no próprio servidor HTTP); 0 = sem servidor
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "0.0.0.0")
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_trace = contextvars.ContextVar("metrics_trace", default=None)
+_trace_listeners = []  # fn(intent, outcome, segundos, [(etapa, segundos, outcome)]) ao fim de cada mensagem
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+def _labels_text(names, values, extra=""):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, labels=(), amount=1.0):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_labels_text(self.labelnames, labels)} {value:g}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [contagens por bucket (não acumuladas) + inf, soma]
+
+    def observe(self, labels, value):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound:g}"'
+                lines.append(f"{self.name}_bucket{_labels_text(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels_text(self.labelnames, labels)} {total:.6f}")
+            lines.append(f"{self.name}_count{_labels_text(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Métricas do processo + coletores (funções stats() dos componentes, exportadas como gauges)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+        self._collectors = {}
+
+    def add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, prefix, stats_fn):
+        """stats_fn() -> dict; cada valor numérico vira o gauge calobot_<prefix>_<chave>."""
+        self._collectors[prefix] = stats_fn
+
+    def record(self, fn, *args):
+        with self._lock:
+            fn(*args)
+
+    def render(self):
+        with self._lock:
+            lines = [line for metric in self._metrics for line in metric.render()]
+        for prefix, stats_fn in sorted(self._collectors.items()):
+            try:
+                stats = stats_fn() or {}
+            except Exception as e:
+                logger.warning(f"[Metrics] Coletor '{prefix}' falhou: {e}")
+                continue
+            for key, value in stats.items():
+                if isinstance(value, bool):
+                    value = int(value)
+                if isinstance(value, (int, float)):
+                    name = f"calobot_{prefix}_{key}"
+                    lines += [f"# TYPE {name} gauge", f"{name} {value:g}"]
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+stage_seconds = registry.add(
+    Histogram("calobot_stage_seconds", "Duração de cada etapa do processamento de uma mensagem.", ("stage", "intent", "outcome"))
+)
+message_seconds = registry.add(
+    Histogram("calobot_message_seconds", "Duração total do processamento de uma mensagem.", ("intent", "outcome"))
+)
+messages_total = registry.add(Counter("calobot_messages_total", "Mensagens processadas pelo core.", ("intent", "outcome")))
+
+
+class Span:
+    __slots__ = ("stage", "outcome", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.outcome = "ok"
+
+    def fail(self):
+        self.outcome = "error"
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        outcome = "error" if exc_type is not None else self.outcome
+        trace = _trace.get()
+        if trace is not None:
+            trace.spans.append((self.stage, elapsed, outcome))
+        else:  # Etapa fora de uma mensagem (ex: warm-up)
+            registry.record(stage_seconds.observe, (self.stage, "-", outcome), elapsed)
+        return False
+
+
+class MessageTrace:
+    __slots__ = ("intent", "outcome", "spans", "start", "_token")
+
+    def __init__(self):
+        self.intent = "UNKNOWN"
+        self.outcome = "ok"
+        self.spans = []
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self._token = _trace.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        try:
+            _trace.reset(self._token)
+        except ValueError:  # Async generator fechado em outro contexto (ex: finalizador do loop)
+            pass
+        if exc_type is not None:
+            self.outcome = "error"
+        registry.record(self._flush, elapsed)
+        return False
+
+    def _flush(self, elapsed):
+        for stage, seconds, outcome in self.spans:
+            stage_seconds.observe((stage, self.intent, outcome), seconds)
+        message_seconds.observe((self.intent, self.outcome), elapsed)
+        messages_total.inc((self.intent, self.outcome))
+        for listener in _trace_listeners:
+            listener(self.intent, self.outcome, elapsed, self.spans)
+
+
+class _NullSpan:
+    """Modo desligado: um só objeto reaproveitado, sem medir nada."""
+
+    __slots__ = ()
+
+    def fail(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL = _NullSpan()
+
+
+def span(stage):
+    return Span(stage) if METRICS_ENABLED else _NULL
+
+
+def message_trace():
+    return MessageTrace() if METRICS_ENABLED else _NULL
+
+
+def tag_message(intent=None, outcome=None):
+    """Define intent/resultado da mensagem em andamento (sem efeito fora de um message_trace)."""
+    trace = _trace.get()
+    if trace is None:
+        return
+    if intent:
+        trace.intent = intent
+    if outcome:
+        trace.outcome = outcome
+
+
+def add_trace_listener(fn):
+    """Recebe cada mensagem concluída com as amostras brutas (ex: bench_calobot calcula percentis exatos)."""
+    _trace_listeners.append(fn)
+
+
+def remove_trace_listener(fn):
+    if fn in _trace_listeners:
+        _trace_listeners.remove(fn)
+
+
+def register_collector(prefix, stats_fn):
+    registry.register_collector(prefix, stats_fn)
+
+
+def render():
+    return registry.render()
+
+
+async def metrics_handler(request):
+    """Rota GET /metrics para http_server.HTTPServer."""
+    return http_server.text_response(200, render(), CONTENT_TYPE)
+
+
+async def start_server(host=METRICS_LISTEN, port=METRICS_PORT):
+    """Servidor só com /metrics (modo polling). Retorna o HTTPServer ou None se desligado."""
+    if not METRICS_ENABLED or not port:
+        return None
+    server = http_server.HTTPServer({("GET", "/metrics"): metrics_handler})
+    await server.start(host, port)
+    return server
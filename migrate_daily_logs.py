@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: migrate_daily_logs.py (v1 - Migração única de daily_tracking.log_today)
+#
+# Uso: python migrate_daily_logs.py [--dry-run] [--page-size N]
+# Move os arrays daily_tracking.log_today (formato antigo) para
+# users/{id}/daily_logs/{data}/entries e remove o array do documento do usuário.
+
+import argparse
+import logging
+
+import firestore_manager
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migra log_today para daily_logs.")
+    parser.add_argument("--dry-run", action="store_true", help="Só conta, não grava.")
+    parser.add_argument("--page-size", type=int, default=200)
+    args = parser.parse_args()
+
+    stats = firestore_manager.migrate_daily_tracking(
+        page_size=args.page_size, dry_run=args.dry_run
+    )
+    if stats is None:
+        logger.critical("Migração não executada: Firestore indisponível.")
+        return
+    logger.info(f"Resultado da migração: {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: nlu_cache.py (v3 - Hit do store compartilhado herda o prazo restante da entrada)
+
+import copy
+import datetime
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from text_utils import normalize_text
+
+logger = logging.getLogger(__name__)
+
+MAX_KEY_LENGTH = 200  # Mensagens longas quase nunca se repetem: não vale cachear
+
+
+def make_key(message):
+    """Chave do cache: texto normalizado, sem pontuação nas pontas ("Valeu!" == "valeu")."""
+    return normalize_text(message).strip(" .,!?;:")
+
+
+class FirestoreNLUStore:
+    """Armazenamento compartilhado (opcional) no Firestore, para vários processos do bot."""
+
+    def __init__(self, db, collection="nlu_cache", async_db_factory=None):
+        self.db = db
+        self.collection = collection
+        # Função que devolve o AsyncClient do loop atual (ex: firestore_manager.get_async_db)
+        self.async_db_factory = async_db_factory
+
+    @staticmethod
+    def _doc_id(key):
+        # IDs de documento não aceitam '/', e a chave pode ter qualquer caractere
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _parse(snapshot):
+        """Resultado da entrada, com "expires_in" (segundos até expirar; None se não expira)."""
+        if not snapshot.exists:
+            return None
+        data = snapshot.to_dict()
+        expires_at = data.get("expires_at")
+        expires_in = None
+        if expires_at:
+            expires_in = (expires_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+            if expires_in <= 0:
+                return None
+        return {"intent": data.get("intent"), "entities": data.get("entities", {}), "expires_in": expires_in}
+
+    @staticmethod
+    def _document(key, result, ttl_seconds):
+        expires_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=ttl_seconds)
+        return {"key": key, "intent": result["intent"], "entities": result.get("entities", {}), "expires_at": expires_at}
+
+    def get(self, key):
+        return self._parse(self.db.collection(self.collection).document(self._doc_id(key)).get())
+
+    def set(self, key, result, ttl_seconds):
+        self.db.collection(self.collection).document(self._doc_id(key)).set(self._document(key, result, ttl_seconds))
+
+    async def get_async(self, key):
+        if not self.async_db_factory:
+            return self.get(key)
+        doc_ref = self.async_db_factory().collection(self.collection).document(self._doc_id(key))
+        return self._parse(await doc_ref.get())
+
+    async def set_async(self, key, result, ttl_seconds):
+        if not self.async_db_factory:
+            return self.set(key, result, ttl_seconds)
+        doc_ref = self.async_db_factory().collection(self.collection).document(self._doc_id(key))
+        await doc_ref.set(self._document(key, result, ttl_seconds))
+
+
+class NLUCache:
+    """Cache em memória com LRU, TTL e contadores; consulta o store compartilhado nos misses."""
+
+    def __init__(self, max_entries=5000, ttl_seconds=6 * 3600, backing_store=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.backing_store = backing_store
+        self._data = OrderedDict()  # chave -> (expira_em, resultado)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.store_hits = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def _cacheable_key(message):
+        key = make_key(message)
+        return key if key and len(key) <= MAX_KEY_LENGTH else None
+
+    def _get_local(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, result = entry
+            if expires_at > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(result)
+            del self._data[key]
+            self.expirations += 1
+            return None
+
+    def _after_store_lookup(self, key, result):
+        # Localmente a entrada vive só o que lhe resta no store (nunca mais que ttl_seconds)
+        expires_in = result.pop("expires_in", None) if result else None
+        ttl_seconds = self.ttl_seconds if expires_in is None else min(self.ttl_seconds, expires_in)
+        if result and result.get("intent") and ttl_seconds > 0:
+            self._put_local(key, result, ttl_seconds)
+            with self._lock:
+                self.store_hits += 1
+            return copy.deepcopy(result)
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def get(self, message):
+        """Retorna {"intent", "entities"} em cache para a mensagem, ou None."""
+        key = self._cacheable_key(message)
+        if not key:
+            return None
+        result = self._get_local(key)
+        if result is not None or not self.backing_store:
+            if result is None:
+                with self._lock:
+                    self.misses += 1
+            return result
+        try:
+            result = self.backing_store.get(key)
+        except Exception as e:
+            logger.warning(f"[NLU Cache] Erro ao ler store compartilhado: {e}")
+            result = None
+        return self._after_store_lookup(key, result)
+
+    async def get_async(self, message):
+        """Como get(), mas consulta o store compartilhado sem bloquear o event loop."""
+        key = self._cacheable_key(message)
+        if not key:
+            return None
+        result = self._get_local(key)
+        if result is not None or not self.backing_store:
+            if result is None:
+                with self._lock:
+                    self.misses += 1
+            return result
+        try:
+            result = await self.backing_store.get_async(key)
+        except Exception as e:
+            logger.warning(f"[NLU Cache] Erro ao ler store compartilhado: {e}")
+            result = None
+        return self._after_store_lookup(key, result)
+
+    def _prepare_set(self, message, result):
+        key = self._cacheable_key(message)
+        if not key or not result or not result.get("intent"):
+            return None, None
+        result = {"intent": result["intent"], "entities": copy.deepcopy(result.get("entities", {}))}
+        self._put_local(key, result)
+        return key, result
+
+    def set(self, message, result):
+        """Guarda o resultado ({"intent", "entities"}) da NLU para a mensagem."""
+        key, result = self._prepare_set(message, result)
+        if key and self.backing_store:
+            try:
+                self.backing_store.set(key, result, self.ttl_seconds)
+            except Exception as e:
+                logger.warning(f"[NLU Cache] Erro ao gravar store compartilhado: {e}")
+
+    async def set_async(self, message, result):
+        """Como set(), gravando no store compartilhado de forma assíncrona."""
+        key, result = self._prepare_set(message, result)
+        if key and self.backing_store:
+            try:
+                await self.backing_store.set_async(key, result, self.ttl_seconds)
+            except Exception as e:
+                logger.warning(f"[NLU Cache] Erro ao gravar store compartilhado: {e}")
+
+    def _put_local(self, key, result, ttl_seconds=None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self.ttl_seconds if ttl_seconds is None else ttl_seconds), result)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.store_hits + self.misses
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "store_hits": self.store_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": (self.hits + self.store_hits) / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: nlu_local.py (v2 - Perguntas de tendência (semana/mês) como GET_STATUS)
+
+import json
+import logging
+import math
+import os
+import re
+import sys
+import zlib
+
+from text_utils import normalize_text, tokenize
+
+logger = logging.getLogger(__name__)
+
+# --- Configurações ---
+DEFAULT_MODEL_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "nlu_local_model.json"
+)
+MODEL_PATH = os.environ.get("NLU_LOCAL_MODEL_PATH", DEFAULT_MODEL_PATH)
+# Se definido, cada resultado da NLU do Gemini é anotado aqui (JSONL) para treino
+TRAINING_LOG_PATH = os.environ.get("NLU_TRAINING_LOG_PATH")
+N_BUCKETS = 2**18
+
+EXACT_CONFIDENCE = 0.97  # Mensagem inteira bate com uma regra
+NUMERIC_CONFIDENCE = 0.95  # Mensagem é só um número/medida (ex: "1990", "70,5 kg")
+PHRASE_MAX_CONFIDENCE = 0.93  # Frase-chave cobre toda a parte "útil" da mensagem
+
+# Intents que só servem se vierem com entidades (o modelo local não extrai comida etc.)
+ENTITY_INTENTS = {"LOG_FOOD", "ASK_SUGGESTION", "UPDATE_PROFILE", "PROVIDE_INFO"}
+
+# --- Regras: mensagem inteira (já normalizada, sem pontuação) ---
+EXACT_RULES = {
+    "GREETING": ["oi", "oie", "ola", "opa", "salve", "bom dia", "boa tarde", "boa noite", "e ai", "eai", "hey", "hello", "hi", "oi calobot", "ola calobot", "bom dia calobot"],
+    "FAREWELL": ["tchau", "tchau tchau", "ate mais", "ate logo", "ate amanha", "falou", "flw", "bye", "fui"],
+    "AFFIRMATION": ["sim", "s", "ok", "okay", "blz", "beleza", "certo", "isso", "claro", "pode ser", "com certeza", "perfeito", "show", "valeu", "vlw", "obrigado", "obrigada", "brigado", "muito obrigado", "muito obrigada"],
+    "NEGATION": ["nao", "n", "nope", "negativo", "nao quero", "de jeito nenhum"],
+    "HELP": ["ajuda", "help", "socorro", "me ajuda", "comandos", "o que voce faz", "como funciona"],
+    "GET_STATUS": ["status", "meu status", "qual meu status", "qual o meu status", "quanto falta", "resumo do dia", "como estou hoje", "resumo da semana", "resumo do mes", "minha semana", "como foi minha semana", "como fui essa semana"],
+    "GET_PROFILE": ["perfil", "meu perfil", "meus dados"],
+}
+
+# --- Regras: frases-chave dentro de mensagens maiores (trie de tokens) ---
+PHRASE_RULES = {
+    "GET_STATUS": ["meu status", "quanto falta", "calorias faltam", "calorias restam", "quantas calorias comi", "quantas calorias eu comi", "comi hoje", "consumi hoje", "status de calorias", "saldo de calorias",
+                   "minha semana", "meu mes", "essa semana", "esta semana", "esse mes", "este mes", "ultimos 7 dias", "ultimos 30 dias", "media da semana", "media do mes"],
+    "GET_PROFILE": ["meu perfil", "meus dados", "minha altura", "meu peso", "minha meta", "minha idade", "meu objetivo", "meu nivel de atividade"],
+    "HELP": ["me ajuda", "o que voce faz", "como funciona", "como te uso"],
+    "ASK_SUGGESTION": ["sugere", "sugestao", "sugira", "o que comer", "o que eu como", "recomenda"],
+    "LOG_FOOD": ["comi", "almocei", "jantei", "lanchei", "tomei", "bebi"],
+}
+
+# Tokens que não contam para a cobertura de uma frase-chave
+FILLER_TOKENS = {
+    "a", "ae", "agora", "ai", "as", "calobot", "da", "de", "do", "e", "entao", "eu", "favor", "hein", "hoje", "la",
+    "me", "mesmo", "ne", "o", "os", "pf", "pfv", "por", "qual", "quais", "tipo", "um", "uma",
+}
+
+PROFILE_FIELD_KEYWORDS = {
+    "altura": "height_cm",
+    "peso": "current_weight_kg",
+    "meta": "daily_calorie_goal",
+    "idade": "birth_year",
+    "nascimento": "birth_year",
+    "genero": "gender",
+    "sexo": "gender",
+    "atividade": "activity_level",
+    "objetivo": "goal",
+}
+
+_NUMERIC_RE = re.compile(r"^\d+(?:[.,]\d+)?\s*(?:cm|kg|kcal|anos)?$")
+
+
+# --- Trie de frases ---
+class _PhraseTrie:
+    """Trie por tokens; cada nó terminal guarda a intenção da frase."""
+
+    def __init__(self):
+        self.root = {}
+
+    def insert(self, tokens, intent):
+        node = self.root
+        for tok in tokens:
+            node = node.setdefault(tok, {})
+        node[None] = intent
+
+    def find_spans(self, tokens):
+        """Retorna [(inicio, fim, intent)] para todas as frases encontradas."""
+        spans = []
+        for start in range(len(tokens)):
+            node = self.root
+            for end in range(start, len(tokens)):
+                node = node.get(tokens[end])
+                if node is None:
+                    break
+                if None in node:
+                    spans.append((start, end + 1, node[None]))
+        return spans
+
+
+_EXACT = {}
+for _intent, _phrases in EXACT_RULES.items():
+    for _p in _phrases:
+        _EXACT[tuple(tokenize(_p))] = _intent
+
+_TRIE = _PhraseTrie()
+for _intent, _phrases in PHRASE_RULES.items():
+    for _p in _phrases:
+        _TRIE.insert(tokenize(_p), _intent)
+
+
+# --- Modelo linear com features hasheadas ---
+def _hashed_features(tokens, n_buckets=N_BUCKETS):
+    """Unigramas, bigramas e trigramas de caracteres, hasheados e normalizados (L2)."""
+    feats = [f"w:{t}" for t in tokens]
+    feats += [f"b:{a}_{b}" for a, b in zip(tokens, tokens[1:])]
+    joined = f" {' '.join(tokens)} "
+    feats += [f"c:{joined[i:i + 3]}" for i in range(len(joined) - 2)]
+    buckets = {}
+    for feat in feats:
+        h = zlib.crc32(feat.encode("utf-8")) % n_buckets
+        buckets[h] = buckets.get(h, 0.0) + 1.0
+    norm = math.sqrt(sum(v * v for v in buckets.values())) or 1.0
+    return {h: v / norm for h, v in buckets.items()}
+
+
+class HashedLinearModel:
+    """Regressão logística multiclasse (softmax) sobre features hasheadas esparsas."""
+
+    def __init__(self, intents, n_buckets=N_BUCKETS):
+        self.intents = list(intents)
+        self.n_buckets = n_buckets
+        self.weights = {intent: {} for intent in self.intents}
+        self.bias = {intent: 0.0 for intent in self.intents}
+
+    def _scores(self, feats):
+        return {
+            intent: self.bias[intent]
+            + sum(self.weights[intent].get(h, 0.0) * v for h, v in feats.items())
+            for intent in self.intents
+        }
+
+    def predict_proba(self, tokens):
+        scores = self._scores(_hashed_features(tokens, self.n_buckets))
+        top = max(scores.values())
+        exps = {intent: math.exp(s - top) for intent, s in scores.items()}
+        total = sum(exps.values())
+        return {intent: e / total for intent, e in exps.items()}
+
+    def train(self, samples, epochs=10, learning_rate=0.5, l2=1e-5):
+        """SGD simples. samples: lista de (tokens, intent)."""
+        data = [(_hashed_features(toks, self.n_buckets), intent) for toks, intent in samples]
+        for epoch in range(epochs):
+            loss = 0.0
+            for feats, gold in data:
+                scores = self._scores(feats)
+                top = max(scores.values())
+                exps = {i: math.exp(s - top) for i, s in scores.items()}
+                total = sum(exps.values())
+                for intent in self.intents:
+                    p = exps[intent] / total
+                    grad = p - (1.0 if intent == gold else 0.0)
+                    if intent == gold:
+                        loss -= math.log(max(p, 1e-12))
+                    if abs(grad) < 1e-6:
+                        continue
+                    w = self.weights[intent]
+                    for h, v in feats.items():
+                        w[h] = w.get(h, 0.0) * (1 - learning_rate * l2) - learning_rate * grad * v
+                    self.bias[intent] -= learning_rate * grad
+            logger.info(f"[NLU Local] Época {epoch + 1}/{epochs}: loss médio={loss / max(len(data), 1):.4f}")
+
+    def to_dict(self):
+        return {
+            "version": 1,
+            "n_buckets": self.n_buckets,
+            "intents": self.intents,
+            "bias": self.bias,
+            # Pesos quase nulos não valem o espaço no arquivo
+            "weights": {
+                intent: {str(h): round(v, 5) for h, v in w.items() if abs(v) > 1e-4}
+                for intent, w in self.weights.items()
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        model = cls(data["intents"], data.get("n_buckets", N_BUCKETS))
+        model.bias = {k: float(v) for k, v in data["bias"].items()}
+        model.weights = {
+            intent: {int(h): float(v) for h, v in w.items()}
+            for intent, w in data["weights"].items()
+        }
+        return model
+
+
+_model = None
+_model_loaded = False
+
+
+def load_model(path=None):
+    """Carrega o modelo linear do disco. Sem arquivo, o classificador usa só regras."""
+    global _model, _model_loaded
+    path = path or MODEL_PATH
+    _model_loaded = True
+    if not os.path.exists(path):
+        logger.info(f"[NLU Local] Modelo '{path}' não encontrado. Usando apenas regras.")
+        _model = None
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            _model = HashedLinearModel.from_dict(json.load(f))
+        logger.info(f"[NLU Local] Modelo carregado de '{path}' ({len(_model.intents)} intents).")
+    except Exception as e:
+        logger.error(f"[NLU Local] Erro ao carregar modelo '{path}': {e}", exc_info=True)
+        _model = None
+    return _model
+
+
+def _get_model():
+    if not _model_loaded:
+        load_model()
+    return _model
+
+
+# --- Classificação ---
+def _extract_entities(intent, tokens, original_text):
+    entities = {}
+    if intent == "GET_PROFILE":
+        for tok in tokens:
+            field = PROFILE_FIELD_KEYWORDS.get(tok)
+            if field:
+                entities["profile_field"] = field
+                break
+    elif intent == "PROVIDE_INFO":
+        entities["info_value"] = original_text.strip()
+    return entities
+
+
+def _phrase_scores(tokens):
+    """Cobertura das frases-chave por intent, ignorando tokens de enchimento."""
+    useful = [i for i, tok in enumerate(tokens) if tok not in FILLER_TOKENS]
+    if not useful:
+        return {}
+    covered = {}
+    for start, end, intent in _TRIE.find_spans(tokens):
+        covered.setdefault(intent, set()).update(range(start, end))
+    useful_set = set(useful)
+    return {
+        intent: PHRASE_MAX_CONFIDENCE * len(positions & useful_set) / len(useful_set)
+        for intent, positions in covered.items()
+    }
+
+
+def classify(message):
+    """Classifica a mensagem localmente.
+
+    Retorna {"intent", "entities", "confidence", "source"} ou None se não houver palpite.
+    """
+    tokens = tokenize(message)
+    if not tokens:
+        return None
+
+    intent, confidence, source = None, 0.0, None
+    if tuple(tokens) in _EXACT:
+        intent, confidence, source = _EXACT[tuple(tokens)], EXACT_CONFIDENCE, "rules"
+    elif _NUMERIC_RE.match(normalize_text(message)):
+        intent, confidence, source = "PROVIDE_INFO", NUMERIC_CONFIDENCE, "rules"
+    else:
+        candidates = _phrase_scores(tokens)
+        if len(candidates) > 1:
+            # Frases de intents diferentes: reduz a confiança de todas
+            candidates = {k: v / len(candidates) for k, v in candidates.items()}
+        source = "rules" if candidates else None
+        model = _get_model()
+        if model:
+            for m_intent, p in model.predict_proba(tokens).items():
+                # "noisy-or" entre a regra e o modelo quando ambos apontam a mesma intent
+                prior = candidates.get(m_intent, 0.0)
+                candidates[m_intent] = 1 - (1 - prior) * (1 - p)
+            source = "model"
+        if candidates:
+            intent = max(candidates, key=candidates.get)
+            confidence = candidates[intent]
+
+    if not intent:
+        return None
+    entities = _extract_entities(intent, tokens, message)
+    if intent in ENTITY_INTENTS and not entities:
+        # Sem entidades, a resposta local é inútil para o roteamento: força o Gemini
+        confidence = min(confidence, 0.5)
+    return {"intent": intent, "entities": entities, "confidence": confidence, "source": source}
+
+
+# --- Log e treino ---
+def log_nlu_result(message, result):
+    """Anota um resultado de NLU (do Gemini) no log de treino, se configurado."""
+    if not TRAINING_LOG_PATH or not result or not result.get("intent"):
+        return
+    try:
+        with open(TRAINING_LOG_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"text": message, "intent": result["intent"], "entities": result.get("entities", {})}, ensure_ascii=False) + "\n")
+    except Exception as e:
+        logger.warning(f"[NLU Local] Falha ao gravar log de treino: {e}")
+
+
+def train_from_log(log_path, model_path=None, epochs=10):
+    """Treina o modelo linear a partir de um log JSONL de resultados da NLU."""
+    samples = []
+    with open(log_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            intent = row.get("intent")
+            tokens = tokenize(row.get("text", ""))
+            # UNCLEAR é ruído: não ensina nada ao modelo
+            if tokens and intent and intent != "UNCLEAR":
+                samples.append((tokens, intent))
+    if not samples:
+        logger.error(f"[NLU Local] Nenhuma amostra válida em '{log_path}'.")
+        return None
+    intents = sorted({intent for _, intent in samples})
+    logger.info(f"[NLU Local] Treinando com {len(samples)} amostras, {len(intents)} intents.")
+    model = HashedLinearModel(intents)
+    model.train(samples, epochs=epochs)
+    model_path = model_path or MODEL_PATH
+    with open(model_path, "w", encoding="utf-8") as f:
+        json.dump(model.to_dict(), f)
+    logger.info(f"[NLU Local] Modelo salvo em '{model_path}'.")
+    load_model(model_path)
+    return model
+
+
+# --- Uso via linha de comando ---
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    if len(sys.argv) >= 3 and sys.argv[1] == "train":
+        train_from_log(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
+    elif len(sys.argv) >= 2:
+        print(classify(" ".join(sys.argv[1:])))
+    else:
+        print("Uso: python nlu_local.py train <log.jsonl> [modelo.json] | python nlu_local.py <mensagem>")
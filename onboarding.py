@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: onboarding.py (v2 - Opções: negação e respostas conflitantes vão para a NLU; número com '.' e ',' juntos)
+#
+# Cada campo esperado em user_state.awaiting é uma etapa de STEPS: pergunta, dica do reprompt,
+# onde gravar o valor e o parser local. O parser entende as formas comuns ("1990", "1,80 m",
+# "80,5kg", "masc", "perder peso", "sim", "2.000 kcal"...) sem chamar o Gemini; o core só usa a
+# NLU quando ele devolve (None, None).
+
+import datetime
+import logging
+import re
+
+from text_utils import normalize_text, tokenize
+
+logger = logging.getLogger(__name__)
+
+ACCEPT = "accept"  # goal_confirmation: usuário aceitou a meta sugerida
+OUT_OF_RANGE = "fora da faixa"
+
+_NUMBER_RE = re.compile(r"\d+(?:[.,]\d+)*")
+_YEAR_RE = re.compile(r"\b(19\d{2}|20\d{2})\b")
+_AGE_RE = re.compile(r"\b(\d{1,3})\s*anos?\b")
+_METERS_CM_RE = re.compile(r"\b([12])\s*(?:m|metros?)\s*e?\s*(\d{1,2})\b")  # "1m80", "1 metro e 75"
+_POUNDS_RE = re.compile(r"\b(?:lb|lbs|libras?|pounds?)\b")
+_METERS_RE = re.compile(r"\b(?:m|mt|mts|metro|metros)\b")
+
+MALE_WORDS = {"m", "masc", "masculino", "homem", "h", "male", "man", "macho"}
+FEMALE_WORDS = {"f", "fem", "feminino", "mulher", "female", "woman", "femea"}
+YES_WORDS = {
+    "sim", "s", "ok", "okay", "k", "aceito", "aceitar", "confirmo", "confirmado", "confirma", "pode", "pode ser",
+    "beleza", "blz", "claro", "certo", "isso", "fechado", "bora", "vamos", "manda ver", "perfeito", "yes", "y",
+    "sim aceito", "sim pode ser", "ok aceito", "pode confirmar", "esta otimo", "ta otimo", "ta bom", "esta bom",
+}
+# Expressões normalizadas (sem acento); a mais longa vence a contida nela ("muito ativo" x "ativo")
+ACTIVITY_SYNONYMS = [
+    ("extra_active", ["muito ativo", "muito ativa", "extremamente ativo", "extra", "atleta", "intenso", "very active", "extra active", "extra_active"]),
+    ("sedentary", ["sedentario", "sedentaria", "parado", "parada", "nenhuma", "nenhum", "nada", "sedentary"]),
+    ("moderate", ["moderado", "moderada", "medio", "media", "regular", "moderate"]),
+    ("light", ["leve", "pouco", "pouca", "caminhada", "light"]),
+    ("active", ["ativo", "ativa", "bastante", "active"]),
+]
+ACTIVITY_OPTIONS = ["sedentary", "light", "moderate", "active", "extra_active"]  # Ordem da pergunta (1-5)
+GOAL_SYNONYMS = [
+    ("lose", ["perder", "emagrecer", "secar", "baixar", "diminuir", "reduzir", "lose", "cut", "emagrecimento"]),
+    ("maintain", ["manter", "manutencao", "maintain", "mesmo peso", "estabilizar"]),
+    ("gain", ["ganhar", "massa", "engordar", "hipertrofia", "aumentar", "crescer", "gain", "bulk"]),
+]
+GOAL_OPTIONS = ["lose", "maintain", "gain"]
+# Com negação ("não quero perder peso", "não muito ativo") a resposta não é a opção citada
+NEGATION_WORDS = {"nao", "nem", "not"}
+GOAL_LABELS = {"lose": "perder peso", "maintain": "manter o peso", "gain": "ganhar massa"}
+
+
+def _number(text):
+    """Primeiro número do texto como float ('80,5' -> 80.5; '2.000' -> 2000.0; '1.800,5' -> 1800.5); None se não houver."""
+    match = _NUMBER_RE.search(text)
+    if not match:
+        return None
+    raw = match.group(0)
+    if "," in raw and "." in raw:
+        decimal = max(raw.rfind(","), raw.rfind("."))  # Os dois separadores: o último é o decimal
+        raw = raw[:decimal].replace(".", "").replace(",", "") + "." + raw[decimal + 1:]
+    elif raw.count(",") + raw.count(".") > 1 or re.fullmatch(r"\d{1,2}[.,]\d{3}", raw):
+        raw = raw.replace(".", "").replace(",", "")  # Separador de milhar: "2.000", "10,000"
+    try:
+        return float(raw.replace(",", "."))
+    except ValueError:
+        return None
+
+
+def _in_range(value, low, high):
+    return (value, None) if low <= value <= high else (None, OUT_OF_RANGE)
+
+
+def _match_synonyms(text, table, options):
+    """Opção citada na resposta; None com negação ou com mais de uma opção citada.
+
+    Expressão contida numa mais longa que também casou não conta ("ativo" em "muito ativo").
+    """
+    tokens = tokenize(text)
+    normalized = " ".join(tokens)
+    if normalized.isdigit() and 1 <= int(normalized) <= len(options):
+        return options[int(normalized) - 1]  # Resposta pela posição da opção na pergunta
+    if NEGATION_WORDS & set(tokens):
+        return None
+    matches = []  # (início, fim, opção) de cada expressão encontrada
+    for value, words in table:
+        for word in words:
+            phrase = word.split()
+            for start in range(len(tokens) - len(phrase) + 1):
+                if tokens[start:start + len(phrase)] == phrase:
+                    matches.append((start, start + len(phrase), value))
+    values = {
+        value for start, end, value in matches
+        if not any(s <= start and end <= e and e - s > end - start for s, e, _ in matches)
+    }
+    return values.pop() if len(values) == 1 else None
+
+
+def parse_birth_year(text):
+    normalized = normalize_text(text)
+    current_year = datetime.datetime.now(datetime.timezone.utc).year
+    year = _YEAR_RE.search(normalized)
+    if year:
+        return _in_range(int(year.group(1)), 1901, current_year)
+    age = _AGE_RE.search(normalized)
+    if age:  # "tenho 35 anos" -> ano aproximado
+        return _in_range(current_year - int(age.group(1)), 1901, current_year)
+    if _number(normalized) is not None:
+        return None, OUT_OF_RANGE
+    return None, None
+
+
+def parse_gender(text):
+    tokens = set(tokenize(text))
+    male, female = bool(tokens & MALE_WORDS), bool(tokens & FEMALE_WORDS)
+    if male != female:
+        return ("male" if male else "female"), None
+    return None, None
+
+
+def parse_height_cm(text):
+    normalized = normalize_text(text)
+    split = _METERS_CM_RE.search(normalized)
+    if split:
+        return _in_range(int(split.group(1)) * 100 + int(split.group(2)), 100, 250)
+    value = _number(normalized)
+    if value is None:
+        return None, None
+    if value < 3 or (_METERS_RE.search(normalized) and value < 10):  # "1,80", "1.75 m"
+        value *= 100
+    return _in_range(int(round(value)), 100, 250)
+
+
+def parse_weight_kg(text):
+    normalized = normalize_text(text)
+    value = _number(normalized)
+    if value is None:
+        return None, None
+    if _POUNDS_RE.search(normalized):
+        value = round(value * 0.45359237, 1)
+    return _in_range(value, 30, 300)
+
+
+def parse_activity_level(text):
+    return _match_synonyms(text, ACTIVITY_SYNONYMS, ACTIVITY_OPTIONS), None
+
+
+def parse_goal(text):
+    return _match_synonyms(text, GOAL_SYNONYMS, GOAL_OPTIONS), None
+
+
+def parse_goal_confirmation(text):
+    """ACCEPT para 'sim' e afins; int para uma meta própria (1000-10000 kcal)."""
+    normalized = " ".join(tokenize(text))
+    if normalized in YES_WORDS:
+        return ACCEPT, None
+    value = _number(normalize_text(text))
+    if value is not None:
+        return _in_range(int(value), 1000, 10000)
+    return None, None
+
+
+# Etapas: campo -> pergunta, dica do reprompt, documento/campo onde gravar e parser local
+STEPS = {
+    "birth_year": {"question": "Ano nascimento (AAAA)? 🎂", "hint": "Ano inválido(AAAA).", "target": ("profile", "birth_year"), "parse": parse_birth_year},
+    "gender": {"question": "Gênero (masc/fem)? 🧍", "hint": "Inválido(masc/fem).", "target": ("profile", "gender"), "parse": parse_gender},
+    "height_cm": {"question": "Altura em cm (ex:175)? 📏", "hint": "Inválido(cm, números).", "target": ("profile", "height_cm"), "parse": parse_height_cm},
+    "current_weight_kg": {"question": "Peso atual kg (ex:70.5)? ⚖️", "hint": "Inválido(kg, números).", "target": ("profile", "current_weight_kg"), "parse": parse_weight_kg},
+    "activity_level": {"question": "Nível atividade? Opções:'sedentário','leve','moderado','ativo','muito ativo' 🏃", "hint": "Inválido. Opções: 'sedentário',...,'muito ativo'.", "target": ("profile", "activity_level"), "parse": parse_activity_level},
+    "goal": {"question": "Objetivo? Opções:'perder peso','manter peso','ganhar massa' 💪", "hint": "Inválido. Opções:'perder','manter','ganhar'.", "target": ("profile", "goal"), "parse": parse_goal},
+    "goal_confirmation": {"question": "Aceita a meta sugerida? Digite 'sim' ou outro valor em kcal (1000-10000).", "hint": "Inválido. Digite 'sim' ou número kcal(1000-10000).", "target": ("diet_settings", "daily_calorie_goal"), "parse": parse_goal_confirmation},
+}
+PROFILE_FIELDS = [field for field, step in STEPS.items() if step["target"][0] == "profile"]
+
+
+def parse_answer(field, text):
+    """Resposta da etapa 'field' pelo parser local. Retorna (valor, problema):
+
+    (valor, None) entendeu; (None, OUT_OF_RANGE) número fora da faixa; (None, None) não entendeu (vale tentar a NLU).
+    """
+    step = STEPS.get(field)
+    if not step or not text or not str(text).strip():
+        return None, None
+    try:
+        value, problem = step["parse"](str(text))
+    except Exception as e:  # Parser não pode derrubar o onboarding: cai na NLU
+        logger.warning(f"[Onboarding] Parser de '{field}' falhou para '{text}': {e}")
+        return None, None
+    logger.debug(f"[Onboarding] '{field}' <- '{text}': {value} ({problem or 'ok'})")
+    return value, problem
+
+
+def question(field):
+    step = STEPS.get(field)
+    return step["question"] if step else f"'{field}'?"
+
+
+def hint(field):
+    step = STEPS.get(field)
+    return step["hint"] if step else "Inválido. Tente de novo."
+
+
+def plain_question(user_display_name, field):
+    """Pergunta sem passar pelo Gemini (etapa que já gastou sua chamada ao modelo)."""
+    return f"Anotado, {user_display_name}! 👍 {question(field)}"
+
+
+def plain_reprompt(user_display_name, field, problem=None):
+    detail = " (valor fora da faixa)" if problem == OUT_OF_RANGE else ""
+    return f"Hmm, não entendi{detail}, {user_display_name}. 🤔 {hint(field)} {question(field)}"
+
+
+def plain_goal_suggestion(user_display_name, tdee, goal, suggested):
+    return (f"Perfil completo, {user_display_name}! 🎉 Seu gasto diário estimado é ~{round(tdee)} kcal e, para "
+            f"{GOAL_LABELS.get(goal, goal)}, sugiro uma meta de {suggested} kcal/dia. Digite 'sim' para aceitar ou outro valor (1000-10000).")
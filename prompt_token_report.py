@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: prompt_token_report.py (v2 - Cria o modelo só com --count-tokens (init sob demanda))
+#
+# Uso: python prompt_token_report.py [--count-tokens] [--system-instruction on|off]
+# Monta os prompts de cada intent para um usuário de exemplo no formato antigo (persona e
+# esquema da NLU repetidos em todo prompt) e no atual (calobot_core) e compara os tokens de
+# entrada por chamada. Sem --count-tokens usa a estimativa de ~4 caracteres por token.
+# Com system_instruction, o texto fixo continua sendo entrada de cada chamada: entra na conta.
+
+import argparse
+import logging
+
+import calobot_core as core
+
+logger = logging.getLogger(__name__)
+
+NAME = "Ana"
+STATUS = "Meta:2000 Cons:850 Restam:1150"
+PROFILE = {"birth_year": 1990, "gender": "female", "height_cm": 165, "current_weight_kg": 62.5, "activity_level": "light", "goal": "lose"}
+FOOD_PRICE = {"items": [{"query": "pão francês", "grams": 50.0, "kcal": 150.0}, {"query": "café com leite", "grams": 200.0, "kcal": 110.0}], "unknown": [], "total_kcal": 260.0}
+
+# (nome, intent, mensagem, entidades, food_price)
+SCENARIOS = [
+    ("LOG_FOOD", "LOG_FOOD", "comi um prato de feijoada no almoço", {"food_items": ["feijoada"], "quantity": "1 prato", "meal_time": "almoço"}, None),
+    ("LOG_FOOD (tabela)", "LOG_FOOD", "comi um pão francês e café com leite", {"food_items": ["pão francês", "café com leite"]}, FOOD_PRICE),
+    ("ASK_SUGGESTION", "ASK_SUGGESTION", "sugere algo leve pro jantar sem lactose", {"preference": "leve", "dietary_constraint": ["sem lactose"]}, None),
+    ("GET_STATUS", "GET_STATUS", "quanto ainda posso comer hoje?", {}, None),
+    ("GET_PROFILE", "GET_PROFILE", "qual meu peso cadastrado?", {"profile_field": "current_weight_kg"}, None),
+    ("GREETING", "GREETING", "bom dia!", {}, None),
+    ("OUT_OF_SCOPE", "OUT_OF_SCOPE", "quem ganhou o jogo ontem?", {}, None),
+]
+
+
+# --- Prompts no formato antigo (calobot_core v42) ---
+LEGACY_PERSONA = """
+Aja como o CaloBot: um coach nutricional digital parceiro e motivador. Use uma linguagem clara, positiva e encorajadora. Seu objetivo é ajudar o usuário com informações sobre calorias, dieta e hábitos saudáveis de forma prática e compreensível. Use emojis para tornar a conversa amigável (ex: 😊, 👍, 💪, 🍎, 🥗, 🏃‍♀️), mas evite sarcasmo ou excesso de informalidade. Responda sempre em português do Brasil (pt-br).
+"""
+
+
+def legacy_nlu_prompt(message):
+    return f"""
+Analise a mensagem do usuário e retorne um JSON VÁLIDO contendo a intenção principal ("intent") e as entidades relevantes ("entities").
+
+Intenções Possíveis: {core.POSSIBLE_INTENTS}
+Entidades Possíveis: {core.POSSIBLE_ENTITIES} (retorne apenas as encontradas: food_items[], quantity, meal_time, profile_field, profile_value, info_value, dietary_constraint[], preference).
+Intents especiais: UNCLEAR, CHITCHAT, OUT_OF_SCOPE.
+
+Mensagem do Usuário: "{message}"
+
+JSON Result:
+```json
+{{
+  "intent": "...",
+  "entities": {{ ... }}
+}}
+```"""
+
+
+def legacy_reply_prompt(intent, message, entities, food_price):
+    cal_rem = 1150
+    persona = f"{LEGACY_PERSONA}\n\nContexto User '{NAME}': {STATUS}."
+    if intent == "LOG_FOOD":
+        ctx = f"Alim:{','.join(entities.get('food_items', [message]))}"
+        if entities.get("quantity"):
+            ctx += f",Qtd:{entities['quantity']}"
+        if entities.get("meal_time"):
+            ctx += f",Ref:{entities['meal_time']}"
+        if food_price:
+            price = ", ".join(f"{i['query']}(~{i['grams']:g}g)={i['kcal']:g}kcal" for i in food_price["items"])
+            task = f"Tarefa:User registrou:'{message}'(Extr:{ctx}). Tabela CaloBot:{price}. 1.Informe 'Estimativa CaloBot: {round(food_price['total_kcal'])} kcal.' 2.Comente. 3.Mencione status({STATUS},+estimativa)."
+        else:
+            task = f"Tarefa:User registrou:'{message}'(Extr:{ctx}). 1.Estime kcal('Estimativa CaloBot: XXX kcal.'). 2.Comente. 3.Mencione status({STATUS},+estimativa)."
+    elif intent == "ASK_SUGGESTION":
+        ctx = f"Restam {cal_rem} kcal. Pref:{entities['preference']}. Restr:{','.join(entities['dietary_constraint'])}."
+        task = f"Tarefa:User pede sugestão:'{message}'. Contexto:{ctx}. Sugira 2-3 opções c/ kcal."
+    elif intent == "GET_STATUS":
+        task = f"Tarefa:User perguntou status('{message}'). Responda c/ contexto:{STATUS}."
+    elif intent == "GET_PROFILE":
+        task = f"Tarefa:User pediu perfil('{message}',campo:{entities.get('profile_field', 'geral')}). Apresente:{PROFILE}. Foco no campo se esp."
+    elif intent == "OUT_OF_SCOPE":
+        task = f"Tarefa:User fora do escopo('{message}'). Diga foco nutrição/saúde."
+    else:
+        task = f"Tarefa:User enviou '{intent}':'{message}'. Responda apropriadamente."
+    return f"{persona}\n\n{task}\n\nCaloBot:"
+
+
+def legacy_onboarding_prompt():
+    task = f"Tarefa: Onboarding '{NAME}'. Peça 'height_cm' usando: 'Altura em cm (ex:175)? 📏'"
+    return f"{LEGACY_PERSONA}\n\n{task}\n\nCaloBot:"
+
+
+# --- Prompts atuais (calobot_core) ---
+def current_prompts():
+    """[(nome, texto fixo do system_instruction ou '', prompt)] para cada chamada de exemplo."""
+    persona = core.BASE_PERSONA_PROMPT if core.SYSTEM_INSTRUCTION_ENABLED else ""
+    schema = core.NLU_SCHEMA_PROMPT if core.SYSTEM_INSTRUCTION_ENABLED else ""
+    context = core.TASK_TEMPLATES["CONTEXT"].format(name=NAME, status=STATUS)
+    calls = []
+    for name, intent, message, entities, food_price in SCENARIOS:
+        calls.append((f"NLU {name}", schema, core.get_nlu_prompt(message)))
+        task = core.get_intent_task(intent, message, entities, 1150, PROFILE, food_price)
+        calls.append((f"Resposta {name}", persona, core.compose_prompt(task, context)))
+    calls.append(("Onboarding", persona, core.get_onboarding_prompt(NAME, "height_cm")))
+    calls.append(("Chamada única", persona, core.get_single_call_prompt(NAME, STATUS, PROFILE, SCENARIOS[0][2])))
+    return calls
+
+
+def legacy_prompts():
+    calls = []
+    for name, intent, message, entities, food_price in SCENARIOS:
+        calls.append((f"NLU {name}", "", legacy_nlu_prompt(message)))
+        calls.append((f"Resposta {name}", "", legacy_reply_prompt(intent, message, entities, food_price)))
+    calls.append(("Onboarding", "", legacy_onboarding_prompt()))
+    single = (f"Contexto User '{NAME}': {STATUS}. Perfil: {PROFILE}.\nMensagem do Usuário: \"{SCENARIOS[0][2]}\"\n\nTarefa:\n"
+              f"1. Identifique a intenção (\"intent\") entre {core.POSSIBLE_INTENTS} e as entidades (\"entities\") entre {core.POSSIBLE_ENTITIES} (só as encontradas).\n"
+              "2. Escreva a resposta (\"reply\") ao usuário conforme a intenção: LOG_FOOD->estime kcal, comente e mencione status(+estimativa); ASK_SUGGESTION->sugira 2-3 opções c/ kcal; GET_STATUS->responda c/ o contexto; GET_PROFILE->apresente o perfil; UPDATE_PROFILE->informe não impl.; OUT_OF_SCOPE->diga foco nutrição/saúde; demais->responda apropriadamente.\n"
+              "3. \"estimated_kcal\": número inteiro de kcal estimadas se LOG_FOOD, senão null.\n\nRetorne APENAS um JSON VÁLIDO:\n"
+              "```json\n{\"intent\": \"...\", \"entities\": { ... }, \"reply\": \"...\", \"estimated_kcal\": null}\n```")
+    calls.append(("Chamada única", "", f"{LEGACY_PERSONA}\n\n{single}"))
+    return calls
+
+
+def make_counter(use_api):
+    cache = {}
+
+    def count(text):
+        if not text:
+            return 0
+        if text not in cache:
+            if use_api:
+                cache[text] = core.model.count_tokens(text).total_tokens
+            else:
+                cache[text] = max(1, round(len(text) / 4))
+        return cache[text]
+
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compara tokens de entrada por intent (antes x depois).")
+    parser.add_argument("--count-tokens", action="store_true", help="Conta com model.count_tokens (Vertex AI).")
+    parser.add_argument("--system-instruction", choices=["on", "off"], help="Força o modo (padrão: o do calobot_core).")
+    args = parser.parse_args()
+
+    if args.count_tokens and not (core.init() or core.model):
+        logger.critical("Modelo indisponível para count_tokens; rode sem --count-tokens.")
+        return
+    if args.system_instruction:
+        core.SYSTEM_INSTRUCTION_ENABLED = args.system_instruction == "on"
+    count = make_counter(args.count_tokens)
+
+    before = legacy_prompts()
+    after = current_prompts()
+    unit = "tokens" if args.count_tokens else "tokens (~4 chars/token)"
+    print(f"Tokens de entrada por chamada, {unit}; system_instruction={'on' if core.SYSTEM_INSTRUCTION_ENABLED else 'off'}")
+    print(f"{'chamada':<32}{'antes':>8}{'depois':>8}{'(fixo)':>8}{'var':>6}{'redução':>9}")
+    total_before = total_after = 0
+    for (name, _, old_prompt), (_, fixed, new_prompt) in zip(before, after):
+        old_tokens = count(old_prompt)
+        fixed_tokens = count(fixed)
+        new_tokens = fixed_tokens + count(new_prompt)
+        total_before += old_tokens
+        total_after += new_tokens
+        print(f"{name:<32}{old_tokens:>8}{new_tokens:>8}{fixed_tokens:>8}{new_tokens - fixed_tokens:>6}{1 - new_tokens / old_tokens:>9.0%}")
+    print(f"{'TOTAL':<32}{total_before:>8}{total_after:>8}{'':>8}{'':>6}{1 - total_after / total_before:>9.0%}")
+
+
+if __name__ == "__main__":
+    main()
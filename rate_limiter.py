@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: rate_limiter.py (v1 - Limite de taxa do Vertex AI com prioridades, retry e prazo)
+
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import random
+import time
+
+from google.api_core import exceptions as google_exceptions
+
+logger = logging.getLogger(__name__)
+
+# --- Configurações ---
+# Cota de requisições ao modelo por minuto (somando todas as chamadas: NLU, resposta, chamada única)
+MODEL_QUOTA_PER_MINUTE = float(os.environ.get("MODEL_QUOTA_PER_MINUTE", "300"))
+MODEL_BURST = float(os.environ.get("MODEL_BURST", "10"))
+MODEL_MAX_RETRIES = int(os.environ.get("MODEL_MAX_RETRIES", "4"))
+RETRY_BASE_SECONDS = float(os.environ.get("MODEL_RETRY_BASE_SECONDS", "0.5"))
+RETRY_MAX_SECONDS = float(os.environ.get("MODEL_RETRY_MAX_SECONDS", "8"))
+# Orçamento de tempo de uma mensagem para todas as suas chamadas ao modelo (espera + retries)
+MESSAGE_DEADLINE_SECONDS = float(os.environ.get("MODEL_MESSAGE_DEADLINE_SECONDS", "25"))
+
+# Prioridades (menor = atendido antes); compartilhadas com core_executor
+PRIORITY_HIGH = 0  # Onboarding e LOG_FOOD
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2  # Papo, saudações etc.
+
+LOW_VALUE_INTENTS = {"GREETING", "FAREWELL", "AFFIRMATION", "NEGATION", "CHITCHAT", "OUT_OF_SCOPE"}
+
+RETRYABLE_ERRORS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.GatewayTimeout,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.Aborted,
+)
+QUOTA_ERRORS = (google_exceptions.TooManyRequests, google_exceptions.ResourceExhausted)
+
+# Prazo (time.monotonic) e prioridade da mensagem em processamento
+_deadline = contextvars.ContextVar("model_deadline", default=None)
+_priority = contextvars.ContextVar("model_priority", default=PRIORITY_NORMAL)
+
+
+class ModelDeadlineExceeded(Exception):
+    """O orçamento de tempo da mensagem acabou antes de o modelo responder."""
+
+
+def priority_for_intent(intent):
+    """Prioridade de uma chamada ao modelo pela intent do turno (None = manter a do contexto)."""
+    if not intent:
+        return None
+    if intent == "LOG_FOOD" or intent.startswith(("ONBOARDING_", "REPROMPT_")):
+        return PRIORITY_HIGH
+    if intent in LOW_VALUE_INTENTS:
+        return PRIORITY_LOW
+    return None
+
+
+@contextlib.contextmanager
+def message_scope(priority=None, deadline_seconds=MESSAGE_DEADLINE_SECONDS):
+    """Define prioridade e prazo das chamadas ao modelo feitas dentro do bloco.
+
+    Escopos aninhados mantêm o prazo mais curto; a prioridade só muda se for informada.
+    """
+    now = time.monotonic()
+    current = _deadline.get()
+    deadline = now + deadline_seconds if deadline_seconds else None
+    if current is not None and (deadline is None or current < deadline):
+        deadline = current
+    deadline_token = _deadline.set(deadline)
+    priority_token = _priority.set(priority) if priority is not None else None
+    try:
+        yield
+    finally:
+        _deadline.reset(deadline_token)
+        if priority_token is not None:
+            _priority.reset(priority_token)
+
+
+def remaining_seconds():
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+class PriorityTokenBucket:
+    """Token bucket assíncrono: quem espera é servido por prioridade e, na mesma prioridade, por ordem.
+
+    Deve ser usado a partir de um único event loop (o do bot ou o da ponte síncrona do core).
+    """
+
+    def __init__(self, rate_per_second, capacity):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._waiters = []  # heap de (prioridade, seq, future)
+        self._seq = itertools.count()
+        self._pump = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _has_waiters(self):
+        while self._waiters and self._waiters[0][2].done():
+            heapq.heappop(self._waiters)
+        return bool(self._waiters)
+
+    def penalize(self):
+        """Após um 429, esvazia o balde: as próximas chamadas esperam a cota reabrir."""
+        self._refill()
+        self._tokens = min(self._tokens, 0.0)
+
+    async def acquire(self, priority=PRIORITY_NORMAL, timeout=None):
+        """Espera um token; retorna o tempo de espera. Levanta asyncio.TimeoutError se passar do timeout."""
+        self._refill()
+        if not self._has_waiters() and self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.ensure_future(self._run_pump())
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            if not future.done() or future.cancelled():
+                future.cancel()
+                raise
+            # O token chegou junto com o timeout: usa
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        return time.monotonic() - start
+
+    async def _run_pump(self):
+        while self._has_waiters():
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                _, _, future = heapq.heappop(self._waiters)
+                future.set_result(None)
+                continue
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class ModelRateLimiter:
+    """Envolve as chamadas ao modelo: token bucket por prioridade, retry com backoff e prazo da mensagem."""
+
+    def __init__(self, quota_per_minute=MODEL_QUOTA_PER_MINUTE, burst=MODEL_BURST, max_retries=MODEL_MAX_RETRIES):
+        self.bucket = PriorityTokenBucket(quota_per_minute / 60.0, burst)
+        self.max_retries = max_retries
+        self.calls = 0
+        self.retries = 0
+        self.throttled = 0
+        self.quota_errors = 0
+        self.deadline_exceeded = 0
+        self.wait_seconds_total = 0.0
+
+    def _backoff(self, attempt):
+        # "Full jitter": espera aleatória entre 0 e o teto exponencial
+        return random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2**attempt))
+
+    def _check_deadline(self, needed=0.0):
+        remaining = remaining_seconds()
+        if remaining is not None and remaining <= needed:
+            self.deadline_exceeded += 1
+            raise ModelDeadlineExceeded(f"Prazo da mensagem esgotado ({remaining:.1f}s restantes)")
+        return remaining
+
+    async def call(self, fn, *args, priority=None, **kwargs):
+        """await fn(*args, **kwargs) respeitando cota, prioridade, retries e prazo da mensagem."""
+        priority = _priority.get() if priority is None else priority
+        attempt = 0
+        while True:
+            remaining = self._check_deadline()
+            try:
+                waited = await self.bucket.acquire(priority, timeout=remaining)
+            except asyncio.TimeoutError:
+                self.deadline_exceeded += 1
+                raise ModelDeadlineExceeded("Prazo da mensagem esgotado esperando cota do modelo")
+            if waited:
+                self.throttled += 1
+                self.wait_seconds_total += waited
+            self.calls += 1
+            remaining = self._check_deadline()
+            try:
+                if remaining is None:
+                    return await fn(*args, **kwargs)
+                return await asyncio.wait_for(fn(*args, **kwargs), timeout=remaining)
+            except asyncio.TimeoutError:
+                self.deadline_exceeded += 1
+                raise ModelDeadlineExceeded("Prazo da mensagem esgotado aguardando o modelo")
+            except RETRYABLE_ERRORS as e:
+                if isinstance(e, QUOTA_ERRORS):
+                    self.quota_errors += 1
+                    self.bucket.penalize()
+                if attempt >= self.max_retries:
+                    logger.error(f"[Rate Limiter] Desistindo após {attempt + 1} tentativas: {e}")
+                    raise
+                delay = self._backoff(attempt)
+                self._check_deadline(needed=delay)
+                attempt += 1
+                self.retries += 1
+                logger.warning(f"[Rate Limiter] Erro transitório ({type(e).__name__}); tentativa {attempt + 1} em {delay:.2f}s.")
+                await asyncio.sleep(delay)
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "quota_errors": self.quota_errors,
+            "deadline_exceeded": self.deadline_exceeded,
+            "wait_seconds_total": round(self.wait_seconds_total, 3),
+            "tokens": round(self.bucket._tokens, 2),
+            "waiting": sum(1 for _, _, f in self.bucket._waiters if not f.done()),
+        }
+
+
+model_limiter = ModelRateLimiter()
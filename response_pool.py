@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: response_pool.py (v2 - Pool curado versionado no repositório (response_pool.json))
+#
+# Uso: python response_pool.py [--variants 6] [--force]   (gera com o Gemini e grava RESPONSE_POOL_PATH)
+# O response_pool.json do repositório já cobre todas as chaves (variações revisadas à mão), então
+# o deploy padrão responde o onboarding sem o modelo. Ao mudar onboarding.STEPS, rode o comando
+# acima (as chaves novas são geradas) e revise o arquivo antes do commit.
+# As mensagens do onboarding são textos fixos (onboarding.STEPS) que o core mandava ao Gemini só
+# para ganhar o tom da persona. Aqui elas são geradas uma vez (offline ou no warm-up), N variações
+# por campo e tipo de mensagem, com marcadores ({name}, {tdee}...) no lugar dos dados do usuário.
+# Em produção o core sorteia uma variação e preenche os marcadores: a etapa responde sem chamar o
+# modelo. Sem variações válidas para uma chave, cai no texto fixo de onboarding.plain_*.
+
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import threading
+
+import onboarding
+from text_utils import normalize_text
+
+logger = logging.getLogger(__name__)
+
+# --- Configurações ---
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RESPONSE_POOL_ENABLED = os.environ.get("RESPONSE_POOL_ENABLED", "1") == "1"
+RESPONSE_POOL_PATH = os.environ.get("RESPONSE_POOL_PATH", os.path.join(_BASE_DIR, "response_pool.json"))
+VARIANTS_PER_KEY = int(os.environ.get("RESPONSE_POOL_VARIANTS", "6"))
+# Gera no warm-up as chaves que faltarem no arquivo (uma chamada ao modelo por chave)
+GENERATE_ON_WARMUP = os.environ.get("RESPONSE_POOL_GENERATE_ON_WARMUP", "0") == "1"
+MAX_VARIANT_CHARS = 400
+
+QUESTION, REPROMPT, REPROMPT_RANGE, GOAL_SUGGESTION = "question", "reprompt", "reprompt_range", "goal_suggestion"
+# Campos cujo parser pode responder onboarding.OUT_OF_RANGE
+RANGE_FIELDS = ("birth_year", "height_cm", "current_weight_kg", "goal_confirmation")
+# Termos (normalizados) que toda variação da pergunta/reprompt precisa manter: opções e unidades
+REQUIRED_TERMS = {
+    "birth_year": ["ano"],
+    "gender": ["masc", "fem"],
+    "height_cm": ["altura"],
+    "current_weight_kg": ["peso"],
+    "activity_level": ["sedentario", "leve", "moderado", "ativo"],
+    "goal": ["perder", "manter", "ganhar"],
+    "goal_confirmation": ["sim", "kcal"],
+}
+_PLACEHOLDER_RE = re.compile(r"\{(\w+)\}")
+_JSON_LIST_RE = re.compile(r"\[.*\]", re.DOTALL)
+
+_pool = {}  # "tipo:campo" -> [variações com marcadores]
+_loaded = False
+_lock = threading.Lock()
+_rng = random.Random()
+
+
+def pool_keys():
+    keys = []
+    for field in onboarding.STEPS:
+        if field != "goal_confirmation":
+            keys.append(f"{QUESTION}:{field}")
+        keys.append(f"{REPROMPT}:{field}")
+        if field in RANGE_FIELDS:
+            keys.append(f"{REPROMPT_RANGE}:{field}")
+    keys.append(f"{GOAL_SUGGESTION}:goal")
+    return keys
+
+
+def _placeholders(key):
+    return {"name", "tdee", "goal", "suggested"} if key.startswith(GOAL_SUGGESTION) else {"name"}
+
+
+def base_text(key):
+    """Texto fixo (com marcadores) que serve de modelo para as variações da chave."""
+    kind, field = key.split(":", 1)
+    if kind == QUESTION:
+        return f"{{name}}, {onboarding.question(field)}"
+    if kind == GOAL_SUGGESTION:
+        return ("Perfil completo, {name}! 🎉 Seu gasto diário estimado é ~{tdee} kcal e, para {goal}, sugiro uma meta "
+                "de {suggested} kcal/dia. Digite 'sim' para aceitar ou outro valor (1000-10000).")
+    problem = onboarding.OUT_OF_RANGE if kind == REPROMPT_RANGE else None
+    return onboarding.plain_reprompt("{name}", field, problem)
+
+
+def is_valid_variant(key, text):
+    if not isinstance(text, str) or not text.strip() or len(text) > MAX_VARIANT_CHARS:
+        return False
+    rest = _PLACEHOLDER_RE.sub("", text)
+    if set(_PLACEHOLDER_RE.findall(text)) != _placeholders(key) or "{" in rest or "}" in rest:
+        return False
+    kind, field = key.split(":", 1)
+    terms = ["sim"] if kind == GOAL_SUGGESTION else REQUIRED_TERMS.get(field, [])
+    normalized = normalize_text(text)
+    return all(term in normalized for term in terms)
+
+
+def generation_prompt(key, variants=VARIANTS_PER_KEY):
+    return (f"Reescreva a mensagem abaixo do CaloBot de {variants} jeitos diferentes, curtos e amigáveis, em pt-br. "
+            f"Mantenha o mesmo pedido, as mesmas opções/unidades e os marcadores entre chaves exatamente como estão "
+            f"({', '.join('{' + p + '}' for p in sorted(_placeholders(key)))}), sem criar outros.\n"
+            f"Mensagem: \"{base_text(key)}\"\n"
+            f"Retorne APENAS uma lista JSON de strings.")
+
+
+def parse_variants(key, raw):
+    """Resposta do modelo -> variações válidas (descarta as que perderam marcador, opção etc.)."""
+    match = _JSON_LIST_RE.search(raw or "")
+    try:
+        candidates = json.loads(match.group(0)) if match else []
+    except json.JSONDecodeError:
+        candidates = []
+    if not isinstance(candidates, list):
+        return []
+    valid = [c.strip() for c in candidates if is_valid_variant(key, c)]
+    if len(valid) < len(candidates):
+        logger.info(f"[Pool] '{key}': {len(candidates) - len(valid)} variações descartadas.")
+    return list(dict.fromkeys(valid))
+
+
+def load(path=RESPONSE_POOL_PATH):
+    """Carrega o arquivo do pool (ausente ou inválido = pool vazio). Retorna o nº de chaves."""
+    global _pool, _loaded
+    pool = {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        for key, variants in (data.get("variants") or {}).items():
+            valid = [v for v in variants if is_valid_variant(key, v)]
+            if valid:
+                pool[key] = valid
+    except FileNotFoundError:
+        logger.info(f"[Pool] {path} não existe; onboarding usa os textos fixos/Gemini.")
+    except (OSError, ValueError, AttributeError) as e:
+        logger.warning(f"[Pool] Arquivo {path} inválido ({e}); ignorado.")
+    with _lock:
+        _pool = pool
+        _loaded = True
+    logger.info(f"[Pool] {len(pool)} chaves carregadas ({sum(len(v) for v in pool.values())} variações).")
+    return len(pool)
+
+
+def save(path=RESPONSE_POOL_PATH):
+    with _lock:
+        data = {"version": 1, "variants": dict(sorted(_pool.items()))}
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+    logger.info(f"[Pool] Gravado em {path}.")
+
+
+def missing_keys():
+    _ensure_loaded()
+    return [key for key in pool_keys() if key not in _pool]
+
+
+def generate(generate_text, keys=None, variants=VARIANTS_PER_KEY):
+    """Gera as chaves pedidas (padrão: as que faltam). generate_text(prompt) -> str. Retorna o nº de chaves novas."""
+    added = 0
+    for key in missing_keys() if keys is None else keys:
+        try:
+            found = parse_variants(key, generate_text(generation_prompt(key, variants)))
+        except Exception as e:
+            logger.warning(f"[Pool] Geração de '{key}' falhou: {e}")
+            continue
+        if found:
+            with _lock:
+                _pool[key] = found
+            added += 1
+        else:
+            logger.warning(f"[Pool] Nenhuma variação válida para '{key}'.")
+    return added
+
+
+def _ensure_loaded():
+    if not _loaded:
+        load()
+
+
+def covers(kind, field):
+    """True se há variações prontas para (tipo, campo): a etapa pode responder sem o modelo."""
+    if not RESPONSE_POOL_ENABLED:
+        return False
+    _ensure_loaded()
+    return f"{kind}:{field}" in _pool
+
+
+def _render(key, values):
+    variants = _pool.get(key) if RESPONSE_POOL_ENABLED else None
+    if not variants:
+        return None
+    template = _rng.choice(variants)
+    return _PLACEHOLDER_RE.sub(lambda m: str(values.get(m.group(1), m.group(0))), template)
+
+
+def question(user_display_name, field):
+    _ensure_loaded()
+    return _render(f"{QUESTION}:{field}", {"name": user_display_name}) or onboarding.plain_question(user_display_name, field)
+
+
+def reprompt_kind(problem):
+    return REPROMPT_RANGE if problem == onboarding.OUT_OF_RANGE else REPROMPT
+
+
+def reprompt(user_display_name, field, problem=None):
+    _ensure_loaded()
+    return (_render(f"{reprompt_kind(problem)}:{field}", {"name": user_display_name})
+            or onboarding.plain_reprompt(user_display_name, field, problem))
+
+
+def goal_suggestion(user_display_name, tdee, goal, suggested):
+    _ensure_loaded()
+    values = {"name": user_display_name, "tdee": round(tdee), "goal": onboarding.GOAL_LABELS.get(goal, goal), "suggested": suggested}
+    return (_render(f"{GOAL_SUGGESTION}:goal", values)
+            or onboarding.plain_goal_suggestion(user_display_name, tdee, goal, suggested))
+
+
+def stats():
+    with _lock:
+        return {"keys": len(_pool), "variants": sum(len(v) for v in _pool.values()), "missing": len(pool_keys()) - len(_pool)}
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Gera o pool de respostas do onboarding com o Gemini.")
+    parser.add_argument("--variants", type=int, default=VARIANTS_PER_KEY, help="Variações por chave.")
+    parser.add_argument("--force", action="store_true", help="Regera todas as chaves, não só as que faltam.")
+    parser.add_argument("--path", default=RESPONSE_POOL_PATH)
+    args = parser.parse_args()
+
+    import calobot_core  # Só aqui: o core importa este módulo
+
+    load(args.path)
+    if not calobot_core.init():
+        logger.critical("Modelo indisponível; pool não gerado.")
+        return
+    added = generate(calobot_core.generate_pool_text, keys=pool_keys() if args.force else None, variants=args.variants)
+    save(args.path)
+    logger.info(f"{added} chaves geradas. Pool: {stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
-# Nome do arquivo: telegram_bot.py (v3 - Onboarding no /start refatorado, logs melhorados)
+# Nome do arquivo: telegram_bot.py (v17 - Webhook não sobe sem WEBHOOK_SECRET, salvo opt-out explícito)
 
 import logging
 import asyncio
+import hmac
+import signal
 import calobot_core  # Importa nossa lógica principal (v20 ou superior)
+import core_executor  # Limite de concorrência e descarte sob carga
+import http_server  # Servidor HTTP embutido do modo webhook
+import metrics  # Tempos por etapa e /metrics (Prometheus)
+import rate_limiter  # Prioridade e prazo das chamadas ao Gemini
 import firestore_manager  # Importa para acesso direto a verificação de perfil
 from telegram import Update, constants  # Importa constants para ChatAction
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -26,6 +33,39 @@ if TELEGRAM_TOKEN == "7822556645:AAFolOnxLs6MsIRa-RZYBCCnPg30tkXXD84":
         "AVISO: Usando token hardcoded. Considere usar variáveis de ambiente (TELEGRAM_BOT_TOKEN)."
     )
 
+# Streaming: a primeira parte da resposta sai assim que o Gemini começa a gerar e a mensagem
+# é editada em lotes (o Telegram limita edições a ~1 por segundo por chat)
+STREAM_REPLIES = os.environ.get("CALOBOT_STREAM_REPLIES", "0") == "1"
+STREAM_EDIT_INTERVAL_SECONDS = float(os.environ.get("STREAM_EDIT_INTERVAL_SECONDS", "1.0"))
+MAX_MESSAGE_LENGTH = constants.MessageLimit.MAX_TEXT_LENGTH
+# Fila por usuário: mensagens do mesmo usuário são processadas em ordem, uma chamada ao core por vez.
+# A primeira mensagem vai direto ao core; as que chegam durante o processamento viram uma só chamada.
+MAX_PENDING_PER_USER = int(os.environ.get("MAX_PENDING_PER_USER", "5"))
+
+# Modo de recebimento: "polling" (um processo) ou "webhook" (várias réplicas atrás de um balanceador).
+# Teste local do webhook, sem registrar no Telegram:
+#   BOT_MODE=webhook WEBHOOK_SET_ON_START=0 WEBHOOK_SECRET=teste python telegram_bot.py
+#   curl -X POST localhost:8080/telegram -H "X-Telegram-Bot-Api-Secret-Token: teste" -d @update.json
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")  # URL pública base (https://...), sem o caminho
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")  # Conferido no header X-Telegram-Bot-Api-Secret-Token
+# Sem segredo qualquer um que ache a URL envia updates: o modo webhook só sobe assim com este opt-out
+WEBHOOK_ALLOW_NO_SECRET = os.environ.get("WEBHOOK_ALLOW_NO_SECRET", "0") == "1"
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("PORT", "8080"))
+WEBHOOK_SET_ON_START = os.environ.get("WEBHOOK_SET_ON_START", "1") != "0"
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Cache de usuários, write-behind e UserDispatcher guardam estado do usuário no processo. Com várias
+# réplicas isso só é seguro se o balanceador mandar todo update de um usuário para a mesma réplica
+# (hash do from.id do update); nesse caso use WEBHOOK_STICKY_ROUTING=1. Sem isso (padrão), o modo
+# webhook desliga o cache e o atraso do write-behind e não junta mensagens: cada réplica lê o
+# Firestore a cada mensagem. A ordem entre mensagens do mesmo usuário em réplicas diferentes não é
+# garantida nesse caso.
+WEBHOOK_STICKY_ROUTING = os.environ.get("WEBHOOK_STICKY_ROUTING", "0") == "1"
+# Updates processados em paralelo pelo PTB (a ordem por usuário é garantida pelo UserDispatcher)
+BOT_CONCURRENT_UPDATES = int(os.environ.get("BOT_CONCURRENT_UPDATES", "64"))
+
 # Configuração básica de logging
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -61,10 +101,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     # 2. Buscar/Criar usuário e verificar necessidade de Onboarding
     try:
-        # Usamos asyncio.to_thread para chamar a função síncrona do firestore
-        user_data = await asyncio.to_thread(
-            firestore_manager.get_or_create_user, user_id, user_name
-        )
+        # Versão assíncrona do firestore_manager: não ocupa thread do executor
+        user_data = await firestore_manager.get_or_create_user_async(user_id, user_name)
 
         if not user_data:
             logger.error(f"Falha ao obter/criar dados para user {user_id} no /start.")
@@ -106,11 +144,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             logger.info(
                 f"Chamando process_message com '__INTERNAL_ONBOARDING_CHECK__' para user {user_id}."
             )
-            resposta_onboarding = await asyncio.to_thread(
-                calobot_core.process_message,
-                user_id,
-                user_name,
-                "__INTERNAL_ONBOARDING_CHECK__",
+            resposta_onboarding = await core_executor.core_executor.run(
+                lambda: calobot_core.process_message_async(
+                    user_id,
+                    user_name,
+                    "__INTERNAL_ONBOARDING_CHECK__",
+                ),
+                core_executor.PRIORITY_HIGH,
             )
 
             if resposta_onboarding:
@@ -140,47 +180,218 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
 
 
+async def _edit_stream_message(message, text: str, shown: str, final: bool = False) -> str:
+    """Edita a mensagem em streaming; retorna o texto que ficou visível."""
+    try:
+        await message.edit_text(text)
+        return text
+    except BadRequest as e:
+        if "not modified" in str(e).lower():
+            return text
+        raise
+    except RetryAfter as e:
+        if not final:
+            # Edição intermediária: pula, a próxima (ou a final) leva o texto acumulado
+            logger.warning(f"Limite de edições do Telegram atingido; aguardando {e.retry_after}.")
+            return shown
+        delay = getattr(e.retry_after, "total_seconds", lambda: e.retry_after)()
+        await asyncio.sleep(delay)
+        await message.edit_text(text)
+        return text
+
+
+async def _reply_streaming(update: Update, user_id: int, user_name: str, message_text: str):
+    """Envia a resposta do calobot_core em streaming: primeira mensagem cedo, depois edições espaçadas.
+
+    Retorna o texto completo enviado, ou None se o pipeline não produziu resposta.
+    """
+    loop = asyncio.get_running_loop()
+    sent = None
+    text = shown = ""
+    last_edit = 0.0
+    async for chunk in calobot_core.process_message_stream(user_id, user_name, message_text):
+        text += chunk
+        visible = text[:MAX_MESSAGE_LENGTH]
+        if not visible.strip():
+            continue
+        now = loop.time()
+        if sent is None:
+            sent = await update.message.reply_text(visible)
+            shown, last_edit = visible, now
+            logger.info(f"Primeira parte da resposta enviada para {user_id}.")
+        elif visible != shown and now - last_edit >= STREAM_EDIT_INTERVAL_SECONDS:
+            shown, last_edit = await _edit_stream_message(sent, visible, shown), now
+
+    if sent is None:
+        return None
+    visible = text[:MAX_MESSAGE_LENGTH]
+    if visible != shown:
+        await _edit_stream_message(sent, visible, shown, final=True)
+    # O que passar do limite de uma mensagem vai em mensagens novas
+    for start in range(MAX_MESSAGE_LENGTH, len(text), MAX_MESSAGE_LENGTH):
+        await update.message.reply_text(text[start : start + MAX_MESSAGE_LENGTH])
+    return text
+
+
+class UserDispatcher:
+    """Serializa o processamento por usuário e junta rajadas de mensagens numa só chamada ao core.
+
+    Cada usuário com mensagens pendentes tem uma task própria; usuários diferentes rodam em paralelo.
+    Não há espera fixa: usuário ocioso é atendido na hora e só se junta o que acumulou enquanto a
+    chamada anterior rodava.
+    """
+
+    def __init__(self, process, max_pending=MAX_PENDING_PER_USER, coalesce=True):
+        self._process = process  # async (update, context, message_text) -> None
+        self.coalesce = coalesce  # False: uma chamada por mensagem (ainda em ordem)
+        self.max_pending = max_pending
+        self._pending = {}  # user_id -> [(update, context), ...]
+        self._workers = {}  # user_id -> asyncio.Task
+        self._notified = set()  # usuários já avisados de fila cheia (até a próxima rodada)
+        self.received = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.invocations = 0
+
+    def submit(self, user_id: int, update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+        """Enfileira a mensagem; retorna False se a fila do usuário estiver cheia."""
+        pending = self._pending.setdefault(user_id, [])
+        if len(pending) >= self.max_pending:
+            self.dropped += 1
+            return False
+        self.received += 1
+        pending.append((update, context))
+        if user_id not in self._workers:
+            self._workers[user_id] = asyncio.create_task(self._run(user_id))
+        return True
+
+    def should_notify_full(self, user_id: int) -> bool:
+        if user_id in self._notified:
+            return False
+        self._notified.add(user_id)
+        return True
+
+    @staticmethod
+    def _can_coalesce(user_id: int) -> bool:
+        # Respostas de onboarding ("1990", "180"...) precisam ser validadas uma a uma. Sem cache não
+        # se sabe se o usuário está no onboarding (pode ser novo): processa uma mensagem por vez.
+        cached = firestore_manager.user_cache.get(str(user_id))
+        return cached is not None and not (cached.get("user_state") or {}).get("awaiting")
+
+    async def _run(self, user_id: int) -> None:
+        try:
+            while True:
+                pending = self._pending.get(user_id)
+                if not pending:
+                    break
+                batch = pending[:] if self.coalesce and self._can_coalesce(user_id) else pending[:1]
+                del pending[: len(batch)]
+                self._notified.discard(user_id)
+                texts = [update.message.text.strip() for update, _ in batch]
+                if len(batch) > 1:
+                    self.coalesced += len(batch) - 1
+                    logger.info(f"{len(batch)} mensagens de {user_id} juntadas numa só chamada.")
+                self.invocations += 1
+                last_update, last_context = batch[-1]
+                try:
+                    await self._process(last_update, last_context, "\n".join(texts))
+                except Exception as e:
+                    logger.error(f"Erro no processamento enfileirado de {user_id}: {e}", exc_info=True)
+        finally:
+            # Sem await entre o 'break' e aqui: nenhum submit pode se perder no meio
+            self._workers.pop(user_id, None)
+            if not self._pending.get(user_id):
+                self._pending.pop(user_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "active_users": len(self._workers),
+            "pending": sum(len(p) for p in self._pending.values()),
+            "received": self.received,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "invocations": self.invocations,
+        }
+
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handler para mensagens de texto normais."""
+    """Handler para mensagens de texto normais: enfileira no dispatcher do usuário."""
     user = update.effective_user
-    chat_id = update.effective_chat.id
     message_text = update.message.text
     user_id = user.id
-    user_name = user.first_name
 
     # Ignora mensagens muito curtas ou vazias (pode acontecer)
     if not message_text or len(message_text.strip()) < 1:
         logger.info(f"Mensagem vazia recebida de {user_id}. Ignorando.")
         return
 
-    logger.info(
-        f"Mensagem '{message_text}' recebida de {user.name} ({user_id}). Processando com calobot_core..."
-    )
+    logger.info(f"Mensagem '{message_text}' recebida de {user.name} ({user_id}). Enfileirando...")
+    if not user_dispatcher.submit(user_id, update, context):
+        logger.warning(f"Fila de {user_id} cheia ({MAX_PENDING_PER_USER}). Mensagem descartada.")
+        if user_dispatcher.should_notify_full(user_id):
+            await update.message.reply_text(
+                "Calma, ainda estou processando suas mensagens anteriores! ⏳ Já te respondo."
+            )
+
+
+async def _process_text(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str) -> None:
+    """Processa um texto (uma mensagem ou uma rajada juntada) com o calobot_core e responde."""
+    user = update.effective_user
+    chat_id = update.effective_chat.id
+    user_id = user.id
+    user_name = user.first_name
+
+    logger.info(f"Processando com calobot_core para {user.name} ({user_id}): '{message_text}'")
 
     # Feedback visual para o usuário
     await context.bot.send_chat_action(
         chat_id=chat_id, action=constants.ChatAction.TYPING
     )
 
-    try:
-        # Chama a função síncrona principal em uma thread separada
-        resposta_calobot = await asyncio.to_thread(
-            calobot_core.process_message, user.id, user_name, message_text
-        )
-
-        # Verifica se process_message retornou None (indicando que não há resposta a enviar)
-        if resposta_calobot is None:
-            logger.info(
-                f"process_message retornou None para user {user_id}. Nenhuma resposta enviada."
+    priority, local_intent = core_executor.classify_priority(user_id, message_text)
+    # Prioridade e prazo das chamadas ao Gemini; a espera na fila do executor já consome o prazo
+    with rate_limiter.message_scope(priority):
+        try:
+            if STREAM_REPLIES:
+                # A resposta vai sendo enviada/editada durante a geração
+                resposta_stream = await core_executor.core_executor.run(
+                    lambda: _reply_streaming(update, user.id, user_name, message_text),
+                    priority,
+                    local_intent,
+                )
+                if resposta_stream is None:
+                    logger.info(
+                        f"process_message_stream não gerou resposta para user {user_id}. Nenhuma resposta enviada."
+                    )
+                else:
+                    logger.info(f"Resposta (streaming) enviada para {user.name} ({user_id})")
+                return
+
+            # Chama o pipeline assíncrono no event loop do bot, dentro do limite de concorrência
+            resposta_calobot = await core_executor.core_executor.run(
+                lambda: calobot_core.process_message_async(user.id, user_name, message_text),
+                priority,
+                local_intent,
             )
-            return  # Não envia nada
 
-    except Exception as e:
-        logger.error(
-            f"Erro GERAL ao chamar calobot_core.process_message para user {user_id}: {e}",
-            exc_info=True,
-        )
-        resposta_calobot = "Xiii, deu um bug aqui no meu processamento! 🤯 Tente de novo daqui a pouco, por favor?"
+            # Verifica se process_message retornou None (indicando que não há resposta a enviar)
+            if resposta_calobot is None:
+                logger.info(
+                    f"process_message retornou None para user {user_id}. Nenhuma resposta enviada."
+                )
+                return  # Não envia nada
+
+        except core_executor.CoreOverloaded as e:
+            # Core saturado: resposta pronta, sem chamar o modelo
+            logger.warning(f"Core saturado ({e.reason}); resposta rápida para user {user_id}.")
+            resposta_calobot = e.reply
+
+        except Exception as e:
+            logger.error(
+                f"Erro GERAL ao chamar calobot_core.process_message para user {user_id}: {e}",
+                exc_info=True,
+            )
+            resposta_calobot = "Xiii, deu um bug aqui no meu processamento! 🤯 Tente de novo daqui a pouco, por favor?"
 
     # Envia a resposta do CaloBot de volta ao usuário
     if resposta_calobot:  # Garante que não é None ou vazia
@@ -207,6 +418,123 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
             logger.error(f"Falha ao notificar usuário sobre erro: {e_notify}")
 
 
+user_dispatcher = UserDispatcher(_process_text)
+
+
+# --- Modo webhook ---
+def build_webhook_routes(application: Application) -> dict:
+    """Rotas do servidor HTTP: webhook do Telegram, /healthz (processo vivo) e /readyz (pronto p/ tráfego).
+
+    Levanta ValueError sem WEBHOOK_SECRET (a não ser com WEBHOOK_ALLOW_NO_SECRET=1).
+    """
+    if not WEBHOOK_SECRET and not WEBHOOK_ALLOW_NO_SECRET:
+        raise ValueError("WEBHOOK_SECRET não definido (ou use WEBHOOK_ALLOW_NO_SECRET=1).")
+
+    async def telegram_webhook(request: http_server.Request):
+        if WEBHOOK_SECRET and not hmac.compare_digest(
+            request.headers.get("x-telegram-bot-api-secret-token", ""), WEBHOOK_SECRET
+        ):
+            logger.warning("Webhook com secret token inválido recusado.")
+            return http_server.text_response(403, "forbidden")
+        try:
+            update = Update.de_json(request.json(), application.bot)
+        except Exception as e:
+            logger.warning(f"Update inválido no webhook: {e}")
+            return http_server.text_response(400, "bad update")
+        # Responde logo ao Telegram; o processamento segue pela fila do Application
+        await application.update_queue.put(update)
+        return http_server.text_response(200, "ok")
+
+    async def healthz(request: http_server.Request):
+        return http_server.text_response(200, "ok")
+
+    async def readyz(request: http_server.Request):
+        checks = {
+            "firestore": calobot_core.db is not None,
+            "model": calobot_core.model is not None,
+            "application": application.running,
+        }
+        return http_server.json_response(200 if all(checks.values()) else 503, checks)
+
+    return {
+        ("POST", WEBHOOK_PATH): telegram_webhook,
+        ("GET", "/healthz"): healthz,
+        ("GET", "/readyz"): readyz,
+        **({("GET", "/metrics"): metrics.metrics_handler} if metrics.METRICS_ENABLED else {}),
+    }
+
+
+async def run_webhook(application: Application) -> None:
+    """Roda o Application alimentado pelo servidor HTTP embutido até SIGINT/SIGTERM.
+
+    Várias réplicas: ver WEBHOOK_STICKY_ROUTING (sem roteamento por usuário, main() já desligou o
+    estado por usuário em processo antes de chegar aqui).
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:  # Windows
+            pass
+
+    server = http_server.HTTPServer(build_webhook_routes(application))
+    async with application:  # initialize() / shutdown()
+        await calobot_core.warmup_async()  # Canais do loop abertos antes do /readyz responder 200
+        await application.start()
+        if WEBHOOK_SET_ON_START:
+            if not WEBHOOK_URL:
+                logger.critical("ERRO FATAL: WEBHOOK_URL não definido (ou use WEBHOOK_SET_ON_START=0).")
+                await application.stop()
+                return
+            # Idempotente: todas as réplicas registram a mesma URL do balanceador
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+            )
+            logger.info(f"Webhook registrado no Telegram: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+        await server.start(WEBHOOK_LISTEN, WEBHOOK_PORT)
+        try:
+            await stop_event.wait()
+        finally:
+            logger.info("Encerrando servidor do webhook...")
+            await server.stop()
+            await application.stop()
+
+
+def register_metrics_collectors() -> None:
+    """Estatísticas dos componentes do bot exportadas no /metrics."""
+    metrics.register_collector("user_dispatcher", user_dispatcher.stats)
+    metrics.register_collector("core_executor", core_executor.core_executor.stats)
+    metrics.register_collector("touch_flusher", firestore_manager.touch_flusher.stats)
+    metrics.register_collector("user_cache", firestore_manager.user_cache.stats)
+
+
+async def _post_init(application: Application) -> None:
+    # post_init do modo polling (já no event loop do bot): canais presos ao loop e /metrics (METRICS_PORT)
+    await calobot_core.warmup_async()
+    application.bot_data["metrics_server"] = await metrics.start_server()
+
+
+async def _post_shutdown(application: Application) -> None:
+    server = application.bot_data.pop("metrics_server", None)
+    if server:
+        await server.stop()
+
+
+def register_handlers(application: Application) -> None:
+    """Handlers do bot (também usados pelo loadtest_bot com um Application de teste)."""
+    application.add_handler(CommandHandler("start", start))
+    # Handler principal para mensagens de texto que NÃO são comandos
+    application.add_handler(
+        MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message)
+    )
+    # Registra o handler de erro
+    application.add_error_handler(error_handler)
+
+
 # --- Função Principal ---
 def main() -> None:
     """Inicia o bot e o mantém rodando."""
@@ -220,16 +548,30 @@ def main() -> None:
         )
         return
 
-    # Verifica dependências críticas antes de iniciar
-    if not calobot_core.db:
-        logger.critical(
-            "ERRO FATAL: Conexão com Firestore não estabelecida em calobot_core. Bot não pode iniciar."
-        )
-        return
-    if not calobot_core.model:
-        logger.critical(
-            "ERRO FATAL: Modelo Gemini não carregado em calobot_core. Bot não pode iniciar."
-        )
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        if not WEBHOOK_ALLOW_NO_SECRET:
+            logger.critical(
+                "ERRO FATAL: modo webhook sem WEBHOOK_SECRET. Defina o segredo (ou WEBHOOK_ALLOW_NO_SECRET=1 para testes locais)."
+            )
+            return
+        logger.warning("WEBHOOK_SECRET vazio (WEBHOOK_ALLOW_NO_SECRET=1): qualquer um que ache a URL pode enviar updates.")
+
+    if BOT_MODE == "webhook" and not WEBHOOK_STICKY_ROUTING:
+        # Outra réplica pode atender o próximo update do usuário: nada de estado dele só aqui
+        firestore_manager.disable_process_user_state()
+        user_dispatcher.coalesce = False
+        logger.info("Webhook sem roteamento por usuário: cache de usuários e junção de mensagens desligados.")
+
+    # Cria os clientes e abre os canais antes do polling: o primeiro usuário não paga o cold start
+    if not calobot_core.warmup():
+        if not calobot_core.db:
+            logger.critical(
+                "ERRO FATAL: Conexão com Firestore não estabelecida em calobot_core. Bot não pode iniciar."
+            )
+        if not calobot_core.model:
+            logger.critical(
+                "ERRO FATAL: Modelo Gemini não carregado em calobot_core. Bot não pode iniciar."
+            )
         return
 
     logger.info("Verificações de dependência OK.")
@@ -238,29 +580,44 @@ def main() -> None:
     # persistence = PicklePersistence(filepath="calobot_persistence.pkl")
     # application = Application.builder().token(TELEGRAM_TOKEN).persistence(persistence).build()
 
-    logger.info("Criando Application do bot Telegram...")
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    logger.info(f"Criando Application do bot Telegram (modo {BOT_MODE})...")
+    builder = Application.builder().token(TELEGRAM_TOKEN).concurrent_updates(BOT_CONCURRENT_UPDATES)
+    if BOT_MODE == "webhook":
+        builder = builder.updater(None)  # Updates chegam pelo servidor HTTP, não por polling
+    else:
+        builder = builder.post_init(_post_init).post_shutdown(_post_shutdown)
+    application = builder.build()
     logger.info("Application criada.")
 
-    # Registra os handlers
-    application.add_handler(CommandHandler("start", start))
-    # Handler principal para mensagens de texto que NÃO são comandos
-    application.add_handler(
-        MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message)
-    )
-
-    # Registra o handler de erro
-    application.add_error_handler(error_handler)
+    register_handlers(application)
     logger.info("Handlers registrados (start, message, error).")
+    if metrics.METRICS_ENABLED:
+        register_metrics_collectors()
+        logger.info("Métricas ativas (/metrics no formato Prometheus).")
 
-    # Inicia o Bot usando Polling
-    logger.info("Iniciando o bot com polling...")
-    try:
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
-    except Exception as e:
-        logger.critical(
-            f"Erro fatal ao iniciar ou rodar o polling do bot: {e}", exc_info=True
-        )
+    if BOT_MODE == "webhook":
+        logger.info(f"Iniciando o bot com webhook em {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}...")
+        try:
+            asyncio.run(run_webhook(application))
+        except Exception as e:
+            logger.critical(f"Erro fatal no modo webhook: {e}", exc_info=True)
+    else:
+        # Inicia o Bot usando Polling
+        logger.info("Iniciando o bot com polling...")
+        try:
+            application.run_polling(allowed_updates=Update.ALL_TYPES)
+        except Exception as e:
+            logger.critical(
+                f"Erro fatal ao iniciar ou rodar o polling do bot: {e}", exc_info=True
+            )
+
+    # Grava os "touches" (last_interaction_at) ainda pendentes no write-behind e fecha os clientes
+    logger.info("Gravando escritas pendentes do Firestore...")
+    firestore_manager.touch_flusher.stop()
+    logger.info(f"Write-behind finalizado: {firestore_manager.touch_flusher.stats()}")
+    calobot_core.close()
+    logger.info(f"Dispatcher por usuário: {user_dispatcher.stats()}")
+    logger.info(f"Executor do core: {core_executor.core_executor.stats()}")
 
     logger.info("Bot encerrado.")
 
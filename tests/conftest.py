@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: tests/conftest.py (v1 - Módulos do projeto importáveis pelos testes)
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: tests/test_core_executor.py (v1 - Prioridade dos pedidos com e sem cache de usuários)
+
+import pytest
+
+import core_executor
+import firestore_manager as fm
+from rate_limiter import PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL
+
+
+@pytest.fixture
+def no_user_cache(monkeypatch):
+    # Como em firestore_manager.disable_process_user_state(): nenhum usuário fica em cache
+    monkeypatch.setattr(fm, "user_cache", fm.UserCache(max_entries=0))
+    fm.user_cache.put("7", {"user_state": {"awaiting": None}})
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("oi", (PRIORITY_LOW, "GREETING")),
+        ("tchau", (PRIORITY_LOW, "FAREWELL")),
+        ("obrigado", (PRIORITY_LOW, "AFFIRMATION")),
+        ("comi 2 ovos", (PRIORITY_HIGH, "LOG_FOOD")),
+        ("quanto falta hoje?", (PRIORITY_NORMAL, "GET_STATUS")),
+        ("masc", (PRIORITY_NORMAL, None)),
+        # Pode ser a confirmação da meta de um usuário no onboarding: nunca vira resposta pronta
+        ("sim", (PRIORITY_HIGH, None)),
+        ("ok", (PRIORITY_HIGH, None)),
+    ],
+)
+def test_priority_without_user_cache(no_user_cache, text, expected):
+    assert fm.user_cache.get("7") is None
+    assert core_executor.classify_priority(7, text) == expected
+
+
+def test_priority_with_cached_state(monkeypatch):
+    monkeypatch.setattr(fm, "user_cache", fm.UserCache())
+    fm.user_cache.put("1", {"user_state": {"awaiting": "goal"}})
+    fm.user_cache.put("2", {"user_state": {"awaiting": None}})
+    assert core_executor.classify_priority(1, "oi") == (PRIORITY_HIGH, None)
+    assert core_executor.classify_priority(2, "oi") == (PRIORITY_LOW, "GREETING")
+    assert core_executor.classify_priority(2, "ok") == (PRIORITY_LOW, "AFFIRMATION")
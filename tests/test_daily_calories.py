@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: tests/test_daily_calories.py (v1 - Registro de calorias e troca de dia contra o fake_backends)
+
+import asyncio
+import datetime
+
+import pytest
+
+import fake_backends
+import firestore_manager as fm
+
+TODAY = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d")
+YESTERDAY = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+
+
+@pytest.fixture
+def store(monkeypatch):
+    store = fake_backends.FakeFirestore()
+    store.load({
+        "users/1": {
+            "diet_settings": {"daily_calorie_goal": 2000},
+            "daily_tracking": {"date": YESTERDAY, "calories_consumed": 1900},
+        },
+    })
+    for name in ("db", "_initialized", "_async_client_override"):
+        monkeypatch.setattr(fm, name, getattr(fm, name))
+    fm.set_clients(store, store.async_client())
+    return store
+
+
+def _user(store):
+    return store.dump()["users/1"]
+
+
+def test_rollover_log_starts_new_day_and_closes_old(store):
+    fm.user_cache.put("1", _user(store))
+    assert fm.update_daily_calories(1, 300, "pão")
+    assert fm.update_daily_calories(1, 200, "café")
+    data = store.dump()
+    assert data["users/1"]["daily_tracking"] == {"date": TODAY, "calories_consumed": 500}
+    assert data[f"users/1/daily_logs/{TODAY}"]["calories_consumed"] == 500
+    assert data["users/1/stats/rolling"]["days"][YESTERDAY]["kcal"] == 1900
+    assert fm.user_cache.get("1")["daily_tracking"] == {"date": TODAY, "calories_consumed": 500}
+
+
+def test_stale_replicas_do_not_reset_each_other(store):
+    # Duas réplicas sem cache leram o documento de ontem antes de qualquer uma gravar
+    stale = _user(store)
+    fm.user_cache.put("1", stale)
+    assert fm.update_daily_calories(1, 300, "pão")
+    fm.user_cache.put("1", stale)
+    assert asyncio.run(fm.update_daily_calories_async(1, 200, "café"))
+    assert _user(store)["daily_tracking"] == {"date": TODAY, "calories_consumed": 500}
+    assert store.dump()["users/1/stats/rolling"]["days"][YESTERDAY]["kcal"] == 1900
+
+
+def test_late_rollover_in_get_or_create_keeps_logged_calories(store):
+    stale = _user(store)
+    assert fm.update_daily_calories(1, 300, "pão")
+    fm.user_cache.put("1", stale)  # Esta réplica ainda acha que o dia é ontem
+    user_data = fm.get_or_create_user(1)
+    assert user_data["daily_tracking"] == {"date": TODAY, "calories_consumed": 300}
+    assert _user(store)["daily_tracking"] == {"date": TODAY, "calories_consumed": 300}
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: tests/test_goal_batch.py (v2 - Recálculo sempre roda contra o fake_backends)
+
+import datetime
+import random
+
+import numpy as np
+
+import fake_backends
+import firestore_manager as fm
+import goal_batch
+
+THIS_YEAR = datetime.datetime.now(datetime.timezone.utc).year
+
+
+def _scalar_chain(profile):
+    age = fm.calculate_age(profile.get("birth_year"))
+    bmr = fm.calculate_bmr_mifflin(profile.get("current_weight_kg"), profile.get("height_cm"), age, profile.get("gender"))
+    tdee = fm.calculate_tdee(bmr, profile.get("activity_level"))
+    return {"age": age, "bmr": bmr, "tdee": tdee, "goal_kcal": fm.suggest_calorie_goal(tdee, profile.get("goal"))}
+
+
+def _assert_same_as_scalar(profiles):
+    result = goal_batch.compute(goal_batch.profile_columns(profiles), THIS_YEAR)
+    for i, profile in enumerate(profiles):
+        expected = _scalar_chain(profile)
+        for stage, value in expected.items():
+            ok = result["goal_ok" if stage == "goal_kcal" else f"{stage}_ok"][i]
+            got = int(result[stage][i]) if ok else None
+            assert got == value, f"{stage} de {profile}: vetorizado {got}, escalar {value}"
+            assert value is None or type(value) is int
+
+
+def _random_profile(rng):
+    return {
+        "birth_year": rng.choice([None, 0, "", "19x0", True, 1990.7, "1990.0", rng.randint(1890, THIS_YEAR + 5), str(rng.randint(1900, THIS_YEAR))]),
+        "current_weight_kg": rng.choice([None, "80,5", "abc", float("nan"), float("inf"), -5, rng.uniform(20, 300),
+                                         round(rng.uniform(30, 200), 1), rng.randint(30, 200), str(rng.randint(40, 150))]),
+        "height_cm": rng.choice([None, "175", rng.uniform(100, 250), rng.randint(100, 220), round(rng.uniform(100, 250), 2)]),
+        "gender": rng.choice([None, 1, "x", "male", "female", " Male ", "FEMALE"]),
+        "activity_level": rng.choice([None, "foo", " LIGHT", *fm.ACTIVITY_MULTIPLIERS]),
+        "goal": rng.choice([None, "x", "GAIN ", "lose", "maintain", "gain"]),
+    }
+
+
+def test_compute_matches_scalar_chain_on_random_profiles():
+    rng = random.Random(1234)
+    _assert_same_as_scalar([_random_profile(rng) for _ in range(20000)])
+
+
+def test_compute_matches_scalar_chain_on_half_rounding():
+    # Alturas com frações de 6.25 levam o BMR a x.25/x.5/x.75 (x.5 testa o arredondamento meia-para-par)
+    profiles = [
+        {"birth_year": THIS_YEAR - age, "current_weight_kg": weight, "height_cm": height + fraction,
+         "gender": gender, "activity_level": activity, "goal": goal}
+        for age in (25, 30, 31)
+        for weight in (60, 70.5, 81)
+        for height in (160, 170)
+        for fraction in (0, 0.2, 0.4, 0.6, 0.8)
+        for gender in ("male", "female")
+        for activity in fm.ACTIVITY_MULTIPLIERS
+        for goal in goal_batch.GOAL_CODES
+    ]
+    assert any(_scalar_chain(p)["bmr"] is not None and
+               ((10 * p["current_weight_kg"]) + (6.25 * p["height_cm"])) % 1 == 0.5 for p in profiles)
+    _assert_same_as_scalar(profiles)
+
+
+def test_tdee_and_goal_match_scalar_on_every_integer():
+    # Todos os BMR/TDEE inteiros da faixa real: cobre cada x.5 de TDEE, déficit/superávit e meta/GOAL_ROUNDING
+    bmr = np.arange(500, 4001, dtype=np.int64)
+    for activity, multiplier in fm.ACTIVITY_MULTIPLIERS.items():
+        tdee, ok = goal_batch.tdee(bmr, np.ones(bmr.shape, bool), np.full(bmr.shape, multiplier))
+        assert ok.all()
+        assert tdee.tolist() == [fm.calculate_tdee(int(b), activity) for b in bmr]
+    tdee_values = np.arange(500, 8001, dtype=np.int64)
+    for goal, code in goal_batch.GOAL_CODES.items():
+        suggested, ok = goal_batch.suggest_goal(tdee_values, np.ones(tdee_values.shape, bool), np.full(tdee_values.shape, code, np.int8))
+        assert ok.all()
+        assert suggested.tolist() == [fm.suggest_calorie_goal(int(t), goal) for t in tdee_values]
+
+
+def test_missing_and_invalid_fields_are_masked():
+    valid = {"birth_year": 1990, "current_weight_kg": 80, "height_cm": 180, "gender": "male", "activity_level": "light", "goal": "lose"}
+    profiles = [valid, {}]
+    for field, bad in [("birth_year", None), ("birth_year", THIS_YEAR + 1), ("birth_year", "19x0"), ("current_weight_kg", None),
+                       ("current_weight_kg", "abc"), ("height_cm", float("nan")), ("gender", "x"), ("activity_level", "foo"), ("goal", None)]:
+        profiles.append({**valid, field: bad})
+    result = goal_batch.compute(goal_batch.profile_columns(profiles), THIS_YEAR)
+    assert result["goal_ok"].tolist() == [True] + [False] * (len(profiles) - 1)
+    _assert_same_as_scalar(profiles)
+
+
+def test_recompute_goals_only_touches_suggested(monkeypatch):
+    profile = {"birth_year": 1990, "current_weight_kg": 80, "height_cm": 180, "gender": "male", "activity_level": "light", "goal": "lose"}
+    suggested = _scalar_chain(profile)["goal_kcal"]
+    docs = {
+        "users/1": {"profile": profile, "diet_settings": {"daily_calorie_goal": suggested + 100, "goal_source": "suggested"}},
+        "users/2": {"profile": profile, "diet_settings": {"daily_calorie_goal": suggested + 100, "goal_source": "custom"}},
+        "users/3": {"profile": profile, "diet_settings": {"daily_calorie_goal": suggested + 100}},  # Sem marca: pode ser meta digitada
+        "users/4": {"profile": profile, "diet_settings": {"daily_calorie_goal": suggested}},  # Sem marca, igual à sugestão
+        "users/5": {"profile": profile, "diet_settings": {"daily_calorie_goal": None}},  # Onboarding em andamento
+    }
+    store = fake_backends.FakeFirestore()
+    store.load(docs)
+    for name in ("db", "_initialized", "_async_client_override"):
+        monkeypatch.setattr(fm, name, getattr(fm, name))
+    fm.set_clients(store, store.async_client())
+
+    stats = goal_batch.recompute_goals(page_size=2, this_year=THIS_YEAR)
+    assert (stats["users_eligible"], stats["goals_changed"], stats["users_unmarked"], stats["unmarked_backfilled"]) == (1, 1, 2, 0)
+    settings = {path: doc["diet_settings"] for path, doc in store.dump().items()}
+    assert settings["users/1"]["daily_calorie_goal"] == suggested
+    assert settings["users/2"] == docs["users/2"]["diet_settings"]
+    assert settings["users/3"] == docs["users/3"]["diet_settings"]
+    assert settings["users/4"] == docs["users/4"]["diet_settings"]
+
+    stats = goal_batch.recompute_goals(page_size=2, this_year=THIS_YEAR, backfill_unmarked=True)
+    assert (stats["goals_changed"], stats["unmarked_backfilled"]) == (0, 1)
+    settings = {path: doc["diet_settings"] for path, doc in store.dump().items()}
+    assert settings["users/4"] == {"daily_calorie_goal": suggested, "goal_source": "suggested"}
+    assert "goal_source" not in settings["users/3"]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: tests/test_migrate_daily_logs.py (v1 - Migração de log_today contra o fake_backends)
+
+import fake_backends
+import firestore_manager as fm
+
+
+def _use_store(monkeypatch, docs):
+    store = fake_backends.FakeFirestore()
+    store.load(docs)
+    for name in ("db", "_initialized", "_async_client_override"):
+        monkeypatch.setattr(fm, name, getattr(fm, name))
+    fm.set_clients(store, store.async_client())
+    return store
+
+
+def test_migrate_moves_entries_and_is_idempotent(monkeypatch):
+    log = [{"food": "arroz", "kcal": 200}, {"food": "feijão", "kcal": 150}, {"food": "ovo", "kcal": 80}]
+    docs = {
+        "users/1": {"daily_tracking": {"date": "2026-10-16", "calories_consumed": 430, "log_today": log}},
+        "users/2": {"daily_tracking": {"date": "2026-10-16", "calories_consumed": 0}},  # Já no formato novo
+        "users/3": {"daily_tracking": {"date": "2026-10-15", "calories_consumed": 0, "log_today": []}},
+    }
+    store = _use_store(monkeypatch, docs)
+
+    dry = fm.migrate_daily_tracking(page_size=2, dry_run=True)
+    assert dry == {"users_scanned": 3, "users_migrated": 2, "entries_moved": 3}
+    assert store.dump() == docs
+
+    stats = fm.migrate_daily_tracking(page_size=2)
+    assert stats == dry
+    data = store.dump()
+    day = "users/1/daily_logs/2026-10-16"
+    assert [data[f"{day}/entries/legacy-{i:04d}"] for i in range(3)] == log
+    assert {k: data[day][k] for k in ("date", "calories_consumed", "entry_count")} == {
+        "date": "2026-10-16", "calories_consumed": 430, "entry_count": 3,
+    }
+    assert "log_today" not in data["users/1"]["daily_tracking"]
+    assert data["users/1"]["daily_tracking"]["calories_consumed"] == 430
+    assert data["users/2"] == docs["users/2"]
+    assert data["users/3/daily_logs/2026-10-15"]["entry_count"] == 0
+
+    # Reexecutar não acha mais nada para mover e não muda nenhum documento
+    assert fm.migrate_daily_tracking(page_size=2) == {"users_scanned": 3, "users_migrated": 0, "entries_moved": 0}
+    assert store.dump() == data
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: tests/test_nlu_cache.py (v1 - Prazo das entradas vindas do store compartilhado)
+
+import asyncio
+import datetime
+
+import fake_backends
+import nlu_cache
+
+NOW = datetime.datetime.now(datetime.timezone.utc)
+
+
+def _cache_with_store(expires_at):
+    store = fake_backends.FakeFirestore()
+    shared = nlu_cache.FirestoreNLUStore(store)
+    doc_id = shared._doc_id(nlu_cache.make_key("valeu"))
+    store.load({f"nlu_cache/{doc_id}": {"key": "valeu", "intent": "AFFIRMATION", "entities": {}, "expires_at": expires_at}})
+    return nlu_cache.NLUCache(ttl_seconds=6 * 3600, backing_store=shared)
+
+
+def _local_ttl(cache):
+    ((expires_at, _),) = cache._data.values()
+    return expires_at - nlu_cache.time.monotonic()
+
+
+def test_store_hit_keeps_remaining_ttl():
+    cache = _cache_with_store(NOW + datetime.timedelta(seconds=60))
+    assert cache.get("Valeu!") == {"intent": "AFFIRMATION", "entities": {}}
+    assert 0 < _local_ttl(cache) <= 60
+    assert cache.stats()["store_hits"] == 1
+
+
+def test_store_hit_never_outlives_local_ttl():
+    cache = _cache_with_store(NOW + datetime.timedelta(days=30))
+    assert asyncio.run(cache.get_async("valeu"))["intent"] == "AFFIRMATION"
+    assert _local_ttl(cache) <= cache.ttl_seconds
+
+
+def test_expired_store_entry_is_a_miss():
+    cache = _cache_with_store(NOW - datetime.timedelta(seconds=1))
+    assert cache.get("valeu") is None
+    assert not cache._data and cache.stats()["misses"] == 1
+
+
+def test_remaining_ttl_at_or_below_zero_is_not_cached():
+    cache = nlu_cache.NLUCache()
+    assert cache._after_store_lookup("valeu", {"intent": "AFFIRMATION", "entities": {}, "expires_in": 0}) is None
+    assert not cache._data
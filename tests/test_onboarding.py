@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: tests/test_onboarding.py (v1 - Parsers locais do onboarding em tabela)
+
+import pytest
+
+import onboarding
+from onboarding import ACCEPT, OUT_OF_RANGE
+
+# (campo, resposta do usuário, (valor, problema) esperado)
+CASES = [
+    # Ano de nascimento
+    ("birth_year", "1990", (1990, None)),
+    ("birth_year", "nasci em 1985!", (1985, None)),
+    ("birth_year", "1890", (None, OUT_OF_RANGE)),
+    ("birth_year", "12", (None, OUT_OF_RANGE)),
+    ("birth_year", "não sei", (None, None)),
+    # Gênero (pt/en)
+    ("gender", "masc", ("male", None)),
+    ("gender", "Feminino", ("female", None)),
+    ("gender", "sou mulher", ("female", None)),
+    ("gender", "male", ("male", None)),
+    ("gender", "homem e mulher", (None, None)),
+    # Altura: cm, metros com vírgula/ponto, "1m80"
+    ("height_cm", "175", (175, None)),
+    ("height_cm", "1,80", (180, None)),
+    ("height_cm", "1.75 m", (175, None)),
+    ("height_cm", "1m80", (180, None)),
+    ("height_cm", "1 metro e 65", (165, None)),
+    ("height_cm", "175 cm", (175, None)),
+    ("height_cm", "300", (None, OUT_OF_RANGE)),
+    ("height_cm", "alto", (None, None)),
+    # Peso: vírgula decimal, libras
+    ("current_weight_kg", "80,5kg", (80.5, None)),
+    ("current_weight_kg", "70.5", (70.5, None)),
+    ("current_weight_kg", "176 lbs", (79.8, None)),
+    ("current_weight_kg", "20", (None, OUT_OF_RANGE)),
+    ("current_weight_kg", "pesado", (None, None)),
+    # Atividade: sinônimos pt/en, posição da opção, frase longa vence a contida
+    ("activity_level", "sedentário", ("sedentary", None)),
+    ("activity_level", "faço caminhada leve", ("light", None)),
+    ("activity_level", "Moderada", ("moderate", None)),
+    ("activity_level", "sou ativa", ("active", None)),
+    ("activity_level", "muito ativo", ("extra_active", None)),
+    ("activity_level", "very active", ("extra_active", None)),
+    ("activity_level", "5", ("extra_active", None)),
+    ("activity_level", "não muito ativo", (None, None)),
+    ("activity_level", "sedentário mas faço caminhada", (None, None)),
+    ("activity_level", "9", (None, None)),
+    # Objetivo
+    ("goal", "perder peso", ("lose", None)),
+    ("goal", "quero emagrecer", ("lose", None)),
+    ("goal", "manter", ("maintain", None)),
+    ("goal", "ganhar massa", ("gain", None)),
+    ("goal", "bulk", ("gain", None)),
+    ("goal", "2", ("maintain", None)),
+    ("goal", "não quero perder peso", (None, None)),
+    ("goal", "nem perder nem ganhar", (None, None)),
+    ("goal", "ganhar massa e perder gordura", (None, None)),
+    # Confirmação da meta: palavras de "sim", número com milhar/decimal
+    ("goal_confirmation", "sim", (ACCEPT, None)),
+    ("goal_confirmation", "Ok, aceito!", (ACCEPT, None)),
+    ("goal_confirmation", "tá bom", (ACCEPT, None)),
+    ("goal_confirmation", "yes", (ACCEPT, None)),
+    ("goal_confirmation", "1800", (1800, None)),
+    ("goal_confirmation", "2.000 kcal", (2000, None)),
+    ("goal_confirmation", "1.800,5", (1800, None)),
+    ("goal_confirmation", "500", (None, OUT_OF_RANGE)),
+    ("goal_confirmation", "talvez", (None, None)),
+    # Sem etapa ou sem texto
+    ("unknown_field", "1990", (None, None)),
+    ("birth_year", "   ", (None, None)),
+]
+
+
+@pytest.mark.parametrize("field, text, expected", CASES)
+def test_parse_answer(field, text, expected):
+    assert onboarding.parse_answer(field, text) == expected
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("80,5", 80.5),
+        ("2.000", 2000.0),
+        ("10,000", 10000.0),
+        ("1.800,5", 1800.5),
+        ("1,800.5", 1800.5),
+        ("1.800.000", 1800000.0),
+        ("sem número", None),
+    ],
+)
+def test_number_separators(text, expected):
+    assert onboarding._number(text) == expected
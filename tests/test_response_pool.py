@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: tests/test_response_pool.py (v1 - Pool versionado cobre o onboarding inteiro)
+
+import json
+
+import onboarding
+import response_pool
+
+
+def test_committed_pool_covers_every_key_with_valid_variants():
+    with open(response_pool.RESPONSE_POOL_PATH, encoding="utf-8") as f:
+        variants = json.load(f)["variants"]
+    assert set(variants) == set(response_pool.pool_keys())
+    for key, texts in variants.items():
+        assert texts, key
+        assert all(response_pool.is_valid_variant(key, text) for text in texts), key
+
+
+def test_rendered_variants_have_no_placeholders_left():
+    response_pool.load()
+    assert response_pool.stats()["missing"] == 0
+    for field in onboarding.STEPS:
+        if field != "goal_confirmation":
+            assert "{" not in response_pool.question("Ana", field)
+        assert "{" not in response_pool.reprompt("Ana", field)
+        assert "{" not in response_pool.reprompt("Ana", field, onboarding.OUT_OF_RANGE)
+    text = response_pool.goal_suggestion("Ana", 2150.4, "lose", 1700)
+    assert "2150" in text and "1700" in text and "perder peso" in text
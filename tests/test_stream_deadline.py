@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: tests/test_stream_deadline.py (v1 - Stream da resposta parado respeita o prazo da mensagem)
+
+import asyncio
+import time
+
+import pytest
+
+import calobot_core as core
+import fake_backends
+import firestore_manager as fm
+import rate_limiter
+
+
+class StallingModel(fake_backends.FakeGenerativeModel):
+    """Modelo cujo stream entrega `chunks_before_stall` pedaços e depois trava."""
+
+    def __init__(self, chunks_before_stall, **kwargs):
+        super().__init__(**kwargs)
+        self.chunks_before_stall = chunks_before_stall
+        self.closed = False
+
+    async def _stream(self, text):
+        try:
+            for piece in text.split(" ")[:self.chunks_before_stall]:
+                yield fake_backends.FakeResponse(piece + " ")
+            await asyncio.sleep(3600)
+        finally:
+            self.closed = True
+
+
+@pytest.fixture
+def backends(monkeypatch):
+    for name in ("db", "model", "reply_model", "nlu_model", "generation_config", "safety_settings", "_initialized"):
+        monkeypatch.setattr(core, name, getattr(core, name))
+    for name in ("db", "_initialized", "_async_client_override"):
+        monkeypatch.setattr(fm, name, getattr(fm, name))
+    monkeypatch.setattr(fm, "user_cache", fm.UserCache())
+    monkeypatch.setattr(rate_limiter, "model_limiter", rate_limiter.ModelRateLimiter(quota_per_minute=6000, burst=100))
+    store = fake_backends.FakeFirestore()
+    store.load({
+        "users/1": {
+            "profile": {"birth_year": 1990, "gender": "feminino", "height_cm": 165, "current_weight_kg": 60,
+                        "activity_level": "moderado", "goal": "manter"},
+            "diet_settings": {"daily_calorie_goal": 2000},
+            "user_state": {"awaiting": None},
+        },
+    })
+
+    def install(model):
+        core.set_backends(db_client=store, async_db_client=store.async_client(), model_obj=model)
+        return model
+
+    yield install
+    # Grava as escritas adiadas no fake antes de o monkeypatch restaurar o cliente real
+    fm.touch_flusher.flush()
+    if core.kcal_writer:
+        core.kcal_writer.flush()
+
+
+async def _collect(text, deadline_seconds):
+    parts = []
+    with rate_limiter.message_scope(deadline_seconds=deadline_seconds):
+        async for part in core.process_message_stream(1, "Ana", text):
+            parts.append(part)
+    return "".join(parts)
+
+
+@pytest.mark.parametrize("chunks_before_stall", [0, 2])
+def test_stalled_stream_ends_at_message_deadline(backends, chunks_before_stall):
+    model = backends(StallingModel(chunks_before_stall))
+    started = time.monotonic()
+    reply = asyncio.run(_collect("me sugere um jantar leve", deadline_seconds=0.5))
+    assert time.monotonic() - started < 2
+    assert model.closed
+    if chunks_before_stall:
+        assert reply.endswith("(Resposta interrompida 😟)")
+        assert len(reply) > len("\n\n(Resposta interrompida 😟)")
+    else:
+        assert reply == core.STREAM_TIMEOUT_REPLY
+
+
+def test_stream_within_deadline_is_untouched(backends):
+    backends(fake_backends.FakeGenerativeModel(chunk_latency_seconds=0.01))
+    reply = asyncio.run(_collect("me sugere um jantar leve", deadline_seconds=5))
+    assert reply
+    assert "Resposta interrompida" not in reply and reply != core.STREAM_TIMEOUT_REPLY
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: tests/test_webhook_routes.py (v1 - Segredo obrigatório no webhook)
+
+import asyncio
+
+import pytest
+
+import http_server
+import telegram_bot
+
+
+class _Application:
+    bot = None
+    running = True
+
+    def __init__(self):
+        self.update_queue = asyncio.Queue()
+
+
+def _post(routes, headers, body=b"{}"):
+    request = http_server.Request("POST", telegram_bot.WEBHOOK_PATH, {}, headers, body)
+    return asyncio.run(routes[("POST", telegram_bot.WEBHOOK_PATH)](request))[0]
+
+
+def test_routes_refuse_to_build_without_secret(monkeypatch):
+    monkeypatch.setattr(telegram_bot, "WEBHOOK_SECRET", "")
+    monkeypatch.setattr(telegram_bot, "WEBHOOK_ALLOW_NO_SECRET", False)
+    with pytest.raises(ValueError):
+        telegram_bot.build_webhook_routes(_Application())
+
+
+def test_secret_is_checked(monkeypatch):
+    monkeypatch.setattr(telegram_bot, "WEBHOOK_SECRET", "s3cr3t")
+    routes = telegram_bot.build_webhook_routes(_Application())
+    assert _post(routes, {}) == 403
+    assert _post(routes, {"x-telegram-bot-api-secret-token": "errado"}) == 403
+    assert _post(routes, {"x-telegram-bot-api-secret-token": "s3cr3t"}, b"nao e json") == 400
+
+
+def test_opt_out_accepts_without_secret(monkeypatch):
+    monkeypatch.setattr(telegram_bot, "WEBHOOK_SECRET", "")
+    monkeypatch.setattr(telegram_bot, "WEBHOOK_ALLOW_NO_SECRET", True)
+    routes = telegram_bot.build_webhook_routes(_Application())
+    assert _post(routes, {}, b"nao e json") == 400  # Passou do segredo; só o corpo é inválido
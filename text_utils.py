@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Nome do arquivo: text_utils.py (v1 - Normalização de texto compartilhada)
+
+import re
+import unicodedata
+
+_PUNCT_RE = re.compile(r"[^\w\s]")
+
+
+def normalize_text(text):
+    """Casefold, remove acentos e colapsa espaços ('  Olá  Mundo ' -> 'ola mundo')."""
+    if text is None:
+        return ""
+    decomposed = unicodedata.normalize("NFKD", str(text).casefold())
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(stripped.split())
+
+
+def tokenize(text):
+    """Normaliza e quebra em tokens, descartando pontuação."""
+    return _PUNCT_RE.sub(" ", normalize_text(text)).split()